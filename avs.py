@@ -1,4 +1,5 @@
 import os
+from tracing import traced
 
 class UndefinedVariableError(Exception):
   pass
@@ -109,6 +110,7 @@ def get_custom_commands(input_file):
   return commands_dict
 
 ##################################################################################################
+@traced()
 def get_trim_times(params, input_file, frame_rate):
 
   trims_list = list()
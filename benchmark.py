@@ -0,0 +1,384 @@
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+EXECUTE = os.path.join(ROOT, 'execute_ffmpeg.py')
+FRAME_RATE = os.path.join(ROOT, 'frame_rate.py')
+
+RATE = '24000/1001'
+FONT_PATTERNS = ['/usr/share/fonts/**/*.ttf', '/usr/share/fonts/**/*.otf']
+METRICS = ['wall', 'cpu', 'read_bytes', 'written_bytes']
+
+# stages are run in this order on every source. later stages work on the
+# outputs of earlier ones, the same way an episode is worked on by hand.
+STAGES = [
+  ('frame_rate', FRAME_RATE, list()),
+  ('video', EXECUTE, ['-an', '-sn', '-tn', '-x']),
+  ('audio', EXECUTE, ['-vn', '-sn', '-tn', '-x']),
+  ('subtitles', EXECUTE, ['-vn', '-an', '-tn', '-subtrim', '-x']),
+  ('merge', EXECUTE, ['-an', '-sn', '-tn', '-mx']),
+  ('chapters', EXECUTE, ['-cc', '-config', 'source.json']),
+  ('mux', EXECUTE, ['-mx']),
+  ('graph', EXECUTE, ['-graph', '-sn', '-tn', '-x']),
+]
+
+# timings below this many seconds are too noisy to be compared.
+MIN_COMPARED_TIME = 0.05
+
+##################################################################################################
+def get_params():
+
+  parser = argparse.ArgumentParser(description='runs the whole pipeline on generated sources ' \
+    'and reports wall time, cpu time and bytes read / written of every stage.')
+  parser.add_argument('-sizes', type=str, default='640x360,1280x720',
+    help='comma separated frame sizes. every size gets its own source.')
+  parser.add_argument('-duration', type=int, default=30, help='source duration in seconds.')
+  parser.add_argument('-audio', type=int, default=2, help='number of audio tracks in the source.')
+  parser.add_argument('-trims', type=int, default=3, help='number of trims in the avscript.')
+  parser.add_argument('-font', type=str, help='font attached to the source. the first font ' \
+    'found under /usr/share/fonts is used by default.')
+  parser.add_argument('-stages', type=str, help='comma separated stages to run (default: all). ' \
+    'available: %s.' % (', '.join([x[0] for x in STAGES])))
+  parser.add_argument('-repeat', type=int, default=1, help='runs per stage. medians are reported.')
+  parser.add_argument('-output', type=str, help='writes the report to this json file. ' \
+    'a saved report can be used as -baseline later.')
+  parser.add_argument('-baseline', type=str, help='compares the report against this json file.')
+  parser.add_argument('-threshold', type=float, default=0.10,
+    help='relative slow down (of wall or cpu time) reported as a regression.')
+  parser.add_argument('-keep', action='store_true', help='keeps the work directory.')
+
+  params = vars(parser.parse_args())
+  params['sizes'] = [x.strip() for x in params['sizes'].split(',') if x.strip()]
+  params['stages'] = [x.strip() for x in params['stages'].split(',')] \
+    if params['stages'] else [x[0] for x in STAGES]
+
+  unknown = set(params['stages']) - set([x[0] for x in STAGES])
+  if unknown:
+    print('Unknown stages: %s' % (', '.join(sorted(unknown)))); exit(0)
+
+  if params['font'] is None:
+    fonts = sorted(sum([glob.glob(x, recursive=True) for x in FONT_PATTERNS], list()))
+    params['font'] = fonts[0] if fonts else None
+
+  return params
+
+##################################################################################################
+def get_frames(params):
+
+  return int(params['duration'] * 24000 / 1001)
+
+##################################################################################################
+def get_trims(params):
+
+  # evenly spaced trims with a dropped part between every two of them.
+  frames = get_frames(params)
+  parts = 2 * params['trims'] - 1
+  step = frames // parts
+
+  return [(num * step, (num + 1) * step - 1) for num in range(0, parts, 2)]
+
+##################################################################################################
+def get_subtitle_content(params, font_name):
+
+  lines = [
+    '[Script Info]',
+    'ScriptType: v4.00+',
+    'PlayResX: 1280',
+    'PlayResY: 720',
+    '',
+    '[V4+ Styles]',
+    'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, ' \
+      'BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, ' \
+      'BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding',
+    'Style: Default,%s,48,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,' \
+      '0,0,1,2,1,2,20,20,20,1' % (font_name),
+    'Style: Sign,%s,36,&H0000FFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,' \
+      '0,0,1,2,1,8,20,20,20,1' % (font_name),
+    '',
+    '[Events]',
+    'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text',
+  ]
+
+  # a dialogue line every second and a sign every five seconds.
+  for second in range(params['duration']):
+    lines.append('Dialogue: 0,0:%02d:%02d.00,0:%02d:%02d.80,Default,,0,0,0,,Line %d' % (
+      second // 60, second % 60, second // 60, second % 60, second + 1))
+
+    if second % 5 == 0:
+      lines.append('Dialogue: 1,0:%02d:%02d.00,0:%02d:%02d.00,Sign,,0,0,0,,' \
+        '{\\pos(640,60)}Sign %d' % (second // 60, second % 60,
+          (second + 4) // 60, (second + 4) % 60, second // 5 + 1))
+
+  return '\n'.join(lines) + '\n'
+
+##################################################################################################
+def get_chapter_metadata(params):
+
+  # four chapters in ffmetadata format.
+  lines = [';FFMETADATA1']
+  step = params['duration'] * 1000 // 4
+
+  for num in range(4):
+    lines.extend(['[CHAPTER]', 'TIMEBASE=1/1000', 'START=%d' % (num * step),
+      'END=%d' % ((num + 1) * step - 1), 'title=Part %d' % (num + 1)])
+
+  return '\n'.join(lines) + '\n'
+
+##################################################################################################
+def get_script_content(params):
+
+  trims = get_trims(params)
+  chapters = ','.join(['>Part %d[%d:%d]<' % (num + 1, start, end)
+    for num, (start, end) in enumerate(trims)])
+
+  return 'FFVideoSource("source.mkv")\n' \
+    '%s\n' \
+    '##>input=source.mkv\n' \
+    '##!!%s\n' % ('++'.join(['Trim(%d,%d)' % x for x in trims]), chapters)
+
+##################################################################################################
+def get_lavfi_inputs(size, duration, audio):
+
+  inputs = ['-f', 'lavfi', '-i', 'testsrc2=size=%s:rate=%s:duration=%d' % (size, RATE, duration)]
+  for track in range(audio):
+    inputs.extend(['-f', 'lavfi', '-i', 'sine=frequency=%d:sample_rate=48000:duration=%d' % (
+      440 * (track + 1), duration)])
+
+  return inputs
+
+##################################################################################################
+def create_fixtures(params, size, directory):
+
+  # synthetic source from lavfi: a test pattern, one sine per audio track,
+  # an ass track, chapters and (when a font is found) a font attachment.
+  os.makedirs(directory, exist_ok=True)
+  font_name = os.path.splitext(os.path.basename(params['font']))[0] \
+    if params['font'] else 'Arial'
+
+  open(os.path.join(directory, 'source.ass'), 'w').write(
+    get_subtitle_content(params, font_name))
+  open(os.path.join(directory, 'chapters.txt'), 'w').write(get_chapter_metadata(params))
+
+  command = ['ffmpeg', '-v', 'error'] + get_lavfi_inputs(size, params['duration'],
+    params['audio']) + ['-i', 'source.ass', '-f', 'ffmetadata', '-i', 'chapters.txt']
+
+  for track in range(params['audio'] + 2):
+    command.extend(['-map', '%d' % (track)])
+  command.extend(['-map_chapters', '%d' % (params['audio'] + 2)])
+
+  if params['font']:
+    mimetype = 'application/vnd.ms-opentype' if params['font'].endswith('.otf') \
+      else 'application/x-truetype-font'
+    command.extend(['-attach', params['font'], '-metadata:s:t', 'mimetype=%s' % (mimetype)])
+
+  command.extend(['-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'flac',
+    '-c:s', 'copy', '-y', 'source.mkv'])
+  subprocess.run(command, cwd=directory, check=True)
+
+  # a short opening for ordered chapters.
+  subprocess.run(['ffmpeg', '-v', 'error'] + get_lavfi_inputs(size, 5, 1) + [
+    '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'flac', '-y', 'op.mkv'],
+    cwd=directory, check=True)
+
+  write_scripts(params, directory)
+  return set(os.listdir(directory))
+
+##################################################################################################
+def write_scripts(params, directory):
+
+  # rewritten before every run, since frame_rate.py appends to the avscript.
+  open(os.path.join(directory, 'source.avs'), 'w').write(get_script_content(params))
+  json.dump({'source.avs': {'trims': get_trims(params), 'op': 'op.mkv'}},
+    open(os.path.join(directory, 'source.json'), 'w'))
+
+##################################################################################################
+def reset_directory(params, directory, fixtures):
+
+  for name in os.listdir(directory):
+    if name not in fixtures:
+      path = os.path.join(directory, name)
+      shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+  write_scripts(params, directory)
+
+##################################################################################################
+def get_span_totals(trace_filename):
+
+  # spans of a stage summed by name.
+  totals = dict()
+  if not os.path.isfile(trace_filename):
+    return totals
+
+  for event in json.load(open(trace_filename, 'r')).get('traceEvents', list()):
+    args = event.get('args', dict())
+    total = totals.setdefault(event['name'], {'count': 0, 'wall': 0.0,
+      'children_cpu': 0.0, 'read_bytes': 0, 'written_bytes': 0})
+
+    total['count'] += 1
+    total['wall'] += event['dur'] / 1000000
+    total['children_cpu'] += args.get('children_cpu_s', 0)
+    total['read_bytes'] += args.get('read_bytes', 0) + args.get('children_read_bytes', 0)
+    total['written_bytes'] += args.get('written_bytes', 0) + args.get('children_written_bytes', 0)
+
+  return totals
+
+##################################################################################################
+def run_stage(command, directory, trace_filename, log_filename, env):
+
+  before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  started = time.perf_counter()
+
+  with open(log_filename, 'w') as log:
+    result = subprocess.run(command + ['-trace', trace_filename], cwd=directory, env=env,
+      stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+  wall = time.perf_counter() - started
+  after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+  return {
+    'returncode': result.returncode,
+    'wall': wall,
+    'cpu': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+    # block counts are in 512 byte units.
+    'read_bytes': (after.ru_inblock - before.ru_inblock) * 512,
+    'written_bytes': (after.ru_oublock - before.ru_oublock) * 512,
+    'spans': get_span_totals(trace_filename)
+  }
+
+##################################################################################################
+def summarise(runs):
+
+  summary = {key: median([x[key] for x in runs]) for key in METRICS}
+  summary['runs'] = len(runs)
+  summary['failed'] = len([x for x in runs if x['returncode']])
+  summary['spans'] = runs[-1]['spans']
+
+  return summary
+
+##################################################################################################
+def get_environment(params):
+
+  try:
+    ffmpeg = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE,
+      stderr=subprocess.DEVNULL).stdout.decode('utf-8').split('\n')[0]
+  except OSError:
+    ffmpeg = None
+
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'ffmpeg': ffmpeg,
+    'font': params['font']
+  }
+
+##################################################################################################
+def run_benchmark(params, work_dir):
+
+  results = dict()
+  log_dir = os.path.join(work_dir, 'logs')
+  os.makedirs(log_dir)
+
+  print('%-10s %-11s %9s %9s %13s %13s' % ('size', 'stage', 'wall (s)',
+    'cpu (s)', 'read (bytes)', 'written'))
+
+  for size in params['sizes']:
+    directory = os.path.join(work_dir, size)
+    fixtures = create_fixtures(params, size, directory)
+    runs = dict()
+
+    for run in range(params['repeat']):
+      reset_directory(params, directory, fixtures)
+
+      # every run starts with a cold probe cache of its own.
+      env = dict(os.environ, XDG_CACHE_HOME=os.path.join(work_dir, 'cache_%s_%d' % (size, run)))
+
+      for stage, script, arguments in STAGES:
+        if stage not in params['stages']:
+          continue
+
+        if stage == 'mux' and not params['font']:
+          arguments = arguments + ['-tn']
+
+        name = '%s_%s_%d' % (size, stage, run)
+        result = run_stage([sys.executable, script, 'source.avs'] + arguments, directory,
+          os.path.join(log_dir, '%s.json' % (name)), os.path.join(log_dir, '%s.log' % (name)), env)
+        runs.setdefault(stage, list()).append(result)
+
+        print('%-10s %-11s %9.2f %9.2f %13d %13d%s' % (size, stage, result['wall'],
+          result['cpu'], result['read_bytes'], result['written_bytes'],
+          ' (exit code: %d)' % (result['returncode']) if result['returncode'] else str()))
+
+    results[size] = {stage: summarise(stage_runs) for stage, stage_runs in runs.items()}
+
+  return results
+
+##################################################################################################
+def compare_reports(report, baseline, threshold):
+
+  regressions = list()
+  print('\n%-10s %-11s %-5s %9s %9s %8s' % ('size', 'stage', 'time', 'baseline', 'current', 'change'))
+
+  for size, stages in sorted(report['results'].items()):
+    for stage, summary in sorted(stages.items()):
+      previous = baseline.get('results', dict()).get(size, dict()).get(stage)
+      if not previous:
+        continue
+
+      for key in ['wall', 'cpu']:
+        if previous[key] < MIN_COMPARED_TIME:
+          continue
+
+        change = summary[key] / previous[key] - 1
+        regressed = change > threshold
+        if regressed:
+          regressions.append((size, stage, key, change))
+
+        print('%-10s %-11s %-5s %9.2f %9.2f %+7.1f%%%s' % (size, stage, key, previous[key],
+          summary[key], change * 100, ' <- regression' if regressed else str()))
+
+  return regressions
+
+##################################################################################################
+if __name__ == '__main__':
+
+  params = get_params()
+  work_dir = tempfile.mkdtemp(prefix='ffmpeg_wrapper_bench_')
+
+  try:
+    report = {
+      'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'environment': get_environment(params),
+      'params': {key: params[key] for key in ['sizes', 'duration', 'audio', 'trims', 'repeat']},
+      'results': run_benchmark(params, work_dir)
+    }
+
+  finally:
+    if params['keep']:
+      print('Work directory: %s' % (work_dir))
+    else:
+      shutil.rmtree(work_dir)
+
+  if params['output']:
+    with open(params['output'], 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+    print('Report written: %s' % (params['output']))
+
+  if params['baseline']:
+    regressions = compare_reports(report, json.load(open(params['baseline'], 'r')),
+      params['threshold'])
+
+    if regressions:
+      print('\n%d regression(s) beyond %.0f%% against %s' % (len(regressions),
+        params['threshold'] * 100, params['baseline']))
+      sys.exit(1)
@@ -2,7 +2,8 @@ import os
 import time
 import chameleon
 from datetime import timedelta
-from metadata import get_metadata
+from metadata import get_metadata_many
+from tracing import traced
 
 
 CH_TEMPLATE_STRING = \
@@ -313,6 +314,7 @@ def get_chapter_mux_command(params):
   return command
 
 ##################################################################################################
+@traced()
 def handle_chapter_writing(params):
 
   if not params.get('cc'):
@@ -324,14 +326,15 @@ def handle_chapter_writing(params):
     exit(0)
 
   if not params['op'] and params.get('config') and params['config'].get('op'):
-    params['op'] = get_metadata(params, params['config']['op'])
+    params['op'] = params['config']['op']
   if not params['ed'] and params.get('config') and params['config'].get('ed'):
-    params['ed'] = get_metadata(params, params['config']['ed'])
+    params['ed'] = params['config']['ed']
 
-  params['op'] = get_metadata(params, params['op']) \
-    if isinstance(params.get('op'), str) else params['op']
-  params['ed'] = get_metadata(params, params['ed']) \
-    if isinstance(params.get('ed'), str) else params['ed']
+  # probe opening and ending files together.
+  to_probe = [key for key in ['op', 'ed'] if isinstance(params.get(key), str)]
+  for key, metadata in zip(to_probe, get_metadata_many(
+      params, [params[key] for key in to_probe])):
+    params[key] = metadata
 
   # if params['source_delay']:
   #   chapter_delay = -1 * int(params['source_delay'])
@@ -1,3 +1,13 @@
 class FileNotFoundError(Exception):
   pass
 
+
+class ExternalJobAborted(Exception):
+
+  # raised when an external job was killed because its output matched a fatal rule.
+  def __init__(self, rule, line, command, log_filename=None):
+    super().__init__('External job aborted on [%s]: %s' % (rule, line.strip()))
+    self.rule = rule
+    self.line = line
+    self.command = command
+    self.log_filename = log_filename
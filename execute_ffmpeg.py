@@ -3,14 +3,25 @@ import sys
 import time
 import json
 import argparse
-import subprocess
 from datetime import timedelta
+from functools import partial
 
-import pysubs
 import chameleon
 from external import start_external_execution
 from subedit import delay_subtitle, convert_to_ssa
-from metadata import get_metadata, get_ffprobe_metadata
+from subio import read_subtitle, write_subtitle, trim_subtitle
+from metadata import get_metadata, get_ffprobe_metadata, get_encoder_settings
+from probe import probe_file
+from probe_cache import disable_probe_cache
+from keyframes import get_keyframe_index, get_trim_gops, get_chunk_bounds
+from scheduler import (
+  CORES_PER_ENCODE, get_worker_count, get_lookahead_threads,
+  get_bash_script, run_jobs, run_sharded_jobs)
+from transport import get_export_dir, get_transports
+from progress import ProgressBoard
+from manifest import RunManifest, get_manifest_filename
+from segment_cache import restore_jobs, store_job, disable_segment_cache
+from tracing import traced, enable_tracing
 
 from chapters import handle_chapter_writing
 from avs import (
@@ -19,7 +30,7 @@ from muxer import (
   add_chapter_file,
   attach_fonts, merge_video,
   mux_episode, ffmpeg_audio_mux,
-  muxing_with_audio)
+  muxing_with_audio, mux_episode_with_audio)
 
 ##################################################################################################
 class FolderNotFoundError(Exception):
@@ -28,10 +39,23 @@ class FolderNotFoundError(Exception):
 ##################################################################################################
 def process_params(params):
 
-  if params.get('rs') and len(params['rs'].split(':')) == 2:
-    params['rs'] = params['rs'].split(':')
-    params['rs'] = [x.replace('0', '-1') if len(x) == 1 else x for x in params['rs']]
+  if params.get('trace'):
+    enable_tracing(params['trace'])
+
+  params['renditions'] = list()
+  for size in (params.get('rs') or str()).split(','):
+    if len(size.split(':')) == 2:
+      size = size.split(':')
+      params['renditions'].append([x.replace('0', '-1') if len(x) == 1 else x for x in size])
+
+  # the first rendition keeps every single -rs code path and name as is.
+  params['rs'] = params['renditions'][0] if params['renditions'] else params.get('rs')
   
+  if params['no_probe_cache']:
+    disable_probe_cache()
+  if params['no_segment_cache']:
+    disable_segment_cache()
+
   params['input_dir'] = os.path.dirname(os.path.abspath(params['in']))
   params['orig_dir'] = os.path.abspath(os.path.curdir)
 
@@ -67,10 +91,14 @@ def get_params():
 
   parser.add_argument('-node', default=-1, type=int, 
     help='computing node that will be sshed into and then used for encoding.')
+  parser.add_argument('-nodes', type=str, default=str(), help='shards trimmed sections or ' \
+    'chunks over several computing nodes, e.g. "3,5,7". "local:4" emulates four nodes ' \
+    'on this machine. concatenation and muxing stay on this machine.')
   parser.add_argument('-nohup', type=str, default=str(), help='starts process in background ' \
     'and redirects stdout, stderr to <NOHUP>. ' \
     'Also puts the job to background using nohup.')
-  parser.add_argument('-rs', type=str, help='resizes output video. ' \
+  parser.add_argument('-rs', type=str, help='resizes output video. a comma separated list ' \
+    '(1920:1080,1280:720) encodes every rendition from one decode. ' \
     'e.g. 1280:720 will give you 720p video. 1280:-1 will give you width of 1280 and height with ' \
     'respective aspect ratio. Same will apply for given height like -1:720')
   parser.add_argument('-dest', type=str, help='creates output file to given destination ' \
@@ -78,7 +106,7 @@ def get_params():
     'after completion.')
   parser.add_argument('-trim', type=int, help='processes given trimmed section only ' \
     'while ignoring rest of the video.')
-  parser.add_argument('-subtrim', action='store_true', help='trims subtitles using pysubs.' \
+  parser.add_argument('-subtrim', action='store_true', help='trims subtitles. ' \
     'trim will occur if input is an avscript (.avs) file with Trim commands.')
   parser.add_argument('-fake', type=str, help='adds fake metadata for streams to detected source. ' \
     'e.g. s:2 will add subtitle stream with track id 2. ' \
@@ -98,8 +126,24 @@ def get_params():
   parser.add_argument('-x', action='store_true', 
     help='executes the bash script, if created any, at the end.')
 
+  parser.add_argument('-seek', action='store_true', help='seeks on the input to each trimmed ' \
+    'section instead of decoding the source from frame 0. frame range stays the same.')
+  parser.add_argument('-smart', action='store_true', help='stream copies whole gops inside ' \
+    'trimmed sections and re-encodes only the partial gops at their ends. used for video only ' \
+    'jobs without -rs, -dframe or -r on sources already encoded with the target codec.')
+  parser.add_argument('-graph', action='store_true', help='encodes video and every audio ' \
+    'track with a single ffmpeg that reads and decodes the source once. subtitles are ' \
+    'extracted and delayed as they are without -graph.')
+  parser.add_argument('-chunks', type=int, default=0, help='splits a single video segment ' \
+    'into this many chunks at source keyframes, encodes them concurrently and joins them.')
   parser.add_argument('-nthread', action='store_true', help='disables multithreading of ffmpegs. ' \
-    'Otherwise each trimmed section will get a ffmpeg process in concurrency.')
+    'Otherwise trimmed sections are encoded concurrently by a pool of ffmpeg processes.')
+  parser.add_argument('-trace', type=str, help='writes timing spans of every stage (wall time, ' \
+    'child cpu time, bytes read / written) to this file as a chrome trace (chrome://tracing).')
+  parser.add_argument('-progress_json', type=str, help='appends progress samples of every ' \
+    'ffmpeg job (frame, fps, speed, bitrate, out_time, eta) to this file as json lines.')
+  parser.add_argument('-workers', type=int, help='number of ffmpeg processes that run at once. ' \
+    'defaults to one per %d available cores.' % (CORES_PER_ENCODE))
   parser.add_argument('-vn', action='store_true', help='disables video encoding.')
   parser.add_argument('-an', action='store_true', help='disables audio encoding.')
   parser.add_argument('-sn', action='store_true', help='disables subtitle encoding / copying.')
@@ -121,6 +165,15 @@ def get_params():
   parser.add_argument('-dframe', type=str, help='draws frame number on video using filter graph.')
   parser.add_argument('-config', type=str, help='path to json config file.')
   parser.add_argument('-abitrate', type=int, help='bitrate per channel for audio encoding.', default=40000)
+  parser.add_argument('-no_probe_cache', action='store_true',
+    help='probes sources again instead of reading ffprobe / mediainfo results from the cache.')
+  parser.add_argument('-probe_jobs', type=int,
+    help='number of files probed concurrently when several files are probed at once.')
+  parser.add_argument('-no_segment_cache', action='store_true',
+    help='encodes every segment instead of reusing identical encodes from the segment cache.')
+  parser.add_argument('-resume', action='store_true',
+    help='skips jobs recorded in the run manifest whose outputs exist and pass a container ' \
+    'check. only missing or failed jobs are run again before concatenation and muxing.')
 
   params = parser.parse_args().__dict__
   params = process_params(params)
@@ -147,52 +200,16 @@ def get_source(input_file):
   return os.path.join(os.path.dirname(params['in']), input_source)
 
 ##################################################################################################
+@traced()
 def get_frame_rate(filename):
   
   if not os.path.isfile(filename):
     raise FileNotFoundError('File does not exist: %s' % (filename))
 
-  probe_command = r'ffprobe -v error -select_streams v -show_entries ' \
-  'stream=r_frame_rate:stream_tags=DURATION,NUMBER_OF_FRAMES ' \
-  '-of default=noprint_wrappers=1 %s' % (os.path.basename(filename))
-
-  # info_command = r'mediainfo --Inform="Video;%FrameRate%"' 
-  # info_command = '%s %s' % (info_command, filename)
-
-  curr_dir = os.path.abspath(os.path.curdir)
-  os.chdir(params['input_dir'])
-
-  result = subprocess.Popen(probe_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-  result = result.replace('\r', '').strip('\n')
-  os.chdir(curr_dir)
-  
-  filtered = dict()
-
-  for expression in result.strip('\n').split('\n'):
-    key = expression.split('=')[0].lower()
-    value = expression.split('=')[1]
-
-    if 'r_frame_rate' in key:
-      numerator = int(value.split('/')[0])
-      denominator = int(value.split('/')[1])
-      value = round(numerator / denominator, 3)
-
-    if 'tag:number_of_frames' in key:
-      value = int(value)
-
-    if 'tag:duration' in key:
-      seconds = sum(int(x) * 60 ** i for i, x in enumerate(reversed(value.split('.')[0].split(":"))))
-      new_time = (seconds + float('0.' + value.split('.')[1])) if len(value.split('.')) > 1 else seconds
-      value = new_time
-
-    filtered[key] = value
-
-  if 'tag:number_of_frames' in filtered.keys() and 'tag:duration' in filtered.keys():
-    temp = str(filtered['tag:number_of_frames'] / filtered['tag:duration'])
-    return float(temp[: 1 + temp.find('.') + 3])
-
-  else:
-    return filtered['r_frame_rate']
+  # r_frame_rate, or NUMBER_OF_FRAMES / DURATION when matroska
+  # statistics tags are present. served from the probe cache.
+  media = probe_file(os.path.join(params['input_dir'], os.path.basename(filename)))
+  return media.frame_rate
   
 ##################################################################################################
 def get_fake_tracks(params):
@@ -237,10 +254,335 @@ def get_fake_tracks(params):
   return fake_streams
 
 ##################################################################################################
-def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
+def get_seek_time(params, frame_cut):
+
+  # input seeking is only used for video segments that do not start at
+  # frame 0. subtitles copied along with the segment would be cut by
+  # the seek as well, so those commands keep decoding from frame 0.
+  if not params.get('seek') or not frame_cut or not frame_cut[0]:
+    return None
+
+  if params['vn'] or not params['sn'] or params.get('r'):
+    return None
+
+  half_frame = 0.5 / params['frame_rate']
+  index = params.get('keyframes')
+
+  # seek straight to the keyframe that precedes start_frame. trim then
+  # counts frames from that keyframe, which is only exact when no frame
+  # of the gop is shown before it (closed gops).
+  keyframe = index.keyframe_before(frame_cut[0]) if index and index.closed_gop else None
+  if keyframe:
+    start_time = probe_file(params['source_file']).start_time
+    return {
+      'time': index.keyframe_time(keyframe) - start_time + half_frame,
+      'frame': keyframe,
+      'accurate': False
+    }
+
+  # -itsoffset cancels the source delay, so frame n sits at n / fps.
+  # seeking half a frame early makes ffmpeg decode from the preceding
+  # keyframe and drop everything before start_frame.
+  return {
+    'time': frame_cut[0] / params['frame_rate'] - half_frame,
+    'frame': frame_cut[0],
+    'accurate': True
+  }
+
+##################################################################################################
+def get_renditions(params):
+
+  return params.get('renditions') or [params['rs']]
+
+##################################################################################################
+def get_rendition_name(name, size):
+
+  # ep_01.mkv -> ep_01_1280x720.mkv. quoted destination paths stay quoted.
+  quote = '"' if name.endswith('"') else str()
+  root, extension = os.path.splitext(name.strip('"'))
+  return '{quote}{root}_{width}x{height}{extension}{quote}'.format(quote=quote,
+    root=root, width=size[0], height=size[1], extension=extension)
+
+##################################################################################################
+def get_picture_filters(params):
+
+  filters = list()
+
+  if params['rs']:
+    filters.append('scale={width}:{height}'.format(
+      width=params['rs'][0], height=params['rs'][1]))
+
+  if params['dframe']:
+    filters.append(
+      'drawtext=fontfile=' + params['dframe'] + ':'\
+      'text=\'%{frame_num}\':start_number=0:x=(w-(tw*1.1)):y=h-(1.2*lh):' \
+      'fontcolor=black:fontsize=24:box=1:boxcolor=white:boxborderw=5')
+
+  return filters
+
+##################################################################################################
+def get_video_encoder(params, threads=None):
+
+  psyrd = str() if not params.get('psyrd') else '-psy-rd %s' % (params['psyrd'])
+
+  # thread budget handed out by the scheduler. without one the
+  # encoders size their own pools from every core of the host.
+  if threads:
+    encoder_threads = '-threads %d' % (threads)
+    lookahead_threads = 'lookahead-threads=%d' % (get_lookahead_threads(threads))
+  else:
+    encoder_threads = str()
+    lookahead_threads = str()
 
-  frame_cut = None
-  if params.get('cuts') and params['cuts']['original'].get('frames'):
+  if params['hevc']:
+    if threads:
+      thread_params = 'pools=%d:%s:' % (threads, lookahead_threads)
+    else:
+      thread_params = str()
+
+    video_encoder = '-c:v libx265 {threads} ' \
+      '-preset slower -pix_fmt yuv420p10le -x265-params {thread_params}crf={crf}:aq-mode={aq_mode}:' \
+      'aq-strength={aq_strength}:subme=5:{vparams} {psyrd}'.format(
+        crf=params['crf'], threads=encoder_threads,
+        thread_params=thread_params, aq_mode=params['aqm'], aq_strength=params['aqs'],
+        vparams=params.get('vparams', str()), psyrd=psyrd)
+  else:
+    x264_params = [x for x in [lookahead_threads, params.get('vparams')] if x]
+    if x264_params:
+      vparams = '-x264-params %s' % (':'.join(x264_params))
+    else:
+      vparams = str()
+
+    video_encoder = '-c:v libx264 {threads} ' \
+      '-preset veryslow -pix_fmt yuv420p10le -crf {crf} -aq-mode {aq_mode} ' \
+      '-aq-strength {aq_strength} {psyrd} {vparams}'.format(
+        crf=params['crf'], threads=encoder_threads,
+        aq_mode=params['aqm'], aq_strength=params['aqs'],
+        psyrd=psyrd, vparams=vparams)
+
+  if params.get('profile'):
+    video_encoder += ' -profile:v %s' % (params['profile'])
+
+  if params.get('r'):
+    # video_encoder += ' -r %.3f' % (params['frame_rate'])
+    video_encoder += ' -r %.3f' % (params.get('r'))
+
+  return video_encoder
+
+##################################################################################################
+def get_audio_channels(params, track_id=-1):
+
+  if track_id != -1:
+    return params['audio_channels'][params['all_tracks']['a'].index(track_id)]
+  else:
+    return params['audio_channels'][-1]
+
+##################################################################################################
+def get_audio_encoder(params, track_id=-1, audio_filter=True):
+
+  # audio_filter=False leaves the opus channel layout filter
+  # to the caller, for streams coming out of a filter graph.
+  if params.get('fdkaac'):
+    return '-c:a libfdk_aac -vbr 4'
+  elif params.get('aac'):
+    return '-c:a aac -q:a 1.2'
+
+  channels = get_audio_channels(params, track_id)
+  
+  if channels > 2 and audio_filter:
+    return '-c:a libopus -af ' \
+      'aformat=channel_layouts="7.1|5.1|stereo" ' \
+      '-b:a {bitrate} -vbr on -compression_level 10'.format(
+        bitrate=(params['abitrate'] * channels))
+  else:
+    return '-c:a libopus -b:a {bitrate} ' \
+      '-vbr on -compression_level 10'.format(
+      bitrate=(params['abitrate'] * channels))
+
+##################################################################################################
+def get_audio_encoding(params, times, track_id=-1):
+
+  if times:
+    start = '%.3f' % (times[0]); end = '%.3f' % (times[1])
+    start_format = str(timedelta(seconds=int(start.split('.')[0]), milliseconds=int(start.split('.')[1])))
+    end_format = str(timedelta(seconds=int(end.split('.')[0]), milliseconds=int(end.split('.')[1])))
+    audio_cut = '-ss {start} -to {end}'.format(
+      start=start_format, end=end_format)
+  else:
+    audio_cut = str()
+
+  audio_encoder = '%s %s' % (audio_cut, get_audio_encoder(params, track_id))
+
+  if track_id != -1:
+    return '-map 0:%d %s' % (track_id, audio_encoder)
+  else:
+    return '-map 0:a %s' % (audio_encoder)
+
+##################################################################################################
+def get_multi_audio_command(params, times, command_num, track_ids, is_final=False):
+
+  # one demux of the source feeds an encoder and an output per track.
+  # is_final writes the outputs under the names the muxer looks for.
+  audio_ext = 'aac' if params.get('aac') else 'opus'
+  ffmpeg_version = 'ffmpeg-hi' if params['hi'] else 'ffmpeg'
+
+  if params['source_delay']:
+    negative_delay = -1 * float(int(params['source_delay']) / 1000)
+  else:
+    negative_delay = 0
+
+  outputs = list()
+  temp_names = dict()
+  for track_id in track_ids:
+    if times and not is_final:
+      temp_name = '%s_%02d_Audio_%d.%s' % (params['in'][:-4], command_num + 1, track_id, audio_ext)
+    else:
+      temp_name = '%s_Audio_%d.%s' % (params['in'][:-4], track_id, audio_ext)
+
+    if params['dest']:
+      temp_name = '"%s"' % (os.path.join(params['dest'], temp_name))
+
+    temp_names[track_id] = temp_name
+    outputs.append('%s -vn -sn -map_chapters -1 %s' % (
+      get_audio_encoding(params, times, track_id), temp_name))
+
+  ffmpeg_command = 'nice -n 15 {ffmpeg} -itsoffset {offset} -i {input} {outputs}'.format(
+    ffmpeg=ffmpeg_version, offset='%.3f' % (negative_delay),
+    input=params['source_file'], outputs=' '.join(outputs))
+
+  return {
+    'command': ffmpeg_command,
+    'temp_name': ', '.join(temp_names.values()),
+    'temp_names': temp_names,
+    'frames': None,
+  }
+
+##################################################################################################
+def get_graph_command(params, times_list, tracks, threads=None):
+
+  # the whole job as one ffmpeg: the source is demuxed and decoded once,
+  # split per trim, concatenated and fed to every encoder and output.
+  original = (params.get('cuts') or dict()).get('original', dict())
+  frames_list = original.get('frames') or list()
+  sections = list(times_list)
+
+  # -trim encodes the given section only.
+  if params.get('trim'):
+    sections = sections[params['trim'] - 1:params['trim']]
+    frames_list = frames_list[params['trim'] - 1:params['trim']]
+
+  count = len(sections)
+
+  def get_output_name(name):
+    return '"%s"' % (os.path.join(params['dest'], name)) if params['dest'] else name
+
+  def get_trimmed(label, stream, trim_filter, trims, concat_options):
+    # [stream] -> split -> one trim per section -> concat -> [label]
+    if count == 1:
+      return ['[%s]%s[%s]' % (stream, trim_filter % trims[0], label)]
+
+    graph = ['[%s]%s=%d%s' % (stream, 'split' if 'v=1' in concat_options else 'asplit',
+      count, ''.join(['[%s_in%d]' % (label, x) for x in range(count)]))]
+    for number, trim in enumerate(trims):
+      graph.append('[%s_in%d]%s[%s_%d]' % (label, number, trim_filter % trim, label, number))
+
+    graph.append('%sconcat=n=%d:%s[%s]' % (''.join(['[%s_%d]' % (label, x)
+      for x in range(count)]), count, concat_options, label))
+    return graph
+
+  graph = list()
+  outputs = list()
+  temp_names = list()
+
+  if not params['vn']:
+    video_label = '0:v'
+    if count and len(frames_list) == count:
+      graph.extend(get_trimmed('vcat', '0:v',
+        'trim=start_frame=%d:end_frame=%d,setpts=PTS-STARTPTS',
+        [(x[0], x[1] + 1) for x in frames_list], 'v=1:a=0'))
+      video_label = 'vcat'
+    elif count:
+      # no frame numbers for the trims, cut by time as the audio is.
+      graph.extend(get_trimmed('vcat', '0:v', 'trim=start=%.3f:end=%.3f,setpts=PTS-STARTPTS',
+        sections, 'v=1:a=0'))
+      video_label = 'vcat'
+
+    renditions = get_renditions(params)
+    video_name = get_output_name('%s_Encoded.mkv' % (params['in'][:-4]))
+    temp_names.append(video_name)
+    temp_names.extend([get_rendition_name(video_name, x) for x in renditions[1:]])
+
+    if len(renditions) > 1:
+      graph.append('[%s]split=%d%s' % (video_label, len(renditions),
+        ''.join(['[rs%d]' % (x) for x in range(len(renditions))])))
+      rendition_threads = max(1, threads // len(renditions)) if threads else None
+
+      for index, size in enumerate(renditions):
+        graph.append('[rs%d]%s[vout%d]' % (index,
+          ','.join(get_picture_filters(dict(params, rs=size))), index))
+        outputs.append('-map [vout{index}] {vsync} {encoder} -an -sn -map_chapters -1 ' \
+          '{output}'.format(index=index, vsync='-vsync -1' if params.get('r') else '-vsync 0',
+            encoder=get_video_encoder(dict(params, crf=params['rendition_crfs'][index]),
+              rendition_threads),
+            output=video_name if not index else get_rendition_name(video_name, size)))
+
+    else:
+      filters = get_picture_filters(params)
+      if filters:
+        graph.append('[%s]%s[vout]' % (video_label, ','.join(filters)))
+        video_label = 'vout'
+
+      video_map = '0:v' if video_label == '0:v' else '[%s]' % (video_label)
+      outputs.append('-map {map} {vsync} {encoder} -an -sn -map_chapters -1 {output}'.format(
+        map=video_map, vsync='-vsync -1' if params.get('r') else '-vsync 0',
+        encoder=get_video_encoder(params, threads), output=video_name))
+
+  if not params['an']:
+    audio_ext = 'aac' if params.get('aac') else 'opus'
+    for track_id in tracks['a']:
+      audio_map = '0:%d' % (track_id)
+      if count:
+        graph.extend(get_trimmed('a%d' % (track_id), audio_map,
+          'atrim=start=%.3f:end=%.3f,asetpts=PTS-STARTPTS', sections, 'v=0:a=1'))
+        audio_map = 'a%d' % (track_id)
+
+      if get_audio_channels(params, track_id) > 2 and not params.get('aac') \
+          and not params.get('fdkaac'):
+        graph.append('[%s]aformat=channel_layouts=7.1|5.1|stereo[a%d_fmt]' % (
+          audio_map, track_id))
+        audio_map = 'a%d_fmt' % (track_id)
+
+      temp_names.append(get_output_name('%s_Audio_%d.%s' % (params['in'][:-4], track_id,
+        audio_ext)))
+      outputs.append('-map %s %s -vn -sn -map_chapters -1 %s' % (
+        audio_map if audio_map.startswith('0:') else '[%s]' % (audio_map),
+        get_audio_encoder(params, track_id, audio_filter=False), temp_names[-1]))
+
+  if params['source_delay']:
+    negative_delay = -1 * float(int(params['source_delay']) / 1000)
+  else:
+    negative_delay = 0
+
+  ffmpeg_command = 'nice -n 15 {ffmpeg} -itsoffset {offset} -i {input} {graph} {outputs}'.format(
+    ffmpeg='ffmpeg-hi' if params['hi'] else 'ffmpeg', offset='%.3f' % (negative_delay),
+    input=params['source_file'], outputs=' '.join(outputs),
+    graph='-filter_complex "%s"' % (';'.join(graph)) if graph else str())
+
+  return {
+    'command': ffmpeg_command,
+    'temp_name': ', '.join(temp_names),
+    'temp_names': temp_names,
+    'frames': sum([x[1] - x[0] + 1 for x in frames_list]) or None,
+    'progress_frames': sum([x[1] - x[0] + 1 for x in frames_list]) or None,
+    'builder': partial(get_graph_command, params, times_list, tracks),
+  }
+
+##################################################################################################
+def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1, frames=None,
+    threads=None):
+
+  frame_cut = frames
+  if not frame_cut and params.get('cuts') and params['cuts']['original'].get('frames'):
 
     original = params['cuts']['original']
     if times in original['timestamps']:
@@ -251,21 +593,20 @@ def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
     start_frame = frame_cut[0]
     end_frame = frame_cut[1] + 1
 
-  if times:
-    start = '%.3f' % (times[0]); end = '%.3f' % (times[1])
-    start_format = str(timedelta(seconds=int(start.split('.')[0]), milliseconds=int(start.split('.')[1])))
-    end_format = str(timedelta(seconds=int(end.split('.')[0]), milliseconds=int(end.split('.')[1])))
+  seek = get_seek_time(params, frame_cut)
+  if seek:
+    # input is already positioned at seek['frame'].
+    # trim counts frames from there.
+    start_frame -= seek['frame']
+    end_frame -= seek['frame']
 
-    # if params['source_delay']:
-    #   keyframe_delay = -1 * int(params['source_delay'])
-    #   seconds, millisecs = [int(x) for x in end.split('.')]
-    #   delayed_end = ((seconds * 1000) + millisecs) + keyframe_delay
-    #   delayed_end = '%.3f' % (delayed_end / 1000)
-    #   delayed_end_format = str(timedelta(seconds=int(delayed_end.split('.')[0]),
-    #                            milliseconds=int(delayed_end.split('.')[1])))
-    #   keyframes = '-force_key_frames %s' % (delayed_end_format)
-    # else:
-    #   keyframes = '-force_key_frames %s' % (end_format)
+    if times:
+      times = (max(times[0] - seek['time'], 0), max(times[1] - seek['time'], 0))
+    input_seek = '-ss %.6f' % (seek['time'])
+    if not seek['accurate']:
+      input_seek += ' -noaccurate_seek'
+  else:
+    input_seek = str()
 
   if params['vn'] and params['sn'] and params['tn'] and not params['an']:
     audio_ext = 'aac' if params.get('aac') else 'opus'
@@ -281,9 +622,12 @@ def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
 
   if params['dest']:
     temp_name = '"%s"' % (os.path.join(params['dest'], temp_name))
+
+  if frames is None and can_smart_render(params, frame_cut):
+    return get_smart_render_command(params, times, frame_cut, command_num,
+      temp_name, is_out, track_id, threads)
   
   video_filters = str()
-  psyrd = str() if not params.get('psyrd') else '-psy-rd %s' % (params['psyrd'])
   
   if frame_cut:
     video_filters += '[0:v]trim=start_frame={start}:' \
@@ -301,19 +645,19 @@ def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
     # with -r option in ffmpeg.
     vsync = '-vsync 0'
 
-  filters = list()
-
-  if params['rs']:
-    filters.append('scale={width}:{height}'.format(
-      width=params['rs'][0], height=params['rs'][1]))
+  renditions = get_renditions(params)
+  filters = get_picture_filters(params)
 
-  if params['dframe']:
-    filters.append(
-      'drawtext=fontfile=' + params['dframe'] + ':'\
-      'text=\'%{frame_num}\':start_number=0:x=(w-(tw*1.1)):y=h-(1.2*lh):' \
-      'fontcolor=black:fontsize=24:box=1:boxcolor=white:boxborderw=5')
+  if len(renditions) > 1 and not params['vn']:
+    # one decode, split once per rendition, each scaled and encoded on its own.
+    video_filters += '{source}split={count}{labels};'.format(
+      source='[part]' if frame_cut else '[0:v]', count=len(renditions),
+      labels=''.join(['[rs%d]' % (x) for x in range(len(renditions))]))
+    for index, size in enumerate(renditions):
+      video_filters += '[rs{index}]{complex}[out{index}];'.format(index=index,
+        complex=','.join(get_picture_filters(dict(params, rs=size))))
 
-  if params['rs'] and frame_cut:
+  elif params['rs'] and frame_cut:
     video_filters += '[part]{complex}[out];'.format(complex=','.join(filters))
   elif params['rs'] and not frame_cut:
     video_filters += '[0:v]{complex}[out];'.format(complex=','.join(filters))
@@ -324,6 +668,12 @@ def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
 
   if params['vn']:
     video_encoding = '-vn'
+  elif len(renditions) > 1:
+    rendition_threads = max(1, threads // len(renditions)) if threads else None
+    rendition_encodings = ['-map [out%d] %s' % (index, get_video_encoder(
+      dict(params, crf=params['rendition_crfs'][index]), rendition_threads))
+      for index in range(len(renditions))]
+    video_encoding = '%s %s' % (video_filters, rendition_encodings[0])
   else:
 
     if video_filters:
@@ -332,64 +682,12 @@ def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
     else:
       video_filters = '-map 0:v'
 
-    if params['hevc']:
-      video_encoding = '{vfilters} -c:v libx265 ' \
-        '-preset slower -pix_fmt yuv420p10le -x265-params crf={crf}:aq-mode={aq_mode}:' \
-        'aq-strength={aq_strength}:subme=5:{vparams} {psyrd}'.format(
-          vfilters=video_filters, crf=params['crf'],
-          aq_mode=params['aqm'], aq_strength=params['aqs'],
-          vparams=params.get('vparams', str()), psyrd=psyrd)
-    else:
-      if params.get('vparams'):
-        vparams = '-x264-params %s' % params.get('vparams')
-      else:
-        vparams = str()
-
-      video_encoding = '{vfilters} -c:v libx264 ' \
-        '-preset veryslow -pix_fmt yuv420p10le -crf {crf} -aq-mode {aq_mode} ' \
-        '-aq-strength {aq_strength} {psyrd} {vparams}'.format(
-          vfilters=video_filters, crf=params['crf'],
-          aq_mode=params['aqm'], aq_strength=params['aqs'],
-          psyrd=psyrd, vparams=vparams)
-
-    if params.get('r'):
-      # video_encoding += ' -r %.3f' % (params['frame_rate'])
-      video_encoding += ' -r %.3f' % (params.get('r'))
+    video_encoding = '%s %s' % (video_filters, get_video_encoder(params, threads))
 
   if params['an']:
     audio_encoding = '-an'
   else:
-
-    if times:
-      audio_cut = '-ss {start} -to {end}'.format(
-        start=start_format, end=end_format)
-    else:
-      audio_cut = str()
-
-    if params.get('fdkaac'):
-      audio_encoder = '%s -c:a libfdk_aac -vbr 4' % (audio_cut)
-    elif params.get('aac'):
-      audio_encoder = '%s -c:a aac -q:a 1.2' % (audio_cut)
-    else:
-      if track_id != -1:
-        channels = params['audio_channels'][params['all_tracks']['a'].index(track_id)]
-      else:
-        channels = params['audio_channels'][-1]
-      
-      if channels > 2:
-        audio_encoder = '{audio_cut} -c:a libopus -af ' \
-          'aformat=channel_layouts="7.1|5.1|stereo" ' \
-          '-b:a {bitrate} -vbr on -compression_level 10'.format(
-            audio_cut=audio_cut, bitrate=(params['abitrate'] * channels))
-      else:
-        audio_encoder = '{audio_cut} -c:a libopus -b:a {bitrate} ' \
-          '-vbr on -compression_level 10'.format(
-          audio_cut=audio_cut, bitrate=(params['abitrate'] * channels))
-
-    if track_id is not -1:
-      audio_encoding = '-map 0:%d %s' % (track_id, audio_encoder)
-    else:
-      audio_encoding = '-map 0:a %s' % (audio_encoder)
+    audio_encoding = get_audio_encoding(params, times, track_id)
     
   if params['sn']:
     subtitle_transcoding = '-sn'
@@ -414,54 +712,230 @@ def get_ffmpeg_command(params, times, command_num=0, is_out=str(), track_id=-1):
   else:
     ffmpeg_version = 'ffmpeg-hi'
 
-  if not params['nthread']:
-    PID = 'PID%02d' % (command_num + 1)
-    threading = '& %s=$!' % (PID)
-  else:
-    threading = str()
-    PID = str()
-  
   if params['source_delay']:
     negative_delay = -1 * float(int(params['source_delay']) / 1000)
   else:
     negative_delay = 0
   
-  if times and not temp_name.endswith('ass'):
-    ffmpeg_command = 'nice -n 15 {ffmpeg} -itsoffset {offset} -i {input} ' \
+  if len(renditions) > 1 and not params['vn']:
+    # the first rendition keeps the plain names, others get a size suffix.
+    temp_names = [temp_name] + [get_rendition_name(temp_name, x) for x in renditions[1:]]
+    video_encodings = [video_encoding] + rendition_encodings[1:]
+    extra_outputs = ' '.join(['{vsync} {video} {audio} {subtitle} {attachments} {chapter} ' \
+      '{output}'.format(vsync=vsync, video=video, audio=audio_encoding,
+        subtitle=subtitle_transcoding, attachments=attachments,
+        chapter=chapter_attachment, output=output)
+      for video, output in zip(video_encodings[1:], temp_names[1:])])
+    output = '%s %s' % (temp_name, extra_outputs)
+  else:
+    temp_names = [temp_name]
+    output = temp_name
+
+  if times and not temp_names[0].endswith('ass'):
+    ffmpeg_command = 'nice -n 15 {ffmpeg} -itsoffset {offset} {seek} -i {input} ' \
       '{vsync} {video} {audio} {subtitle} {attachments} {chapter} ' \
-      '{output} {threading}'.format(
+      '{output}'.format(
         ffmpeg=ffmpeg_version, offset='%.3f' % (negative_delay),
-        input=params['source_file'], vsync=vsync,
+        seek=input_seek, input=params['source_file'], vsync=vsync,
         video=video_encoding, audio=audio_encoding,
         subtitle=subtitle_transcoding,
         attachments=attachments, chapter=chapter_attachment,
-        output=temp_name, threading=threading)
+        output=output)
   else:
     ffmpeg_command = 'nice -n 15 {ffmpeg} -itsoffset {offset} -i {input} ' \
       '{vsync} {video} {audio} {subtitle} {attachments} {chapter} ' \
-      '{output} {threading}'.format(
+      '{output}'.format(
         ffmpeg=ffmpeg_version, offset='%.3f' % (negative_delay),
         input=params['source_file'], vsync=vsync,
         video=video_encoding, audio=audio_encoding,
         subtitle=subtitle_transcoding, attachments=attachments,
-        chapter=chapter_attachment, output=temp_name,
-        threading=threading)
+        chapter=chapter_attachment, output=output)
 
   return {
     'command': ffmpeg_command,
+    'temp_name': temp_names[0],
+    'temp_names': temp_names,
+    'frames': (frame_cut[1] - frame_cut[0] + 1) * len(temp_names) if frame_cut else None,
+    # frames ffmpeg reports as progress, for the first output.
+    'progress_frames': frame_cut[1] - frame_cut[0] + 1 if frame_cut else None,
+    # source frames of the output, part of the segment cache key.
+    'frame_range': tuple(frame_cut) if frame_cut else None,
+    # rebuilds the command once the scheduler assigns a thread budget.
+    'builder': partial(get_ffmpeg_command, params, times, command_num,
+      is_out, track_id, frames),
+  }
+
+##################################################################################################
+def get_smart_encoder_params(params):
+
+  # head and tail pieces are decoded along with the copied gops, so they
+  # have to be encoded with the profile, level, reference frames and
+  # b-frames of the source. those are read from the settings x264 / x265
+  # wrote into the stream. None when the source does not carry them.
+  video = probe_file(params['source_file']).video
+  settings = get_encoder_settings(params['source_file'])
+
+  if not video.get('profile') or not video.get('level') or video['level'] < 0:
+    return None
+  if not settings.get('ref') or not settings.get('bframes'):
+    return None
+
+  if params['hevc']:
+    pyramid = settings.get('b-pyramid', '1')
+    # level_idc is 30 times the level.
+    encoder_params = ['level-idc=%g' % (video['level'] / 30.0)]
+  else:
+    pyramid = settings.get('b_pyramid', '2')
+    encoder_params = ['level=%g' % (video['level'] / 10.0)]
+
+  # every keyframe carries its own sps / pps. concat -c copy keeps only
+  # the extradata of the first piece.
+  encoder_params.extend(['ref=%s' % (settings['ref']), 'bframes=%s' % (settings['bframes']),
+    'b-pyramid=%s' % (pyramid), 'open-gop=0', 'repeat-headers=1'])
+
+  return {
+    'profile': video['profile'].lower().replace(' ', str()),
+    'vparams': ':'.join([x for x in [params.get('vparams'), ':'.join(encoder_params)] if x])
+  }
+
+##################################################################################################
+def can_smart_render(params, frame_cut):
+
+  # only plain video segments can be stitched from copied and
+  # re-encoded pieces: nothing may alter the picture and the source
+  # must already be what the encoder produces.
+  if not params.get('smart') or not frame_cut or not params.get('keyframes'):
+    return False
+
+  if params['rs'] or params['dframe'] or params.get('r') or params['vn']:
+    return False
+
+  if not (params['an'] and params['sn'] and params['tn']):
+    return False
+
+  # with open gops, frames after a copied keyframe may reference the gop
+  # before it, and -frames:v (decode order) would not end on a gop.
+  if not params['keyframes'].closed_gop:
+    return False
+
+  video = probe_file(params['source_file']).video
+  if video.get('codec_name') != ('hevc' if params['hevc'] else 'h264') or \
+      video.get('pix_fmt') != 'yuv420p10le':
+    return False
+
+  if not get_smart_encoder_params(params):
+    return False
+
+  gop = get_trim_gops(params['keyframes'], [frame_cut])[0]
+  return gop['last'] is not None and gop['first'] < gop['last']
+
+##################################################################################################
+def get_smart_render_command(params, times, frame_cut, command_num, temp_name,
+    is_out, track_id, threads):
+
+  # re-encodes the partial gops at both ends of the trim and stream
+  # copies every gop in between. pieces are joined by the concat demuxer.
+  index = params['keyframes']
+  start, end = frame_cut
+  gop = get_trim_gops(index, [frame_cut])[0]
+
+  piece_params = dict(params, seek=True, **get_smart_encoder_params(params))
+  basename = '%s_%02d' % (params['in'][:-4], command_num + 1)
+  ffmpeg_version = 'ffmpeg-hi' if params['hi'] else 'ffmpeg'
+
+  def get_piece_path(name):
+    return '"%s"' % (os.path.join(params['dest'], name)) if params['dest'] else name
+
+  def get_encoded_piece(name, frames):
+    times = (frames[0] / params['frame_rate'], frames[1] / params['frame_rate'])
+    return get_ffmpeg_command(piece_params, times, command_num,
+      is_out=name, frames=frames, threads=threads)['command']
+
+  pieces = list()
+  commands = list()
+
+  if start < gop['first']:
+    pieces.append('%s_head.mkv' % (basename))
+    commands.append(get_encoded_piece(pieces[-1], (start, gop['first'] - 1)))
+
+  pieces.append('%s_copy.mkv' % (basename))
+  start_time = probe_file(params['source_file']).start_time
+  seek_time = index.keyframe_time(gop['first']) - start_time + 0.5 / params['frame_rate']
+
+  # dump_extra puts the source's sps / pps in front of every copied keyframe.
+  commands.append('nice -n 15 {ffmpeg} -ss {seek:.6f} -noaccurate_seek -i {input} ' \
+    '-map 0:v:0 -c:v copy -bsf:v dump_extra=freq=keyframe -frames:v {count} ' \
+    '-avoid_negative_ts make_zero ' \
+    '-map_chapters -1 {output}'.format(
+      ffmpeg=ffmpeg_version, seek=seek_time, input=params['source_file'],
+      count=gop['last'] - gop['first'], output=get_piece_path(pieces[-1])))
+
+  if gop['last'] < end + 1:
+    pieces.append('%s_tail.mkv' % (basename))
+    commands.append(get_encoded_piece(pieces[-1], (gop['last'], end)))
+
+  list_name = '%s_pieces.txt' % (basename)
+  commands.append('printf "file \'%s\'\\n" {pieces} > {list_name}'.format(
+    pieces=' '.join(pieces), list_name=get_piece_path(list_name)))
+  commands.append('{ffmpeg} -v error -f concat -safe 0 -i {list_name} -map 0:v ' \
+    '-c copy -y {output}'.format(ffmpeg=ffmpeg_version,
+      list_name=get_piece_path(list_name), output=temp_name))
+  commands.append('rm %s %s' % (' '.join([get_piece_path(x) for x in pieces]),
+    get_piece_path(list_name)))
+
+  return {
+    'command': '( %s )' % (' && '.join(commands)),
     'temp_name': temp_name,
-    'pid': PID,
+    # only the head and tail are encoded.
+    'frames': (gop['first'] - start) + (end + 1 - gop['last']),
+    'progress_frames': end + 1 - start,
+    'frame_range': tuple(frame_cut),
+    'builder': partial(get_ffmpeg_command, params, times, command_num,
+      is_out, track_id),
   }
 
+##################################################################################################
+def can_chunk(params, times_list):
+
+  # chunks are plain video encodes of the single segment path.
+  if params.get('chunks', 0) < 2 or len(times_list) > 1 or params.get('track') is not None:
+    return False
+
+  if len(get_renditions(params)) > 1:
+    return False
+
+  return not params['vn'] and params['an'] and params['sn'] and params['tn']
+
+##################################################################################################
+def get_chunk_commands(params, times):
+
+  # each chunk starts on a source keyframe and is seeked to directly.
+  # every chunk is encoded from its own idr frame, so the chunks can be
+  # joined by the concat demuxer without re-encoding.
+  index = params['keyframes']
+  if times:
+    original = params['cuts']['original']
+    frame_cut = original['frames'][original['timestamps'].index(times)]
+  else:
+    frame_cut = (0, index.frame_count - 1)
+
+  chunk_params = dict(params, seek=True)
+  extension = params['source_file'][-3:]
+
+  commands = list()
+  for num, frames in enumerate(get_chunk_bounds(index, frame_cut, params['chunks'])):
+    chunk_times = (frames[0] / params['frame_rate'], (frames[1] + 1) / params['frame_rate'])
+    commands.append(get_ffmpeg_command(chunk_params, chunk_times, num,
+      is_out='%s_chunk_%02d.%s' % (params['in'][:-4], num + 1, extension), frames=frames))
+
+  return commands
+
 ##################################################################################################
 def get_ssh_commands(params):
   
   if params['node'] != -1:
-    curr_dir = '/'.join([x.replace('state', 'export').replace('partition1', '') 
-      for x in os.getcwd().split('/')])
-
     start_ssh = 'ssh compute-0-%s << EOF' % params['node']
-    change_dir = 'cd %s' % (curr_dir)
+    change_dir = 'cd %s' % (get_export_dir())
     exit_ssh = 'EOF\nexit'
   else:
     start_ssh = str(); change_dir = str(); exit_ssh = str()
@@ -493,6 +967,30 @@ def handle_prompt():
     print('Program interrupted by user.')
     exit(0)
 
+##################################################################################################
+def handle_jobs(params, jobs, post_commands, workers, transports=None, manifest=None):
+
+  # finished encodes are recorded in the manifest and the segment cache.
+  def on_state(job, state, exit_code=None):
+    manifest.set_state(job, state, exit_code) if manifest else None
+    store_job(job) if state == 'done' else None
+
+  if not jobs:
+    exit_codes = list()
+  elif transports:
+    exit_codes = run_sharded_jobs(jobs, transports, on_state=on_state)
+  else:
+    board = ProgressBoard(params.get('progress_json'))
+    exit_codes = run_jobs(jobs, workers, board, on_state)
+    board.close()
+  if any(exit_codes):
+    print('Skipping concatenation and cleanup, %d job(s) failed.' % (
+      len([x for x in exit_codes if x])))
+    exit(1)
+
+  for command in post_commands:
+    start_external_execution(command)
+
 ##################################################################################################
 def handle_execution(params, bash_filename):
 
@@ -509,9 +1007,9 @@ def handle_execution(params, bash_filename):
   start_external_execution(command)
 
 ##################################################################################################
-def add_external_commands(ffmpeg_obj, flag_str='bctw'):
+def add_external_commands(ffmpeg_obj, flag_str='bct'):
 
-  global concat_commands, bash_commands, wait_commands, temp_filenames
+  global concat_commands, jobs, temp_filenames, rendition_files
 
   if 'c' in flag_str:
     concat_commands.append('file %s' % (ffmpeg_obj['temp_name']))
@@ -519,13 +1017,18 @@ def add_external_commands(ffmpeg_obj, flag_str='bctw'):
   if 't' in flag_str:
     temp_filenames.append(ffmpeg_obj['temp_name'])
 
-  if 'b' in flag_str:
-    bash_commands.append(ffmpeg_obj['command'])
+  # outputs of the second and later renditions.
+  for rendition, temp_name in zip(rendition_files, ffmpeg_obj.get('temp_names', list())[1:]):
+    if 'c' in flag_str:
+      rendition['concat_commands'].append('file %s' % (temp_name))
+    if 't' in flag_str:
+      rendition['temp_filenames'].append(temp_name)
 
-  if 'w' in flag_str:
-    wait_commands.append('wait $%s' % (ffmpeg_obj['pid'])) if ffmpeg_obj['pid'] else str()
+  if 'b' in flag_str:
+    jobs.append(ffmpeg_obj)
 
 ##################################################################################################
+@traced()
 def handle_subtitle_extraction(params):
 
   if params.get('sn') or (params.get('track') is not None and
@@ -556,10 +1059,12 @@ def handle_subtitle_extraction(params):
       sub_delay = -1 * int(params['source_delay'])
       delay_subtitle(output_name, sub_delay, True)
 
-  if not params.get('subtrim'):
+  # -graph goes on with the audio and video of the job.
+  if not params.get('subtrim') and not params.get('graph'):
     print('\n'); exit(0)
 
 ##################################################################################################
+@traced()
 def handle_subtitle_trimming(params, subtitle_filename):
 
   if not len(times_list) >= 1:
@@ -568,98 +1073,55 @@ def handle_subtitle_trimming(params, subtitle_filename):
   print('#' * 50)
   print('Trimming [%s] using [%s]' % (subtitle_filename, params['in']))
 
-  subtitle_times = list()
+  # trims and events in integer milliseconds. trims keep the
+  # seconds.milliseconds reading of get_trim_times values.
+  intervals = list()
   for times in times_list:
-    start_time = str(timedelta(seconds=int(str(times[0]).split('.')[0]), 
-        milliseconds=int(str(times[0]).split('.')[1].ljust(3, '0'))))
-    
-    end_time = str(timedelta(seconds=int(str(times[1]).split('.')[0]),
-                             milliseconds=int(str(times[1]).split('.')[1].ljust(3, '0'))))
-  
-    subtitle_times.append((pysubs.misc.Time(start_time), pysubs.misc.Time(end_time)))
-
-  subs = pysubs.SSAFile()
-  subs.from_file(subtitle_filename, encoding='utf8')
+    intervals.append(tuple([int(str(x).split('.')[0]) * 1000 +
+      int(str(x).split('.')[1].ljust(3, '0')) for x in times]))
 
-  new_subs = pysubs.SSAFile()
-  new_subs.info = subs.info.copy()
-  new_subs.styles = subs.styles.copy()
-  new_subs.fonts = subs.fonts.copy()
-
-  shift = pysubs.misc.Time('00:00:00.000')
   time_per_frame = ('%.4f' % (1 / float(params['frame_rate'])))[:-1]
-  for (index, times) in enumerate(subtitle_times):
-    if index > 0:
-      # if index == len(subtitle_times) - 1:
-      shift_offset = str(float(time_per_frame) * index)
-      shift += times[0] - subtitle_times[index - 1][1] - pysubs.misc.Time(
-	'00:00:0' + shift_offset)
-      # else:
-      #   shift += times[0] - subtitle_times[index - 1][1]
-
-      shifting_time = [-x for x in shift.to_times()]
-
-    elif index == 0:
-      shift += subtitle_times[index][0] - pysubs.misc.Time('00:00:00.000')
-      shifting_time = [-x for x in shift.to_times()]
-
-    for line in subs:
-      new_line = None
-
-      if line.start >= times[0] and line.end <= times[1]:
-        new_line = line.copy()
-
-      if line.start < times[0] < line.end:
-        new_line = line.copy()
-        new_line.start = times[0]
-
-      if line.start < times[1] < line.end:
-        new_line = line.copy()
-        new_line.end = times[1]
-
-      if line.start < times[0] < times[1] < line.end:
-        new_line = line.copy()
-        new_line.start = times[0]
-        new_line.end = times[1]
-
-      if shift > pysubs.misc.Time('00:00:00.000') and new_line:        
-        new_line.shift(
-          s=shifting_time[2], ms=shifting_time[3],
-          m=shifting_time[1], h=shifting_time[0])
-      
-      if new_line:
-        new_subs.events.append(new_line)
+  # events are streamed from the file and the trimmed file replaces it.
+  write_subtitle(subtitle_filename, trim_subtitle(read_subtitle(subtitle_filename), intervals,
+    int(round(float(time_per_frame) * 1000))))
 
-  new_subs.save(subtitle_filename)
   print('Trimmed file written to: [%s]' % (subtitle_filename))
   print('#' * 50)
 
 ##################################################################################################
-def process_encoding_settings(params):
+def get_crf(params, size=None):
 
-  if not params.get('crf'):
-    
-    if params.get('rs') and len(params['rs']) == 2:
-      resulting_height = int(params['rs'][1])
-    else:
-      try:
-        resulting_height = params['dim'][1]
-      except:
-        resulting_height = 720
+  if size and len(size) == 2 and int(size[1]) > 0:
+    resulting_height = int(size[1])
+  else:
+    try:
+      resulting_height = params['dim'][1]
+    except:
+      resulting_height = 720
 
-    if resulting_height > 900 and resulting_height <= 1100:
-      crf = 23
-    elif resulting_height > 700 and resulting_height <= 900:
-      crf = 21
-    elif resulting_height > 500 and resulting_height <= 700:
-      crf = 19
-    elif resulting_height > 300 and resulting_height <= 500:
-      crf = 18
+  if resulting_height > 900 and resulting_height <= 1100:
+    crf = 23
+  elif resulting_height > 700 and resulting_height <= 900:
+    crf = 21
+  elif resulting_height > 500 and resulting_height <= 700:
+    crf = 19
+  elif resulting_height > 300 and resulting_height <= 500:
+    crf = 18
 
-    if params.get('hevc'):
-      crf -= 2
+  if params.get('hevc'):
+    crf -= 2
 
-    params['crf'] = crf
+  return crf
+
+##################################################################################################
+def process_encoding_settings(params):
+
+  # renditions get a crf for their own height unless -crf was given.
+  params['rendition_crfs'] = [params.get('crf') or get_crf(params, size)
+    for size in params.get('renditions', list())]
+
+  if not params.get('crf'):
+    params['crf'] = get_crf(params, params.get('rs'))
 
   if not params.get('aqm'):
     params['aqm'] = 3
@@ -674,6 +1136,9 @@ def handle_muxing(params, options, must_end=False):
   if params['an'] and params['sn'] and params['tn']:
     # use mkvmerge to merge video parts.
     if options.get('temp') and len(options.get('temp')) > 1:
+      for temp_filenames, output in options.get('renditions', list()):
+        merge_video(params, temp_filenames, output)
+
       merge_video(params, options.get('temp'), options.get('output'))
       exit(0)
     elif must_end:
@@ -697,26 +1162,21 @@ def handle_muxing(params, options, must_end=False):
     exit(0)
   
   elif params['sn'] and params['tn'] and not params['an']:
-    # use mkvmerge to merge video and chapters.
-    # then use ffmpeg to merge audio with output of above mux.
-    mux_result = mux_episode(params, audio=False,
-      subs=False, attachments=False)
-    muxing_with_audio(params, mux_result)
+    # use mkvmerge to merge video, audio and chapters.
+    # falls back to muxing audio with ffmpeg on timestamp errors.
+    mux_episode_with_audio(params, subs=False, attachments=False)
     exit(0)
 
   elif params['tn'] and not params['sn'] and not params['an']:
-    # use mkvmerge to merge video, subs and chapters.
-    # then use ffmpeg to merge audio with output of above mux.
-    mux_result = mux_episode(params, audio=False,
-      attachments=False)
-    muxing_with_audio(params, mux_result)
+    # use mkvmerge to merge video, audio, subs and chapters.
+    # falls back to muxing audio with ffmpeg on timestamp errors.
+    mux_episode_with_audio(params, attachments=False)
     exit(0)
   
   else:
-    # use mkvmerge to merge video, subs, attachemnts (fonts) and chapters.
-    # then use ffmpeg to merge audio with output of above mux.
-    mux_result = mux_episode(params, audio=False)
-    muxing_with_audio(params, mux_result)
+    # use mkvmerge to merge video, audio, subs, attachemnts (fonts) and chapters.
+    # falls back to muxing audio with ffmpeg on timestamp errors.
+    mux_episode_with_audio(params)
     exit(0)
 
 ##################################################################################################
@@ -785,6 +1245,9 @@ if __name__ == '__main__':
   params['in'] = os.path.basename(params['in'])
 
   params = process_encoding_settings(params)
+  if (params.get('seek') or params.get('smart')) and times_list or can_chunk(params, times_list):
+    params['keyframes'] = get_keyframe_index(params['source_file'])
+
   print('Source:', params['source_file'])
   print(params)
   print('#' * 50)
@@ -797,8 +1260,8 @@ if __name__ == '__main__':
 
   handle_subtitle_extraction(params)
 
-  bash_commands = list() 
-  wait_commands = list()
+  jobs = list()
+  post_commands = list()
   concat_commands = list()
   temp_filenames = list()
 
@@ -810,24 +1273,23 @@ if __name__ == '__main__':
     bash_filename = '%s.sh' % (params['in'][:-4])
     concat_filename = '%s.txt' % (params['in'][:-4])
 
-  if len(tracks['a']) > 1 and not params.get('track') and not params.get('an'):
-    for track_id in tracks['a']:
-      audio_options = '-hi -aac' if params.get('aac') else str()
-      audio_options += ' -abitrate %d' % (params['abitrate'])
-      python_command = 'python3 %s %s -track %d %s -nthread -x' % (
-        __file__, params['orig_in'], track_id, audio_options)
-      start_external_execution(python_command)
-
-    exit(0)
+  rendition_files = [{
+    'size': size,
+    'concat_filename': '%s_%s_%s.txt' % (params['in'][:-4], size[0], size[1]),
+    'concat_commands': list(),
+    'temp_filenames': list()
+  } for size in params['renditions'][1:]]
 
-  # elif len(tracks['s']) > 0 and params.get('track') is None and not params.get('sn'):
-  #   for track_id in tracks['s']:
-  #     python_command = 'python3 %s %s -track %d -nthread -x' % (__file__, params['in'],
-  #       track_id)
-  #     start_external_execution(python_command)
+  # concat lists of the audio tracks, written along with concat_filename.
+  track_concat_files = dict()
 
-  #   if not params.get('subtrim'):
-  #     exit(0);
+  multi_audio = len(tracks['a']) > 1 and not params.get('track') and not params.get('an') \
+    and not params.get('graph')
+  if multi_audio:
+    # every audio track is encoded from the same pass over the source.
+    params['vn'], params['sn'], params['tn'] = (True, True, True)
+    if params.get('aac'):
+      params['hi'] = True
 
   if params.get('track') is not None:
     
@@ -865,7 +1327,41 @@ if __name__ == '__main__':
   if params['dest']:
     out_name = '"%s"' % (os.path.join(params['dest'], out_name))
 
-  if params.get('subtrim'):
+  if params.get('graph'):
+    add_external_commands(get_graph_command(params, times_list, tracks), 'b')
+    # every output is written under its final name.
+    times_list = list()
+
+  elif multi_audio:
+    audio_ext = 'aac' if params.get('aac') else 'opus'
+    audio_concat = {x: list() for x in tracks['a']}
+
+    for num, times in enumerate(times_list or [list()]):
+      if params.get('trim') and params['trim'] != num + 1:
+        continue
+
+      ffmpeg = get_multi_audio_command(params, times, num, tracks['a'], len(times_list) == 1)
+      add_external_commands(ffmpeg, 'b')
+      for track_id, temp_name in ffmpeg['temp_names'].items():
+        audio_concat[track_id].append(temp_name)
+
+    if len(times_list) > 1 and not params.get('trim'):
+      for track_id, temp_names in audio_concat.items():
+        track_concat_filename = '%s_Audio_%d.txt' % (params['in'][:-4], track_id)
+        track_out_name = '%s_Audio_%d.%s' % (params['in'][:-4], track_id, audio_ext)
+        if params['dest']:
+          track_out_name = '"%s"' % (os.path.join(params['dest'], track_out_name))
+
+        track_concat_files[track_concat_filename] = ['file %s' % (x) for x in temp_names]
+        post_commands.append('ffmpeg -v fatal -f concat -i %s -map :a? -c:a copy %s' % (
+          track_concat_filename, track_out_name))
+        post_commands.extend(['rm %s & echo Deleted File: %s' % (x, x) for x in temp_names])
+        post_commands.append('rm %s' % (track_concat_filename))
+
+    # the tracks are concatenated above, not through concat_filename.
+    times_list = list()
+
+  elif params.get('subtrim'):
     fake_subtitle_tracks = params['fake_tracks']['s'] if params.get('fake_tracks') \
       and params['fake_tracks'].get('s') else list()
 
@@ -893,10 +1389,19 @@ if __name__ == '__main__':
 
     exit(0)
 
-  bash_commands.append(ssh['login']) if ssh['login'] else str()
-  bash_commands.append(ssh['chdir']) if ssh['chdir'] else str()
+  elif can_chunk(params, times_list):
+    times = times_list[0] if len(times_list) == 1 else list()
 
-  if len(times_list) == 1 or not times_list:
+    for ffmpeg in get_chunk_commands(params, times):
+      add_external_commands(ffmpeg)
+
+    # same concat the trimmed -vn segments go through.
+    post_commands.append('ffmpeg -v fatal -f concat -i %s -map :v? -c:v copy -map :a? -c:a copy ' \
+                         '-map :s? -c:s copy -map 0:t? %s' % (concat_filename, out_name))
+    post_commands.extend(['rm %s & echo Deleted File: %s' % (x, x) for x in temp_filenames])
+    post_commands.append('rm %s' % (concat_filename))
+
+  elif len(times_list) == 1 or not times_list:
     times = times_list[0] if len(times_list) == 1 else list()
 
     if params.get('track') is not None:
@@ -904,7 +1409,7 @@ if __name__ == '__main__':
     else:
       ffmpeg = get_ffmpeg_command(params, times, is_out=out_name)
     
-    add_external_commands(ffmpeg, 'bw')
+    add_external_commands(ffmpeg, 'b')
     
   else:
     for num, times in enumerate(times_list):
@@ -922,7 +1427,7 @@ if __name__ == '__main__':
         ffmpeg = get_ffmpeg_command(params, times, num)
       
       if params.get('trim') and params['trim'] == num + 1:
-        add_external_commands(ffmpeg, 'bw')
+        add_external_commands(ffmpeg, 'b')
       
       elif not params.get('trim'):
         add_external_commands(ffmpeg)
@@ -930,12 +1435,12 @@ if __name__ == '__main__':
       if out_name.endswith('ass'):
         break
 
-  bash_commands.extend(wait_commands)
-
   if params.get('mx'):
     handle_muxing(params, {
       'temp': temp_filenames,
-      'output': out_name
+      'output': out_name,
+      'renditions': [(x['temp_filenames'], get_rendition_name(out_name, x['size']))
+        for x in rendition_files]
     }, must_end=True)
 
   if len(times_list) > 1 and not params['trim'] and not out_name.endswith('ass'):
@@ -946,36 +1451,81 @@ if __name__ == '__main__':
     #   bash_commands.append('wait $PID00')
 
     if params.get('vn'):
-      bash_commands.append('ffmpeg -v fatal -f concat -i %s -map :v? -c:v copy -map :a? -c:a copy ' \
-                           '-map :s? -c:s copy -map 0:t? %s & PID%02d=$!' % (
-                            concat_filename, out_name, len(times_list) + 1))
-    
-      bash_commands.append('wait $PID%02d' % (len(times_list) + 1))
+      post_commands.append('ffmpeg -v fatal -f concat -i %s -map :v? -c:v copy -map :a? -c:a copy ' \
+                           '-map :s? -c:s copy -map 0:t? %s' % (concat_filename, out_name))
     
     if len(temp_filenames) > 1 and params.get('vn'):
-      bash_commands.extend(['rm %s & echo Deleted File: %s' % (x, x) for x in temp_filenames])
+      post_commands.extend(['rm %s & echo Deleted File: %s' % (x, x) for x in temp_filenames])
 
-  bash_commands.append('rm %s' % (concat_filename)) if len(times_list) > 1 else None
+  post_commands.append('rm %s' % (concat_filename)) if len(times_list) > 1 else None
+  if len(times_list) > 1:
+    post_commands.extend(['rm %s' % (x['concat_filename']) for x in rendition_files])
+
+  # jobs run in process on this machine. the bash script is only
+  # written for -prompt, dry runs and -node / -nohup executions.
+  run_locally = params['x'] and params['node'] == -1 and not params['nohup']
+
+  # every planned job is recorded with its state. -resume drops the
+  # ones that already finished. the manifest goes with the temp files.
+  manifest = None
+  if params['x'] or params['resume']:
+    manifest = RunManifest(get_manifest_filename(params), params)
+    if params['resume']:
+      jobs = manifest.get_pending(jobs)
+
+    # identical encodes of earlier runs are linked into place.
+    if run_locally:
+      jobs = restore_jobs(params, jobs)
+    manifest.plan(jobs, [params['source_file']])
+    post_commands.append('rm %s' % (manifest.filename))
+
+  transports = get_transports(params['nodes']) if params['nodes'] else None
+  workers = len(transports) if transports else get_worker_count(params, jobs)
+
+  bash_commands = list()
+  bash_commands.append(ssh['login']) if ssh['login'] else str()
+  bash_commands.append(ssh['chdir']) if ssh['chdir'] else str()
+  bash_commands.extend(get_bash_script(jobs, workers, escape=bool(ssh['login']),
+    transports=transports))
+  bash_commands.extend(post_commands)
   bash_commands.append('rm %s' % (bash_filename))
   bash_commands.append(ssh['logout']) if ssh['logout'] else str()
 
   if params['prompt']:
     handle_display(bash_commands, bash_filename, concat_commands, concat_filename)
+    for rendition in rendition_files:
+      handle_display(list(), bash_filename, rendition['concat_commands'],
+        rendition['concat_filename'])
+    for filename, lines in track_concat_files.items():
+      handle_display(list(), bash_filename, lines, filename)
     handle_prompt()
 
   print(os.path.abspath(os.path.curdir))
-  if len(times_list) > 1:
+  if len(times_list) > 1 or concat_commands:
     open(concat_filename, 'w').writelines([x + '\n' for x in concat_commands])
-    
-  open(bash_filename, 'w').writelines([x + '\n' for x in bash_commands])
+    for rendition in rendition_files:
+      open(rendition['concat_filename'], 'w').writelines(
+        [x + '\n' for x in rendition['concat_commands']])
+  for filename, lines in track_concat_files.items():
+    open(filename, 'w').writelines([x + '\n' for x in lines])
+
+  if run_locally:
+    handle_jobs(params, jobs, post_commands, workers, transports, manifest)
 
-  if params['x']:
-    handle_execution(params, bash_filename)
-    
     print('=' * 60)
-    print('Removed script: %s' % (bash_filename))
     print('Removed concate file: %s' % (concat_filename)) if len(times_list) > 1 else None
     print('=' * 60 + '\n')
 
   else:
-    print('Bash script created, but not executed: %s' % (bash_filename))
+    open(bash_filename, 'w').writelines([x + '\n' for x in bash_commands])
+
+    if params['x']:
+      handle_execution(params, bash_filename)
+
+      print('=' * 60)
+      print('Removed script: %s' % (bash_filename))
+      print('Removed concate file: %s' % (concat_filename)) if len(times_list) > 1 else None
+      print('=' * 60 + '\n')
+
+    else:
+      print('Bash script created, but not executed: %s' % (bash_filename))
@@ -1,68 +1,225 @@
 import os
+import re
 import sys
-import time
 import codecs
+import signal
+import tempfile
+import selectors
 import subprocess
+from collections import deque
+
+from tracing import span
+from exceptions import ExternalJobAborted
+
+CHUNK_SIZE = 64 * 1024
+# characters of recent output kept in memory (for catchphrases and failure logs).
+RING_BUFFER_SIZE = 256 * 1024
+LINE_BREAK = re.compile(r'\r\n|\r|\n')
+
+# output that dooms a job. callers pick rules by name. new rules can be
+# added here (or to the dict at runtime) without touching the matcher.
+FATAL_RULES = {
+  'conversion_failed': r'Conversion failed!',
+  'muxing_error': r'Error (?:muxing a packet|submitting a packet to the muxer)',
+  'no_space': r'No space left on device',
+  'mkvmerge_error': r'^Error: ',
+  # both words, in either order, as the old catchphrase matched them.
+  'cluster_timestamp': r'^(?=.*new cluster)(?=.*timestamp)',
+}
 
 ##################################################################################################
-def start_external_execution(external_command, catchphrase=None):
+def get_program_name(external_command):
 
-  while '  ' in external_command:
-    external_command = external_command.replace('  ', ' ')
+  # "nice -n 15 ffmpeg ..." -> ffmpeg
+  for word in external_command.split():
+    if word not in ('nice', 'nohup', '-n') and not word.isdigit():
+      return os.path.basename(word)
 
-  temp_name = 'temp_%s' % (str(time.time()).replace('.', ''))
+  return 'command'
 
-  if catchphrase:
-    tempfile = open(temp_name, 'a')
-  else:
-    tempfile = open(temp_name, 'w')
-     
-  print('_' * 50 + '\n' + '_' * 50 + '\n')
-  print('Starting external job...\n[%s]' % (external_command))
-  print('_' * 50 + '\n' + '_' * 50 + '\n')
-  
-  if catchphrase:
-    process = subprocess.Popen(external_command, shell=True,
-      stdout=tempfile, stderr=tempfile)
-    print('Dumping data [%s] to catch errors, if any.' % (temp_name))
-    process.wait()
+##################################################################################################
+def get_fatal_pattern(names):
 
-  else:
-    process = subprocess.Popen(external_command, shell=True,
-      stdout=subprocess.PIPE)
+  # every rule is a named group of a single alternation, so a line is
+  # scanned once whatever the number of rules. lastgroup names the rule.
+  return re.compile('|'.join(['(?P<%s>%s)' % (name, FATAL_RULES[name])
+    for name in names])) if names else None
+
+##################################################################################################
+class OutputCapture(object):
+
+  # keeps the most recent output of a job in a bounded ring buffer and
+  # matches every complete line against the catchphrase and the fatal
+  # rules as it arrives.
 
-    for line in iter(process.stdout.readline, b''):
-      line = line.decode('utf8')
+  def __init__(self, catchphrase=None, echo=True, size=RING_BUFFER_SIZE, fatal=None):
 
+    self.catchphrase = catchphrase
+    self.fatal = get_fatal_pattern(fatal)
+    self.aborted = None
+    self.echo = echo
+    self.size = size
+    self.chunks = deque()
+    self.buffered = 0
+    self.dropped = 0
+    self.pending = str()
+    self.caught = False
+    self.decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+
+  def feed(self, data, final=False):
+
+    text = self.decoder.decode(data, final)
+    if not text:
+      return
+
+    if self.echo:
       try:
-        sys.stdout.write(line)
-        tempfile.write(line)
+        sys.stdout.write(text)
+        sys.stdout.flush()
       except:
         pass
 
-    try:
-      os.remove(temp_name)
-    except PermissionError:
-      pass
+    self.chunks.append(text)
+    self.buffered += len(text)
+    while self.buffered > self.size and len(self.chunks) > 1:
+      chunk = self.chunks.popleft()
+      self.buffered -= len(chunk)
+      self.dropped += len(chunk)
+
+    # the last piece is an unfinished line. it is matched once complete.
+    lines = LINE_BREAK.split(self.pending + text)
+    self.pending = lines.pop()[-self.size:]
+
+    for line in lines:
+      self.match(line)
+
+  def match(self, line):
+
+    if self.catchphrase and not self.caught and \
+        all([word in line for word in self.catchphrase]):
+      self.caught = True
+
+    if self.fatal and not self.aborted:
+      found = self.fatal.search(line)
+      if found:
+        self.aborted = (found.lastgroup, line)
+
+  def close(self):
+
+    self.feed(b'', final=True)
+    self.match(self.pending)
+    self.pending = str()
+
+  def get_output(self):
+
+    return ''.join(self.chunks)
+
+##################################################################################################
+def read_output(process, capture):
+
+  # large reads from a non-blocking pipe, as soon as data is available.
+  fd = process.stdout.fileno()
+  os.set_blocking(fd, False)
+
+  with selectors.DefaultSelector() as selector:
+    selector.register(fd, selectors.EVENT_READ)
+    finished = False
 
+    # reading stops as soon as a fatal rule matches.
+    while not finished and not capture.aborted:
+      for key, events in selector.select():
+        try:
+          data = os.read(fd, CHUNK_SIZE)
+        except BlockingIOError:
+          continue
+
+        if not data:
+          finished = True
+          break
+
+        capture.feed(data)
+
+  process.stdout.close()
+  capture.close()
+
+##################################################################################################
+def kill_process_group(process):
+
+  # the shell and everything it started share the job's process group.
+  try:
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait(timeout=10)
+  except ProcessLookupError:
+    pass
+  except subprocess.TimeoutExpired:
+    os.killpg(process.pid, signal.SIGKILL)
+
+##################################################################################################
+def write_log(external_command, capture, log_filename=None):
+
+  # unique names, so that jobs running in parallel never share a log.
+  if log_filename:
+    log = open(log_filename, 'w', encoding='utf8')
+  else:
+    fd, log_filename = tempfile.mkstemp(prefix='external_', suffix='.log')
+    log = os.fdopen(fd, 'w', encoding='utf8')
+
+  with log:
+    log.write('%s\n\n' % (external_command))
+    if capture.dropped:
+      log.write('[... %d earlier characters dropped ...]\n' % (capture.dropped))
+    log.write(capture.get_output())
+
+  return log_filename
+
+##################################################################################################
+def start_external_execution(external_command, catchphrase=None, log_filename=None, fatal=None):
+
+  with span('external:%s' % (get_program_name(external_command)), command=external_command):
+    return run_external_command(external_command, catchphrase, log_filename, fatal)
+
+##################################################################################################
+def run_external_command(external_command, catchphrase=None, log_filename=None, fatal=None):
+
+  while '  ' in external_command:
+    external_command = external_command.replace('  ', ' ')
+
+  print('_' * 50 + '\n' + '_' * 50 + '\n')
+  print('Starting external job...\n[%s]' % (external_command))
   print('_' * 50 + '\n' + '_' * 50 + '\n')
 
+  # catchphrase jobs are not echoed. stderr is scanned along with stdout
+  # whenever there is something to match. jobs with fatal rules get a
+  # process group of their own, so that they can be killed as a whole.
   if catchphrase:
-    tee_content = codecs.open(
-      temp_name, 'r', 'utf8').readlines()
-
-    try:
-      os.remove(temp_name)
-    except PermissionError:
-      pass
-
-    for line in tee_content:
-      flags = list()
-      for word in catchphrase:
-        if word in line:
-          flags.append(True)
-        else:
-          flags.append(False)
-      
-      if False not in flags:
-        return True
+    print('Watching output to catch errors, if any: [%s]' % (', '.join(catchphrase)))
+
+  process = subprocess.Popen(external_command, shell=True, stdout=subprocess.PIPE,
+    stderr=subprocess.STDOUT if catchphrase or fatal else None,
+    start_new_session=bool(fatal))
+
+  capture = OutputCapture(catchphrase, echo=not catchphrase, fatal=fatal)
+  try:
+    read_output(process, capture)
+  except BaseException:
+    if fatal:
+      kill_process_group(process)
+    raise
+
+  if capture.aborted:
+    print('\nAborting external job on [%s]: %s' % (capture.aborted[0], capture.aborted[1].strip()))
+    kill_process_group(process)
+  process.wait()
+
+  print('_' * 50 + '\n' + '_' * 50 + '\n')
+
+  log = None
+  if process.returncode or log_filename or capture.aborted:
+    log = write_log(external_command, capture, log_filename)
+    print('Output of the job written: %s' % (log))
+
+  if capture.aborted:
+    raise ExternalJobAborted(capture.aborted[0], capture.aborted[1], external_command, log)
+
+  if capture.caught:
+    return True
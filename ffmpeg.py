@@ -1,5 +1,6 @@
 import os
 from external import start_external_execution
+from exceptions import ExternalJobAborted
 
 ##################################################################################################
 def redo_audio_ffmpeg(params, filename):
@@ -34,7 +35,12 @@ def redo_audio_ffmpeg(params, filename):
         output_name=output_name
       )
       
-    start_external_execution(ffmpeg_command)
+    try:
+      start_external_execution(ffmpeg_command, fatal=['muxing_error',
+        'conversion_failed', 'no_space'])
+    except ExternalJobAborted as e:
+      print('ffmpeg audio redo failed: %s' % (e))
+      exit(0)
 
     if not os.path.isfile(output_name):
       print('Expected output from ffmpeg does not exist: %s' % (output_name))
@@ -3,6 +3,9 @@ import argparse
 import subprocess
 
 from avs import source_from_avscript
+from probe import cached_probes
+from probe_cache import cached_query, disable_probe_cache
+from tracing import traced, enable_tracing
 
 #################################################################################
 class MediaInfoError(Exception):
@@ -16,27 +19,57 @@ def get_params():
 
   parser = argparse.ArgumentParser()
   parser.add_argument('path', type=str, help='path to filename or a folder.')
+  parser.add_argument('-no_probe_cache', action='store_true',
+    help='probes sources again instead of reading results from the cache.')
+  parser.add_argument('-probe_jobs', type=int,
+    help='number of sources probed concurrently.')
+  parser.add_argument('-trace', type=str, help='writes timing spans to this file as a chrome trace.')
   params = parser.parse_args().__dict__
 
+  if params['no_probe_cache']:
+    disable_probe_cache()
+  if params['trace']:
+    enable_tracing(params['trace'])
+
   return params
 
 #################################################################################
-def get_frame_rate(filename):
-  
+def get_frame_rate_command(filename):
+
   # mediainfo command.
-  info_command = r'mediainfo --Inform="Video;%FrameRate%"' 
-  info_command = '%s %s' % (info_command, filename)
+  return ['mediainfo', '--Inform=Video;%FrameRate%', filename]
+
+#################################################################################
+def parse_frame_rate(filename, result):
 
-  # put it in a subprocess and try to read the result.
   # raise error if result is unexpected.
-  result = subprocess.Popen(info_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
   try:
-    result = float(result.replace('\r', '').strip('\n'))
+    return float(result.replace('\r', '').strip('\n'))
   except:
     raise MediaInfoError('Failed to find frame rate from source file.\n'
-      '  [Source: %s][Query: %s]' % (filename, info_command))
+      '  [Source: %s][Query: %s]' % (filename, ' '.join(get_frame_rate_command(filename))))
+
+#################################################################################
+@traced()
+def get_frame_rate(filename):
   
-  return result
+  # put it in a subprocess and try to read the result.
+  result = cached_query(filename, 'mediainfo:FrameRate',
+    lambda: subprocess.run(get_frame_rate_command(filename),
+      stdout=subprocess.PIPE).stdout.decode('utf-8'))
+
+  return parse_frame_rate(filename, result)
+
+#################################################################################
+def get_frame_rates(filenames, limit=None):
+
+  # same as get_frame_rate for several sources, probed concurrently.
+  results = cached_probes([(filename, 'mediainfo:FrameRate',
+    get_frame_rate_command(filename), lambda _, output: output)
+    for filename in filenames], limit)
+
+  return [parse_frame_rate(filename, result)
+    for filename, result in zip(filenames, results)]
 
 #################################################################################
 def add_frame_rate(filename, frame_rate):
@@ -51,7 +84,7 @@ def add_frame_rate(filename, frame_rate):
   print('FrameRate added to avscript: [Avscript: %s][FrameRate: %s]' % (filename, frame_rate), end='')
   
 #################################################################################
-def handle_avscript(scriptname):
+def get_avscript_source(scriptname):
 
   # if not .avs extension then raise error.
   if not scriptname.endswith('.avs'):
@@ -63,10 +96,18 @@ def handle_avscript(scriptname):
   if not os.path.exists(os.path.join(os.path.dirname(scriptname), source)):
     raise FileNotFoundError('Source detected from script does not exist.\n' \
       '  [Source: %s][Avscript: %s]' % (source, scriptname))
+
+  return source
+
+#################################################################################
+def handle_avscript(scriptname, frame_rate=None):
+
+  source = get_avscript_source(scriptname)
   
-  # get frame rate (using mediainfo) of the source.
+  # get frame rate (using mediainfo) of the source, unless already probed.
   # finally write the frame rate to avscript (in commented form).
-  frame_rate = get_frame_rate(source)
+  if frame_rate is None:
+    frame_rate = get_frame_rate(source)
   add_frame_rate(scriptname, frame_rate)
   print('[Source: %s]' % (source))
 
@@ -88,8 +129,12 @@ def main():
     else:
       print('#' * 50)
 
-    for scriptname in avscripts:
-      handle_avscript(scriptname)
+    # probe every source up front, concurrently.
+    sources = [get_avscript_source(x) for x in avscripts]
+    frame_rates = get_frame_rates(sources, params['probe_jobs'])
+
+    for scriptname, frame_rate in zip(avscripts, frame_rates):
+      handle_avscript(scriptname, frame_rate)
 
   # if user specified a file path...
   # put that filepath to avs handler.
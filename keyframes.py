@@ -0,0 +1,234 @@
+import os
+import time
+import array
+import struct
+import bisect
+import subprocess
+
+from probe_cache import CACHE_DIR, is_enabled, get_file_identity
+from tracing import traced
+
+INDEX_DIR = os.path.join(CACHE_DIR, 'keyframes')
+INDEX_MAGIC = b'KFIX0002'
+MAX_AGE = 60 * 60 * 24 * 30
+
+##################################################################################################
+class KeyframeIndexError(Exception):
+  pass
+
+##################################################################################################
+class KeyframeIndex(object):
+
+  # keyframe frame numbers (presentation order) and their pts in the
+  # stream time base, kept as two parallel int64 arrays. closed_gop is
+  # False when frames after a keyframe (decode order) are shown before it.
+
+  def __init__(self, frames, pts, time_base, frame_count, closed_gop=True):
+
+    self.frames = frames
+    self.pts = pts
+    self.time_base = time_base
+    self.frame_count = frame_count
+    self.closed_gop = closed_gop
+
+  def keyframe_before(self, frame):
+
+    # nearest keyframe at or before <frame>. None if there is none.
+    position = bisect.bisect_right(self.frames, frame) - 1
+    return self.frames[position] if position >= 0 else None
+
+  def keyframe_after(self, frame):
+
+    # nearest keyframe at or after <frame>. frame_count if there is none.
+    position = bisect.bisect_left(self.frames, frame)
+    return self.frames[position] if position < len(self.frames) else self.frame_count
+
+  def gop_bounds(self, frame):
+
+    # [first, last) frames of the gop that contains <frame>. frames
+    # before the first keyframe count as a gop of their own.
+    start = self.keyframe_before(frame) or 0
+    return (start, self.keyframe_after(start + 1))
+
+  def is_keyframe(self, frame):
+
+    position = bisect.bisect_left(self.frames, frame)
+    return position < len(self.frames) and self.frames[position] == frame
+
+  def keyframe_time(self, frame):
+
+    # presentation time (seconds, container timeline) of a keyframe.
+    position = bisect.bisect_left(self.frames, frame)
+    if position >= len(self.frames) or self.frames[position] != frame:
+      raise KeyframeIndexError('Frame %d is not a keyframe.' % (frame))
+
+    return self.pts[position] * self.time_base[0] / self.time_base[1]
+
+  def save(self, filename):
+
+    temp_name = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_name, 'wb') as f:
+      f.write(INDEX_MAGIC)
+      f.write(struct.pack('<qqqqq', self.time_base[0], self.time_base[1],
+        self.frame_count, len(self.frames), int(self.closed_gop)))
+      self.frames.tofile(f)
+      self.pts.tofile(f)
+
+    os.replace(temp_name, filename)
+
+  @classmethod
+  def load(cls, filename):
+
+    with open(filename, 'rb') as f:
+      if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+        raise KeyframeIndexError('Not a keyframe index: %s' % (filename))
+
+      numerator, denominator, frame_count, count, closed_gop = struct.unpack('<qqqqq',
+        f.read(40))
+      frames = array.array('q'); frames.fromfile(f, count)
+      pts = array.array('q'); pts.fromfile(f, count)
+
+    return cls(frames, pts, (numerator, denominator), frame_count, bool(closed_gop))
+
+##################################################################################################
+def get_scan_command(filename):
+
+  # packet level scan. nothing is decoded.
+  return ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+    '-show_entries', 'stream=time_base:packet=pts,flags',
+    '-of', 'csv=p=0', filename]
+
+##################################################################################################
+def scan_keyframes(filename):
+
+  process = subprocess.Popen(get_scan_command(filename),
+    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+  packets = array.array('q')
+  keyframe_pts = set()
+  time_base = None
+  last_keyframe = None
+  closed_gop = True
+
+  # packets arrive in decode order: "pts,flags" lines,
+  # followed by the stream's "num/den" time base.
+  for line in process.stdout:
+    line = line.decode('utf-8').strip()
+    if not line:
+      continue
+
+    if '/' in line and ',' not in line:
+      time_base = tuple(int(x) for x in line.split('/'))
+      continue
+
+    pts, flags = line.split(',')[:2]
+    if pts == 'N/A':
+      continue
+
+    packets.append(int(pts))
+    if 'K' in flags:
+      keyframe_pts.add(int(pts))
+      last_keyframe = int(pts)
+    elif last_keyframe is not None and int(pts) < last_keyframe:
+      # leading frames reference the previous gop: open gop.
+      closed_gop = False
+
+  process.wait()
+
+  if not packets or not time_base:
+    raise KeyframeIndexError('Failed to scan packets of: %s' % (filename))
+
+  # frame numbers follow presentation order.
+  ordered = sorted(packets)
+  frames = array.array('q'); pts = array.array('q')
+
+  for frame, packet_pts in enumerate(ordered):
+    if packet_pts in keyframe_pts:
+      frames.append(frame)
+      pts.append(packet_pts)
+
+  return KeyframeIndex(frames, pts, time_base, len(ordered), closed_gop)
+
+##################################################################################################
+def evict_indexes(identity_prefix=None):
+
+  # stale indexes of a modified file share its device-inode prefix.
+  if not os.path.isdir(INDEX_DIR):
+    return
+
+  for name in os.listdir(INDEX_DIR):
+    path = os.path.join(INDEX_DIR, name)
+    try:
+      if (identity_prefix and name.startswith(identity_prefix)) or \
+          os.path.getmtime(path) < time.time() - MAX_AGE:
+        os.remove(path)
+    except OSError:
+      pass
+
+##################################################################################################
+@traced()
+def get_keyframe_index(filename):
+
+  if not os.path.isfile(filename):
+    raise FileNotFoundError('File does not exist: %s' % (filename))
+
+  if not is_enabled():
+    return scan_keyframes(filename)
+
+  device, inode, size, mtime_ns = get_file_identity(filename)
+  index_name = os.path.join(INDEX_DIR, '%d-%d-%d-%d.idx' % (
+    device, inode, size, mtime_ns))
+
+  if os.path.isfile(index_name):
+    try:
+      os.utime(index_name)
+      return KeyframeIndex.load(index_name)
+    except (OSError, KeyframeIndexError, EOFError):
+      pass
+
+  print('Building keyframe index: %s' % (filename))
+  index = scan_keyframes(filename)
+
+  try:
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    evict_indexes('%d-%d-' % (device, inode))
+    index.save(index_name)
+  except OSError as error:
+    print('Could not store keyframe index: %s' % (error))
+
+  return index
+
+##################################################################################################
+def get_trim_gops(index, trims):
+
+  # for each (start, end) trim from avs.get_trim_times: the keyframe the
+  # trim starts decoding from, the first keyframe inside the trim and the
+  # last keyframe at or before its exclusive end. keyframes before the
+  # trim are None when the source has none that early.
+  gops = list()
+  for start, end in trims:
+    gops.append({
+      'seek': index.keyframe_before(start),
+      'first': index.keyframe_after(start),
+      'last': index.keyframe_before(end + 1)
+    })
+
+  return gops
+
+##################################################################################################
+def get_chunk_bounds(index, frame_cut, chunks):
+
+  # splits an inclusive (start, end) frame range into at most <chunks>
+  # ranges of similar length. every chunk after the first starts on a
+  # source keyframe, so each one can be seeked to and encoded on its own.
+  start, end = frame_cut
+  length = end + 1 - start
+
+  cuts = [start]
+  for number in range(1, chunks):
+    keyframe = index.keyframe_before(start + length * number // chunks)
+    if keyframe is not None and keyframe > cuts[-1]:
+      cuts.append(keyframe)
+
+  cuts.append(end + 1)
+  return [(cuts[i], cuts[i + 1] - 1) for i in range(len(cuts) - 1)]
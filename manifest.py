@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from probe import probe_file, ProbeError
+
+# an output is valid when its duration is within this many seconds (or
+# this fraction of the expected duration, if larger) of the planned one.
+DURATION_TOLERANCE = 1.0
+DURATION_TOLERANCE_RATIO = 0.02
+
+##################################################################################################
+def get_manifest_filename(params):
+
+  name = '%s_manifest.json' % (os.path.splitext(params['in'])[0])
+  if params.get('dest'):
+    name = os.path.join(params['dest'], name)
+
+  return name
+
+##################################################################################################
+def get_job_outputs(job):
+
+  # temp names are quoted when a destination folder is used.
+  outputs = job.get('temp_names') or [job['temp_name']]
+  if isinstance(outputs, dict):
+    outputs = list(outputs.values())
+
+  return [x.strip('"') for x in outputs]
+
+##################################################################################################
+def get_job_hash(job, inputs):
+
+  # the command built before threads are assigned, so that the hash
+  # only changes with the parameters of the encode.
+  digest = hashlib.sha1(job['command'].encode('utf-8'))
+  for filename in inputs:
+    stat = os.stat(filename) if os.path.isfile(filename) else None
+    digest.update(('%s:%s:%s' % (filename, stat.st_size if stat else None,
+      stat.st_mtime_ns if stat else None)).encode('utf-8'))
+
+  return digest.hexdigest()
+
+##################################################################################################
+def check_output(filename, expected_duration=None):
+
+  # container level check: ffprobe has to read the file and report a
+  # duration close to the planned one. killed encodes fail either way.
+  if not os.path.isfile(filename) or not os.path.getsize(filename):
+    return False
+
+  try:
+    duration = probe_file(filename).duration
+  except (ProbeError, OSError):
+    return False
+
+  if not duration:
+    return False
+
+  if expected_duration:
+    tolerance = max(DURATION_TOLERANCE, expected_duration * DURATION_TOLERANCE_RATIO)
+    return abs(duration - expected_duration) <= tolerance
+
+  return True
+
+##################################################################################################
+class RunManifest(object):
+
+  # planned jobs of a run and their state, kept next to the outputs so
+  # that -resume can tell finished segments from missing or failed ones.
+  # states: planned, running, done, failed.
+
+  def __init__(self, filename, params):
+
+    self.filename = filename
+    self.params = params
+    self.lock = threading.Lock()
+    self.entries = dict()
+
+    if os.path.isfile(filename):
+      try:
+        self.entries = json.load(open(filename, 'r')).get('jobs', dict())
+      except ValueError:
+        print('Ignoring unreadable manifest: %s' % (filename))
+
+  def get_expected_duration(self, job):
+
+    if not job.get('progress_frames') or not self.params.get('frame_rate'):
+      return None
+
+    return job['progress_frames'] / self.params['frame_rate']
+
+  def is_complete(self, job):
+
+    # a job is skipped when it was planned with the same parameters,
+    # was not recorded as failed and every output passes the check.
+    entry = self.entries.get(job['temp_name'])
+    if not entry or entry['state'] == 'failed':
+      return False
+
+    if entry['hash'] != get_job_hash(job, entry['inputs']):
+      return False
+
+    expected_duration = self.get_expected_duration(job)
+    return all([check_output(x, expected_duration) for x in get_job_outputs(job)])
+
+  def get_pending(self, jobs):
+
+    pending = list()
+    for job in jobs:
+      if self.is_complete(job):
+        print('Resuming: skipping finished job: %s' % (job['temp_name']))
+      else:
+        pending.append(job)
+
+    print('Resuming: %d of %d job(s) left to run.' % (len(pending), len(jobs)))
+    return pending
+
+  def plan(self, jobs, inputs):
+
+    with self.lock:
+      for job in jobs:
+        entry = self.entries.get(job['temp_name'])
+        job_hash = get_job_hash(job, inputs)
+
+        # finished entries of skipped jobs are kept as they are.
+        if entry and entry['hash'] == job_hash and entry['state'] == 'done':
+          continue
+
+        self.entries[job['temp_name']] = {
+          'command': job['command'],
+          'inputs': inputs,
+          'hash': job_hash,
+          'outputs': get_job_outputs(job),
+          'frames': job.get('progress_frames'),
+          'state': 'planned',
+          'exit_code': None,
+          'updated': time.time()
+        }
+
+      self.save()
+
+  def set_state(self, job, state, exit_code=None):
+
+    with self.lock:
+      entry = self.entries.get(job['temp_name'])
+      if not entry:
+        return
+
+      entry.update({'state': state, 'exit_code': exit_code, 'updated': time.time()})
+      self.save()
+
+  def save(self):
+
+    # written to a temporary name first, a reboot never leaves half a manifest.
+    temp_filename = '%s.tmp' % (self.filename)
+    with open(temp_filename, 'w') as f:
+      json.dump({'input': self.params['in'], 'jobs': self.entries}, f, indent=2, sort_keys=True)
+    os.replace(temp_filename, self.filename)
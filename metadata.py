@@ -1,10 +1,23 @@
 import os
 import subprocess
 
+from probe import (
+  MediaInfo, probe_file, cached_probes,
+  get_probe_command, parse_probe_output, format_timestamp)
+from probe_cache import cached_query
+from tracing import traced
+
+@traced()
 def get_ffprobe_metadata(params, filename):
   
   metadata = dict()
 
+  if not filename.endswith('.xml'):
+    # single ffprobe pass over the source. every stream type, codec,
+    # dimension and channel count comes from the same json document.
+    media = probe_file(os.path.join(params['input_dir'], os.path.basename(filename)))
+    return media.as_metadata()
+
   curr_dir = os.path.abspath(os.path.curdir)
   os.chdir(params['input_dir'])
 
@@ -99,53 +112,15 @@ def get_ffprobe_metadata(params, filename):
 
     return metadata
 
-  tracks = dict()
-  for stream_type in ['v', 'a', 's']:
-    probe_command = 'ffprobe -v fatal -of flat=s=_ -select_streams %s -show_entries ' \
-      'stream=index %s' % (stream_type, os.path.basename(filename))
-    result = subprocess.Popen(probe_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-    tracks[stream_type] = [int(x.replace('\r', '').split('=')[1]) for x in result.split('\n') if x]
-
-  codecs = dict()
-  for stream_type in ['v', 'a', 's']:
-    probe_command = 'ffprobe -v fatal -of flat=s=_ -select_streams %s -show_entries ' \
-      'stream=codec_name %s' % (stream_type, os.path.basename(filename))
-    result = subprocess.Popen(probe_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-    codecs[stream_type] = [x.replace('\r', '').split('=')[1].strip('"')
-      for x in result.split('\n') if x]
-
-  metadata['tracks'] = tracks
-  metadata['codecs'] = codecs
-
-  probe_command = 'ffprobe -v fatal -of flat=s=_ -select_streams v -show_entries ' \
-    'stream=width,height %s' % (os.path.basename(filename))
-
-  result = subprocess.Popen(probe_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-  metadata['dim'] = [int(x.replace('\r', '').split('=')[1]) for x in result.split('\n') if x]
-
-  probe_command = 'ffprobe -v fatal -of flat=s=_ -select_streams a -show_entries ' \
-    'stream=channels %s' % (os.path.basename(filename))
-
-  result = subprocess.Popen(probe_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-  metadata['audio_channels'] = [int(x.replace('\r', '').split('=')[1]) for x in result.split('\n') if x]
-
-  os.chdir(curr_dir)
-  return metadata
-
 def get_duration(filename):
   
   if not os.path.isfile(filename):
     print('File does not exist: %s' % (filename))
     return None
   
-  info_command = r'mediainfo --Inform="Video;%Duration%"' 
-  info_command = '%s %s' % (info_command, filename)
-
-  result = subprocess.Popen(info_command, shell=True,
-    stdout=subprocess.PIPE).stdout.read() \
-    .decode('utf-8')
-  
-  return int(result.split('.')[0])
+  # video duration in milliseconds.
+  duration = probe_file(filename).duration
+  return int(duration * 1000) if duration is not None else None
 
 def get_codec_name(params, filename):
 
@@ -153,21 +128,9 @@ def get_codec_name(params, filename):
     print('File does not exist: %s' % (filename))
     return None
   
-  for stream_type in ['v']:
-
-    probe_command = 'ffprobe -v fatal -of flat=s=_ -select_streams %s ' \
-      '-show_entries stream=codec_name %s' % (
-        stream_type, os.path.basename(filename))
-
-    result = subprocess.Popen(probe_command, shell=True,
-      stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-    result = [x.replace('\r', str()) for x in result.split('\n') if x]
-
-    for item in result:
-      if 'codec_name=' in item:
-        codec_name = item.split('codec_name=')[1].strip() \
-          .replace('"', str())
-        return codec_name
+  codecs = probe_file(filename).codecs['v']
+  if codecs:
+    return codecs[0]
 
 def get_lang_and_title(params, filename):
 
@@ -175,80 +138,96 @@ def get_lang_and_title(params, filename):
     print('File does not exist: %s' % (filename))
     return None
   
-  params['languages'] = dict()
-  params['titles'] = dict()
-  for stream_type in ['v', 'a', 's']:
-    params['languages'][stream_type] = list()
-    params['titles'][stream_type] = list()
-
-    probe_command = 'ffprobe -v fatal -of flat=s=_ -select_streams %s -show_entries ' \
-      'stream_tags=title -show_entries stream_tags=language %s' % (
-        stream_type, filename)
-
-    result = subprocess.Popen(probe_command, shell=True,
-      stdout=subprocess.PIPE).stdout.read().decode('utf-8')
-    result = [x.replace('\r', str()) for x in result.split('\n') if x]
-
-    for item in result:
-      if 'title=' in item:
-        title = item.split('title=')[1].strip().replace('"', str())
-        params['titles'][stream_type].append(title)
-      
-      if 'language=' in item:
-        lang = item.split('language=')[1].strip().replace('"', str())
-        params['languages'][stream_type].append(lang)
+  media = probe_file(filename)
+  params['languages'] = media.languages
+  params['titles'] = media.titles
 
-def get_metadata(params, filename):
+def get_uid_command(filename):
 
-  if not os.path.isfile(filename):
-    print('File does not exist: %s' % (filename))
-    exit(0)
+  # matroska segment uid is not exposed by ffprobe.
+  return ['mediainfo', '--Inform=General;%UniqueID%', filename]
 
-  info_command = r'mediainfo --Inform="General;%Duration/String3%\n%UniqueID%"' 
-  info_command = '%s %s' % (info_command, filename)
+def parse_uid_output(filename, output):
 
-  result = subprocess.Popen(info_command, shell=True, stdout=subprocess.PIPE).stdout.read().decode('utf-8')
+  return output.replace('\r', '').strip()
 
-  video_info_command = r'mediainfo --Inform="Video;%Duration/String3%\n%Delay%"' 
-  video_info_command = '%s %s' % (video_info_command, filename)
+def get_segment_uid(filename):
 
-  video_result = subprocess.Popen(video_info_command, shell=True,
-    stdout=subprocess.PIPE).stdout.read().decode(
-    'utf-8').replace('\r', '').strip()
+  result = cached_query(filename, 'mediainfo:UniqueID',
+    lambda: parse_uid_output(filename, subprocess.run(get_uid_command(filename),
+      stdout=subprocess.PIPE).stdout.decode('utf-8')))
 
-  metadata = dict()
-  suid = None
+  return result if result.isdigit() else None
+
+def get_settings_command(filename):
+
+  # the settings x264 / x265 write into the stream, e.g. "ref=4 / bframes=3".
+  return ['mediainfo', '--Inform=Video;%Encoded_Library_Settings%', filename]
+
+def get_encoder_settings(filename):
 
-  if len(result.split('\n')) >=2:
-    filtered_result = [x.replace('\r', '') for x in result.split('\n') if len(x) >= 1]
-    if len(filtered_result) >= 2:
-      metadata['duration'], suid = [x.replace('\r', '') for x in result.split('\n') if len(x) >= 1]
-    else:
-      metadata['duration'] = [x.replace('\r', '') for x in result.split('\n') if len(x) >= 1]
+  result = cached_query(filename, 'mediainfo:Encoded_Library_Settings',
+    lambda: subprocess.run(get_settings_command(filename),
+      stdout=subprocess.PIPE).stdout.decode('utf-8').strip())
+
+  # key=value pairs. x265 flags are bare (b-pyramid) or negated (no-b-pyramid).
+  settings = dict()
+  for item in result.split(' / ') if result else list():
+    item = item.strip()
+    if '=' in item:
+      key, value = item.split('=', 1)
+      settings[key.strip()] = value.strip()
+    elif item.startswith('no-'):
+      settings[item[3:]] = '0'
+    elif item:
+      settings[item] = '1'
+
+  return settings
+
+def build_metadata(filename, media, suid):
+
+  metadata = dict()
 
-  if suid:
+  if suid and suid.isdigit():
     metadata['suid'] = "{0:X}".format(int(suid))
 
     while len(metadata['suid']) < 32:
       metadata['suid'] = '0%s' % (metadata['suid'])
 
   metadata['name'] = filename
-  metadata['duration'] = video_result.split('\n')[0]
+  metadata['duration'] = format_timestamp(media.duration) \
+    if media.duration is not None else str()
 
-  if len(video_result.split('\n')) > 1:
-    metadata['delay'] = video_result.split('\n')[1]
+  if media.delay is not None:
+    metadata['delay'] = str(media.delay)
                                                                                   
   return metadata
-#  metadata = dict()
-#  metadata['duration'], suid = [x.replace('\r', '') for x in result.split('\n') if len(x) > 0]
-#  metadata['suid'] = "{0:X}".format(int(suid))
 
-#  while len(metadata['suid']) < 32:
-#    metadata['suid'] = '0%s' % (metadata['suid'])
+def get_metadata(params, filename):
 
-#  metadata['name'] = filename
+  if not os.path.isfile(filename):
+    print('File does not exist: %s' % (filename))
+    exit(0)
 
-#  metadata['duration'] = video_result.split('\n')[0]
-#  metadata['delay'] = video_result.split('\n')[1]
-  
-#  return metadata
+  return build_metadata(filename, probe_file(filename),
+    get_segment_uid(filename))
+
+def get_metadata_many(params, filenames):
+
+  # same as get_metadata for several files. ffprobe and mediainfo
+  # queries of every file run concurrently through the probe pool.
+  for filename in filenames:
+    if not os.path.isfile(filename):
+      print('File does not exist: %s' % (filename))
+      exit(0)
+
+  requests = [(filename, 'ffprobe', get_probe_command(filename),
+    parse_probe_output) for filename in filenames]
+  requests.extend([(filename, 'mediainfo:UniqueID', get_uid_command(filename),
+    parse_uid_output) for filename in filenames])
+
+  results = cached_probes(requests, params.get('probe_jobs'))
+  probe_data, suids = results[:len(filenames)], results[len(filenames):]
+
+  return [build_metadata(filename, MediaInfo(filename, data), suid)
+    for filename, data, suid in zip(filenames, probe_data, suids)]
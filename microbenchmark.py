@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from statistics import median
+from contextlib import redirect_stdout
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'microbenchmark.json')
+SCALES = ['small', 'medium', 'large']
+
+# timings below this many seconds are too noisy to be compared.
+MIN_COMPARED_TIME = 0.001
+
+# lines of plain python work timed along with every case. times are compared
+# relative to it, so a baseline taken on another (or a busier) machine applies.
+REFERENCE_LINES = 20000
+
+# fixture sizes of every case, from small to very large.
+CASES = {
+  'subtitle_trimming': {
+    'small': {'events': 2000, 'trims': 4},
+    'medium': {'events': 20000, 'trims': 12},
+    'large': {'events': 60000, 'trims': 40},
+  },
+  'chapter_content': {
+    'small': {'trims': 4},
+    'medium': {'trims': 12},
+    'large': {'trims': 40},
+  },
+  'ffprobe_xml': {
+    'small': {'bytes': 50 * 1024},
+    'medium': {'bytes': 500 * 1024},
+    'large': {'bytes': 5 * 1024 * 1024},
+  },
+  'custom_commands': {
+    'small': {'commands': 100, 'trims': 4},
+    'medium': {'commands': 5000, 'trims': 12},
+    'large': {'commands': 50000, 'trims': 40},
+  },
+  'delay_subtitle': {
+    'small': {'events': 2000},
+    'medium': {'events': 20000},
+    'large': {'events': 60000},
+  },
+  'subtitle_retiming': {
+    'small': {'events': 2000},
+    'medium': {'events': 20000},
+    'large': {'events': 60000},
+  },
+}
+
+##################################################################################################
+def get_params():
+
+  parser = argparse.ArgumentParser(description='times the pure python paths on generated ' \
+    'fixtures and compares time per operation and peak memory against a baseline.')
+  parser.add_argument('-cases', type=str, help='comma separated cases to run (default: all). ' \
+    'available: %s.' % (', '.join(sorted(CASES))))
+  parser.add_argument('-scales', type=str, default=','.join(SCALES),
+    help='comma separated fixture scales to run.')
+  parser.add_argument('-repeat', type=int, default=5, help='timed operations per case. ' \
+    'medians are reported.')
+  parser.add_argument('-baseline', type=str, default=BASELINE, help='baseline json file.')
+  parser.add_argument('-save_baseline', action='store_true',
+    help='writes the results to the baseline file instead of comparing against it.')
+  parser.add_argument('-threshold', type=float, default=0.5,
+    help='relative increase of time (relative to the reference work) reported as a ' \
+    'regression. shared machines vary by more than the reference can make up for.')
+  parser.add_argument('-memory_threshold', type=float, default=0.25,
+    help='relative increase of peak memory reported as a regression.')
+
+  params = vars(parser.parse_args())
+  params['cases'] = [x.strip() for x in params['cases'].split(',')] \
+    if params['cases'] else sorted(CASES)
+  params['scales'] = [x.strip() for x in params['scales'].split(',')]
+
+  unknown = (set(params['cases']) - set(CASES)) | (set(params['scales']) - set(SCALES))
+  if unknown:
+    print('Unknown cases / scales: %s' % (', '.join(sorted(unknown)))); exit(0)
+
+  return params
+
+##################################################################################################
+def format_ass_time(milliseconds):
+
+  return '%d:%02d:%02d.%02d' % (milliseconds // 3600000, milliseconds // 60000 % 60,
+    milliseconds // 1000 % 60, milliseconds // 10 % 100)
+
+##################################################################################################
+def write_karaoke_subtitle(filename, events):
+
+  # dense karaoke: a new syllable line every 24 ms, each shown for 2 seconds.
+  lines = [
+    '[Script Info]', 'ScriptType: v4.00+', 'PlayResX: 1280', 'PlayResY: 720', '',
+    '[V4+ Styles]',
+    'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, ' \
+      'BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, ' \
+      'BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding',
+    'Style: Karaoke,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,' \
+      '0,0,1,2,1,8,20,20,20,1',
+    '', '[Events]',
+    'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text',
+  ]
+
+  for num in range(events):
+    start = num * 24
+    lines.append('Dialogue: %d,%s,%s,Karaoke,,0,0,0,fx,{\\pos(640,%d)\\k20}ka{\\k15}ra' \
+      '{\\k30}o{\\k25}ke %d' % (num % 4, format_ass_time(start), format_ass_time(start + 2000),
+        60 + 40 * (num % 4), num))
+
+  open(filename, 'w', encoding='utf8').write('\n'.join(lines) + '\n')
+  return events * 24 / 1000
+
+##################################################################################################
+def get_times_list(duration, trims):
+
+  # evenly spaced trims with a short dropped part between every two of them.
+  step = duration / trims
+  return [(float('%.3f' % (num * step)), float('%.3f' % ((num + 1) * step - 1)))
+    for num in range(trims)]
+
+##################################################################################################
+def write_mediainfo_xml(filename, size):
+
+  # audio and text tracks are added until the document reaches the size.
+  def get_track(kind, track_id, fields):
+    lines = ['<track type="%s">' % (kind), '<ID>%d</ID>' % (track_id)]
+    lines.extend(['<%s>%s</%s>' % (key, value, key) for key, value in fields])
+    lines.extend(['<Extra_%02d>%d</Extra_%02d>' % (num, num * 1000, num) for num in range(20)])
+    lines.append('</track>')
+    return lines
+
+  lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<MediaInfo>', '<media ref="source.mkv">',
+    '<track type="General">', '<Format>Matroska</Format>', '<Duration>1440.000</Duration>',
+    '</track>']
+  lines.extend(get_track('Video', 1, [('Format', 'AVC'), ('Width', 1920), ('Height', 1080),
+    ('FrameRate', '23.976'), ('BitDepth', 8)]))
+
+  track_id = 2
+  written = sum([len(x) + 1 for x in lines])
+  while written < size:
+    tracks = get_track('Audio', track_id, [('Format', 'FLAC'), ('Channels', 2),
+      ('SamplingRate', 48000), ('Language', 'ja')])
+    tracks.extend(get_track('Text', track_id + 1, [('Format', 'ASS'), ('Language', 'en')]))
+    written += sum([len(x) + 1 for x in tracks])
+    lines.extend(tracks)
+    track_id += 2
+
+  lines.extend(['</media>', '</MediaInfo>'])
+  open(filename, 'w').write('\n'.join(lines) + '\n')
+
+##################################################################################################
+def write_avscript(filename, commands, trims):
+
+  frames = [(num * 1000, num * 1000 + 899) for num in range(trims)]
+  lines = ['FFVideoSource("source.mkv")', '++'.join(['Trim(%d,%d)' % x for x in frames])]
+
+  for num in range(commands):
+    lines.append('# comment %d' % (num))
+    lines.append('##>option_%d=value_%d' % (num, num))
+
+  lines.append('##!!' + ','.join(['>Part %d[%d:%d]<' % (num + 1, start, end)
+    for num, (start, end) in enumerate(frames)]))
+  open(filename, 'w').write('\n'.join(lines) + '\n')
+
+##################################################################################################
+def setup_subtitle_trimming(sizes, directory):
+
+  import execute_ffmpeg
+
+  source = os.path.join(directory, 'source.ass')
+  subtitle = os.path.join(directory, 'trimmed.ass')
+  duration = write_karaoke_subtitle(source, sizes['events'])
+  params = {'in': 'source.avs', 'frame_rate': 24000 / 1001}
+
+  # the subtitle is trimmed in place, so every operation gets a fresh copy.
+  def reset():
+    shutil.copyfile(source, subtitle)
+    execute_ffmpeg.times_list = get_times_list(duration, sizes['trims'])
+
+  return (lambda: execute_ffmpeg.handle_subtitle_trimming(params, subtitle)), reset
+
+##################################################################################################
+def setup_chapter_content(sizes, directory):
+
+  from chapters import get_chapter_content
+
+  times_list = get_times_list(sizes['trims'] * 90.0, sizes['trims'])
+  params = {'op': None, 'ed': None, 'frame_rate': 24000 / 1001,
+    'config': {'names': ['part %d' % (num + 1) for num in range(sizes['trims'])]}}
+
+  return (lambda: get_chapter_content(list(times_list), dict(params))), None
+
+##################################################################################################
+def setup_ffprobe_xml(sizes, directory):
+
+  from metadata import get_ffprobe_metadata
+
+  write_mediainfo_xml(os.path.join(directory, 'source.xml'), sizes['bytes'])
+  params = {'input_dir': directory}
+  current_dir = os.path.abspath(os.path.curdir)
+
+  # get_ffprobe_metadata changes into the input directory.
+  def reset():
+    os.chdir(current_dir)
+
+  return (lambda: get_ffprobe_metadata(params, 'source.xml')), reset
+
+##################################################################################################
+def setup_custom_commands(sizes, directory):
+
+  from avs import get_custom_commands
+
+  filename = os.path.join(directory, 'source.avs')
+  write_avscript(filename, sizes['commands'], sizes['trims'])
+
+  return (lambda: get_custom_commands(filename)), None
+
+##################################################################################################
+def setup_delay_subtitle(sizes, directory):
+
+  from subedit import delay_subtitle
+
+  filename = os.path.join(directory, 'source.ass')
+  write_karaoke_subtitle(filename, sizes['events'])
+
+  return (lambda: delay_subtitle(filename, 1500)), None
+
+##################################################################################################
+def setup_subtitle_retiming(sizes, directory):
+
+  from subtiming import SubtitleTimings
+
+  source = os.path.join(directory, 'source.ass')
+  filename = os.path.join(directory, 'retimed.ass')
+  write_karaoke_subtitle(source, sizes['events'])
+
+  # delay, pal speed up and snap in one load and save.
+  def retime():
+    timings = SubtitleTimings(source)
+    timings.shift(1500)
+    timings.rescale((24000 / 1001) / 25)
+    timings.snap(25)
+    timings.save(filename)
+
+  return retime, None
+
+##################################################################################################
+def run_reference():
+
+  # formatting, splitting and dict updates, as in the cases above.
+  counts = dict()
+  for num in range(REFERENCE_LINES):
+    fields = ('Dialogue: %d,%s,Karaoke,fx' % (num % 4, format_ass_time(num * 24))).split(',')
+    counts[fields[1]] = counts.get(fields[1], 0) + len(fields)
+
+  return counts
+
+##################################################################################################
+def measure(operation, reset, repeat):
+
+  # the reference work runs right before every operation, so that both
+  # see the same load on the machine.
+  timings = list()
+  reference_timings = list()
+  with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+    for run in range(repeat):
+      if reset:
+        reset()
+      started = time.perf_counter()
+      run_reference()
+      reference_timings.append(time.perf_counter() - started)
+
+      started = time.perf_counter()
+      operation()
+      timings.append(time.perf_counter() - started)
+
+    # peak memory is measured on a separate run, tracemalloc slows everything down.
+    if reset:
+      reset()
+    tracemalloc.start()
+    try:
+      operation()
+      peak = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+
+  return {'time': median(timings), 'min_time': min(timings), 'peak_memory': peak,
+    'reference_time': min(reference_timings)}
+
+##################################################################################################
+def run_cases(params):
+
+  results = dict()
+  print('%-18s %-7s %12s %12s %14s' % ('case', 'scale', 'time (ms)', 'min (ms)', 'peak (KiB)'))
+
+  for case in params['cases']:
+    setup = globals()['setup_%s' % (case)]
+
+    for scale in params['scales']:
+      directory = tempfile.mkdtemp(prefix='ffmpeg_wrapper_micro_')
+      current_dir = os.path.abspath(os.path.curdir)
+      name = '%s:%s' % (case, scale)
+
+      try:
+        operation, reset = setup(CASES[case][scale], directory)
+        results[name] = measure(operation, reset, params['repeat'])
+        print('%-18s %-7s %12.2f %12.2f %14.1f' % (case, scale, results[name]['time'] * 1000,
+          results[name]['min_time'] * 1000, results[name]['peak_memory'] / 1024))
+
+      except ImportError as e:
+        results[name] = {'skipped': str(e)}
+        print('%-18s %-7s skipped: %s' % (case, scale, e))
+
+      finally:
+        os.chdir(current_dir)
+        shutil.rmtree(directory)
+
+  return results
+
+##################################################################################################
+def compare_results(results, baseline, threshold, memory_threshold):
+
+  regressions = list()
+  print('\n%-26s %-6s %12s %12s %8s' % ('case', 'metric', 'baseline', 'current', 'change'))
+
+  for name, result in sorted(results.items()):
+    previous = baseline.get(name)
+    if not previous or 'skipped' in previous or 'skipped' in result:
+      continue
+
+    # the fastest run is the least disturbed by the rest of the machine.
+    # it is scaled by how much slower the reference work ran than in the baseline.
+    speed = 1.0
+    if previous.get('reference_time'):
+      speed = result['reference_time'] / previous['reference_time']
+
+    for key in ['min_time', 'peak_memory']:
+      if key == 'min_time' and previous[key] < MIN_COMPARED_TIME or not previous[key]:
+        continue
+
+      change = result[key] / (previous[key] * (speed if key == 'min_time' else 1)) - 1
+      regressed = change > (threshold if key == 'min_time' else memory_threshold)
+      if regressed:
+        regressions.append((name, key, change))
+
+      scale = 1000 if key == 'min_time' else 1 / 1024
+      print('%-26s %-6s %12.2f %12.2f %+7.1f%%%s' % (name, 'ms' if key == 'min_time' else 'KiB',
+        previous[key] * scale, result[key] * scale, change * 100,
+        ' <- regression' if regressed else str()))
+
+  return regressions
+
+##################################################################################################
+if __name__ == '__main__':
+
+  params = get_params()
+  results = run_cases(params)
+
+  if params['save_baseline']:
+    # cases that were not run (or skipped) keep their previous baseline.
+    baseline = json.load(open(params['baseline'], 'r')) \
+      if os.path.isfile(params['baseline']) else dict()
+    baseline.update({name: result for name, result in results.items()
+      if 'skipped' not in result})
+
+    with open(params['baseline'], 'w') as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+    print('Baseline written: %s' % (params['baseline']))
+
+  elif not os.path.isfile(params['baseline']):
+    print('No baseline to compare against: %s' % (params['baseline']))
+
+  else:
+    regressions = compare_results(results, json.load(open(params['baseline'], 'r')),
+      params['threshold'], params['memory_threshold'])
+
+    if regressions:
+      print('\n%d regression(s) beyond %.0f%% (time) / %.0f%% (memory) against %s' % (
+        len(regressions), params['threshold'] * 100, params['memory_threshold'] * 100,
+        params['baseline']))
+      sys.exit(1)
@@ -2,9 +2,11 @@ import os
 from avs import parse_avs_chapters
 from ffmpeg import redo_audio_ffmpeg
 from external import start_external_execution
+from exceptions import ExternalJobAborted
+from tracing import traced
 
 from metadata import (
-  get_metadata, get_lang_and_title,
+  get_metadata_many, get_lang_and_title,
   get_codec_name, get_duration)
 
 ATTACHMENT_SIZE_RANGE = 40
@@ -76,11 +78,13 @@ def attach_fonts(target_file, attach_path):
   
   return mmg_command
 
+@traced()
 def merge_video(params, temp_filenames, output_filename):
   mmg_command = 'mkvmerge -o %s ' % (output_filename)
+  temp_metadata = get_metadata_many(params, temp_filenames)
+
   for index, temp_filename in enumerate(temp_filenames):
-    temp_video_delay = get_metadata(
-      params, temp_filename).get('delay')
+    temp_video_delay = temp_metadata[index].get('delay')
 
     if index > 0:
       mmg_command += '--sync 0:%s + %s ' % (temp_video_delay,
@@ -98,6 +102,7 @@ def merge_video(params, temp_filenames, output_filename):
         print('Deleting: %s' % (os.path.abspath(filename)))
         os.remove(filename)
 
+@traced()
 def redo_mkvmerge(params, filename):
   if not os.path.isfile(filename):
     print('File does not exist: %s' % (filename))
@@ -110,7 +115,11 @@ def redo_mkvmerge(params, filename):
     "'(' '{input_name}' ')'".format(
       output_name=output_name, input_name=filename)
   
-  start_external_execution(mmg_command)
+  try:
+    start_external_execution(mmg_command, fatal=['mkvmerge_error', 'no_space'])
+  except ExternalJobAborted as e:
+    print('mkvmerge (repass) failed: %s' % (e))
+    exit(0)
 
   if not os.path.isfile(output_name):
     print('Expected output from ffmpeg does not exist: %s' % (output_name))
@@ -238,6 +247,7 @@ def get_sub_files(params):
 
   return sub_files
 
+@traced()
 def add_chapter_file(filename, chapter_file):
 
   if not os.path.isfile(filename):
@@ -253,7 +263,7 @@ def add_chapter_file(filename, chapter_file):
   
   start_external_execution(command)
 
-def mux_episode(params, audio=True, subs=True, attachments=True):
+def get_episode_mux(params, audio=True, subs=True, attachments=True):
 
   basename = os.path.splitext(params['in'])[0]
   video_file = '%s_Encoded.mkv' % (basename)
@@ -359,7 +369,7 @@ def mux_episode(params, audio=True, subs=True, attachments=True):
       try:
         audio_lang = params['languages']['a'][audio_number]
       except:
-        audio_lang = 'eng'
+        audio_lang = 'jpn'
 
       try:
         audio_channels = params['audio_channels'][audio_number]
@@ -435,31 +445,81 @@ def mux_episode(params, audio=True, subs=True, attachments=True):
       chapter_command=chapter_command,
       source_command=source_command
     )
-  
-  start_external_execution(command)
 
-  if os.path.isfile(output_file):
-    real_size = os.path.getsize(output_file)
+  return {
+    'command': command,
+    'output': output_file,
+    'attached_chapter': chapter_file,
+    'size_range': (min_size, max_size)
+  }
 
-    if min_size < real_size < max_size:
-      pass
-    else:
-      print('Output filesize from mkvmerge is not within expectations.\n' \
-        'Expectations: [%.2f MB - %.2f MB]\n' \
-        '%s: (%.2f MB)\n' % (min_size / 1024 / 1024,
-          max_size / 1024 / 1024, output_file,
-          real_size / 1024 / 1024))
-      exit(0)
-  else:
+def check_mux_output(output_file, size_range):
+
+  min_size, max_size = size_range
+
+  if not os.path.isfile(output_file):
     print('Expected output file from mkvmerge does not ' \
       'exist: %s\n' % (output_file))
+    return False
+
+  real_size = os.path.getsize(output_file)
+  if not min_size < real_size < max_size:
+    print('Output filesize from mkvmerge is not within expectations.\n' \
+      'Expectations: [%.2f MB - %.2f MB]\n' \
+      '%s: (%.2f MB)\n' % (min_size / 1024 / 1024,
+        max_size / 1024 / 1024, output_file,
+        real_size / 1024 / 1024))
+    return False
+
+  return True
+
+@traced()
+def mux_episode(params, audio=True, subs=True, attachments=True):
+
+  mux = get_episode_mux(params, audio, subs, attachments)
+  try:
+    start_external_execution(mux['command'], fatal=['mkvmerge_error', 'no_space'])
+  except ExternalJobAborted as e:
+    print('mkvmerge failed: %s' % (e))
+    exit(0)
+
+  if not check_mux_output(mux['output'], mux['size_range']):
     exit(0)
 
   return {
-    'output': output_file,
-    'attached_chapter': chapter_file
+    'output': mux['output'],
+    'attached_chapter': mux['attached_chapter']
   }
 
+@traced()
+def mux_episode_with_audio(params, subs=True, attachments=True):
+
+  # video, audio, subs, attachments and chapters in one mkvmerge pass.
+  # the old three pass route (mkvmerge, ffmpeg audio mux, mkvmerge again
+  # and mkvpropedit for chapters) is only taken when mkvmerge warns
+  # about timestamps or the output size is off.
+  mux = get_episode_mux(params, True, subs, attachments)
+  try:
+    caught = start_external_execution(mux['command'],
+      catchphrase=['Warning', 'timestamp'], fatal=['mkvmerge_error', 'no_space'])
+  except ExternalJobAborted:
+    caught = True
+
+  if not caught and check_mux_output(mux['output'], mux['size_range']):
+    print('Final Output: %s (%.2f MB)\n' % (mux['output'],
+      os.path.getsize(mux['output']) / 1024 / 1024))
+    return mux['output']
+
+  print('Single pass mux failed, falling back to ffmpeg audio muxing.')
+  if os.path.isfile(mux['output']):
+    os.remove(mux['output'])
+
+  mux_result = mux_episode(params, audio=False, subs=subs, attachments=attachments)
+  muxing_with_audio(params, mux_result)
+
+  return mux_result['output']
+
+@traced()
 def ffmpeg_audio_mux(params, mux_to_filename):
   
   get_lang_and_title(params, params['source_file'])
@@ -468,6 +528,7 @@ def ffmpeg_audio_mux(params, mux_to_filename):
 
   audio_input = list()
   audio_mapping = list()
+  audio_command = list()
   is_default = True
   has_defaulted = False
   map_index = 0
@@ -514,6 +575,15 @@ def ffmpeg_audio_mux(params, mux_to_filename):
         audio_lang=audio_lang, audio_name=audio_name,
         is_default='default' if is_default else 'none')
 
+    # the same track for mkvmerge, used when the ffmpeg mux is aborted.
+    audio_command.append(
+      "--default-track 0:{is_default} " \
+      "--language 0:{audio_lang} --track-name '0:{audio_name}' " \
+      "'(' '{filename}' ')'".format(
+        is_default='yes' if is_default else 'no',
+        audio_lang=audio_lang, audio_name=audio_name,
+        filename=filename))
+
     audio_mapping.append(a_map)
     audio_input.append(a_input)
     expected_size += os.path.getsize(filename)
@@ -535,20 +605,25 @@ def ffmpeg_audio_mux(params, mux_to_filename):
       audio_mapping=audio_mapping, output=output_file
     )
   
-  caught = start_external_execution(command,
-    catchphrase=['new cluster', 'timestamp'])
-
-  if caught:
-    os.remove(mux_to_filename)
-    print('Renaming: [%s] -> [%s]' % (output_file, mux_to_filename))
-    os.rename(output_file, mux_to_filename)
-    output_file = mux_to_filename
-
-    return {
-      'error': True,
-      'id': 'cluster-error',
-      'output': output_file
-    }
+  # a doomed mux is stopped as soon as ffmpeg reports it and
+  # the audio is muxed with mkvmerge instead.
+  try:
+    start_external_execution(command, fatal=['cluster_timestamp',
+      'muxing_error', 'conversion_failed', 'no_space'])
+  except ExternalJobAborted as e:
+    print('ffmpeg audio mux aborted [%s], muxing audio with mkvmerge instead.' % (e.rule))
+    if os.path.isfile(output_file):
+      os.remove(output_file)
+
+    command = "mkvmerge --output '{output}' '(' '{video_file}' ')' {audio_command}".format(
+      output=output_file, video_file=mux_to_filename,
+      audio_command=' '.join(audio_command))
+
+    try:
+      start_external_execution(command, fatal=['mkvmerge_error', 'no_space'])
+    except ExternalJobAborted as e:
+      print('mkvmerge audio mux failed: %s' % (e))
+      exit(0)
 
   real_size = os.path.getsize(output_file)
   min_size = expected_size - (1024 * 1024 * 0.25)
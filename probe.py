@@ -0,0 +1,235 @@
+import os
+import json
+import asyncio
+import subprocess
+
+from probe_cache import cached_query, get_cached, set_cached
+from tracing import traced
+
+STREAM_TYPES = {'video': 'v', 'audio': 'a', 'subtitle': 's'}
+PROBE_JOBS = min(8, os.cpu_count() or 1)
+
+##################################################################################################
+class ProbeError(Exception):
+  pass
+
+##################################################################################################
+def get_probe_command(filename):
+
+  return ['ffprobe', '-v', 'fatal', '-show_streams', '-show_format',
+    '-show_chapters', '-of', 'json', filename]
+
+##################################################################################################
+def parse_timestamp(value):
+
+  # parses both plain seconds (0.067000) and matroska
+  # statistics tags (00:23:40.045000000) into seconds.
+  if value is None:
+    return None
+
+  value = str(value).strip()
+  try:
+    return float(value)
+  except ValueError:
+    pass
+
+  try:
+    seconds = 0.0
+    for part in value.split(':'):
+      seconds = seconds * 60 + float(part)
+  except ValueError:
+    return None
+
+  return seconds
+
+##################################################################################################
+def format_timestamp(seconds):
+
+  milliseconds = int(round(seconds * 1000))
+  hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+  minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+  seconds, milliseconds = divmod(milliseconds, 1000)
+
+  return '%02d:%02d:%02d.%03d' % (hours, minutes, seconds, milliseconds)
+
+##################################################################################################
+def get_tag(tags, name):
+
+  # matroska statistics tags may carry a language suffix (DURATION-eng).
+  name = name.lower()
+  for key, value in tags.items():
+    if key.lower() == name or key.lower().startswith(name + '-'):
+      return value
+
+##################################################################################################
+class MediaInfo(object):
+
+  def __init__(self, filename, probe_data):
+
+    self.filename = filename
+    self.streams = probe_data.get('streams', list())
+    self.format = probe_data.get('format', dict())
+    self.chapters = probe_data.get('chapters', list())
+
+    self.tracks = {'v': list(), 'a': list(), 's': list()}
+    self.codecs = {'v': list(), 'a': list(), 's': list()}
+    self.languages = {'v': list(), 'a': list(), 's': list()}
+    self.titles = {'v': list(), 'a': list(), 's': list()}
+    self.dim = list()
+    self.audio_channels = list()
+
+    for stream in self.streams:
+      stream_type = STREAM_TYPES.get(stream.get('codec_type'))
+      if not stream_type:
+        continue
+
+      tags = stream.get('tags', dict())
+      self.tracks[stream_type].append(int(stream['index']))
+      self.codecs[stream_type].append(stream.get('codec_name', str()))
+
+      if get_tag(tags, 'title') is not None:
+        self.titles[stream_type].append(get_tag(tags, 'title'))
+      if get_tag(tags, 'language') is not None:
+        self.languages[stream_type].append(get_tag(tags, 'language'))
+
+      if stream_type == 'v':
+        self.dim.extend([int(stream['width']), int(stream['height'])])
+      elif stream_type == 'a':
+        self.audio_channels.append(int(stream['channels']))
+
+  @property
+  def video(self):
+
+    for stream in self.streams:
+      if stream.get('codec_type') == 'video':
+        return stream
+
+  @property
+  def start_time(self):
+
+    return parse_timestamp(self.format.get('start_time')) or 0.0
+
+  @property
+  def duration(self):
+
+    # video duration in seconds. mirrors mediainfo's Video;%Duration%
+    # and falls back to the container duration.
+    video = self.video or dict()
+    duration = parse_timestamp(video.get('duration'))
+
+    if duration is None:
+      duration = parse_timestamp(get_tag(video.get('tags', dict()), 'DURATION'))
+    if duration is None:
+      duration = parse_timestamp(self.format.get('duration'))
+
+    return duration
+
+  @property
+  def delay(self):
+
+    # timestamp of the first video frame in milliseconds, as mediainfo's
+    # Video;%Delay% reports it. not relative to the container start.
+    video = self.video
+    if not video or parse_timestamp(video.get('start_time')) is None:
+      return None
+
+    return int(round(parse_timestamp(video['start_time']) * 1000))
+
+  @property
+  def frame_rate(self):
+
+    video = self.video
+    if not video:
+      return None
+
+    tags = video.get('tags', dict())
+    frames = get_tag(tags, 'NUMBER_OF_FRAMES')
+    duration = parse_timestamp(get_tag(tags, 'DURATION'))
+
+    if frames and duration:
+      temp = str(int(frames) / duration)
+      return float(temp[: 1 + temp.find('.') + 3])
+
+    numerator, denominator = video.get('r_frame_rate', '0/1').split('/')
+    if not int(denominator):
+      return None
+
+    return round(int(numerator) / int(denominator), 3)
+
+  def as_metadata(self):
+
+    return {
+      'tracks': self.tracks,
+      'codecs': self.codecs,
+      'audio_channels': self.audio_channels,
+      'dim': self.dim
+    }
+
+##################################################################################################
+def parse_probe_output(filename, output):
+
+  try:
+    return json.loads(output)
+  except ValueError:
+    raise ProbeError('ffprobe returned unexpected output for: %s' % (filename))
+
+##################################################################################################
+def run_ffprobe(filename):
+
+  result = subprocess.run(get_probe_command(filename),
+    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+  return parse_probe_output(filename, result.stdout.decode('utf-8'))
+
+##################################################################################################
+@traced()
+def probe_file(filename):
+
+  if not os.path.isfile(filename):
+    raise FileNotFoundError('File does not exist: %s' % (filename))
+
+  probe_data = cached_query(filename, 'ffprobe',
+    lambda: run_ffprobe(filename))
+
+  return MediaInfo(filename, probe_data)
+
+##################################################################################################
+async def run_probe_commands_async(commands, limit):
+
+  semaphore = asyncio.Semaphore(limit)
+
+  async def run_probe_command(command):
+    async with semaphore:
+      process = await asyncio.create_subprocess_exec(*command,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+      stdout, _ = await process.communicate()
+      return stdout.decode('utf-8')
+
+  # gather keeps the results in the order of the given commands.
+  return await asyncio.gather(*[run_probe_command(x) for x in commands])
+
+##################################################################################################
+def run_probe_commands(commands, limit=None):
+
+  if not commands:
+    return list()
+
+  return asyncio.run(run_probe_commands_async(commands, limit or PROBE_JOBS))
+
+##################################################################################################
+@traced()
+def cached_probes(requests, limit=None):
+
+  # requests are (filename, query, command, parser) tuples. cached results
+  # are reused and only the misses are spawned, at most <limit> at a time.
+  results = [get_cached(filename, query) for filename, query, _, _ in requests]
+  misses = [index for index, result in enumerate(results) if result is None]
+
+  outputs = run_probe_commands([requests[index][2] for index in misses], limit)
+
+  for index, output in zip(misses, outputs):
+    filename, query, _, parser = requests[index]
+    results[index] = parser(filename, output)
+    set_cached(filename, query, results[index])
+
+  return results
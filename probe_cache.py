@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+  os.path.join(os.path.expanduser('~'), '.cache')), 'ffmpeg_wrapper')
+CACHE_FILE = os.path.join(CACHE_DIR, 'probe.sqlite')
+DISABLE_ENV = 'FFMPEG_WRAPPER_NO_PROBE_CACHE'
+
+MAX_AGE = 60 * 60 * 24 * 30
+MAX_SIZE = 1024 * 1024 * 128
+
+connection = None
+
+##################################################################################################
+def disable_probe_cache():
+
+  # exported so that child processes launched by the wrapper
+  # (per track encodes, benchmarks) skip the cache as well.
+  global connection
+  os.environ[DISABLE_ENV] = '1'
+  connection = None
+
+##################################################################################################
+def is_enabled():
+
+  return not os.environ.get(DISABLE_ENV)
+
+##################################################################################################
+def get_connection():
+
+  global connection
+
+  if connection is None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    connection = sqlite3.connect(CACHE_FILE, timeout=30)
+    connection.execute('CREATE TABLE IF NOT EXISTS probes (' \
+      'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, ' \
+      'query TEXT, value TEXT, path TEXT, accessed REAL, ' \
+      'PRIMARY KEY (device, inode, query))')
+    connection.execute('CREATE INDEX IF NOT EXISTS probes_accessed ON probes (accessed)')
+    connection.commit()
+
+  return connection
+
+##################################################################################################
+def get_file_identity(filename):
+
+  stat = os.stat(filename)
+  return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+##################################################################################################
+def evict(db):
+
+  # drop entries that were not used for a while, then trim
+  # least recently used entries until the cache fits MAX_SIZE.
+  db.execute('DELETE FROM probes WHERE accessed < ?', (time.time() - MAX_AGE,))
+
+  total = db.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM probes').fetchone()[0]
+  while total > MAX_SIZE:
+    rows = db.execute('SELECT device, inode, query, LENGTH(value) FROM probes ' \
+      'ORDER BY accessed LIMIT 64').fetchall()
+    if not rows:
+      break
+
+    for device, inode, query, size in rows:
+      if total <= MAX_SIZE:
+        break
+      db.execute('DELETE FROM probes WHERE device = ? AND inode = ? AND query = ?',
+        (device, inode, query))
+      total -= size
+
+##################################################################################################
+def get_cached(filename, query):
+
+  if not is_enabled() or not os.path.isfile(filename):
+    return None
+
+  try:
+    device, inode, size, mtime_ns = get_file_identity(filename)
+    db = get_connection()
+
+    row = db.execute('SELECT size, mtime_ns, value FROM probes WHERE ' \
+      'device = ? AND inode = ? AND query = ?', (device, inode, query)).fetchone()
+    if not row:
+      return None
+
+    # file was replaced or modified since it was probed.
+    if (row[0], row[1]) != (size, mtime_ns):
+      db.execute('DELETE FROM probes WHERE device = ? AND inode = ?', (device, inode))
+      db.commit()
+      return None
+
+    db.execute('UPDATE probes SET accessed = ? WHERE device = ? AND inode = ? AND query = ?',
+      (time.time(), device, inode, query))
+    db.commit()
+    return json.loads(row[2])
+
+  except (OSError, sqlite3.Error) as error:
+    print('Probe cache is unavailable, continuing without it: %s' % (error))
+    disable_probe_cache()
+    return None
+
+##################################################################################################
+def is_cacheable(value):
+
+  # empty output ('', {}) is what a failed probe returns. it is not
+  # kept, so that the next run probes the file again.
+  if isinstance(value, str):
+    return bool(value.strip())
+
+  return bool(value)
+
+##################################################################################################
+def set_cached(filename, query, value):
+
+  if not is_enabled() or not os.path.isfile(filename) or not is_cacheable(value):
+    return
+
+  try:
+    device, inode, size, mtime_ns = get_file_identity(filename)
+    db = get_connection()
+
+    db.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+      (device, inode, size, mtime_ns, query, json.dumps(value),
+        os.path.abspath(filename), time.time()))
+    evict(db)
+    db.commit()
+
+  except (OSError, sqlite3.Error) as error:
+    print('Probe cache is unavailable, continuing without it: %s' % (error))
+    disable_probe_cache()
+
+##################################################################################################
+def cached_query(filename, query, compute):
+
+  value = get_cached(filename, query)
+  if value is None:
+    value = compute()
+    set_cached(filename, query, value)
+
+  return value
@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import time
+import threading
+from datetime import timedelta
+
+# first word of every ffmpeg invocation inside a (possibly chained) command.
+FFMPEG_PATTERN = re.compile(r'(^|[\s(;&|])(ffmpeg(?:-hi)?)(?=\s)')
+REFRESH_INTERVAL = 2.0
+
+##################################################################################################
+def add_progress_options(command, fd):
+
+  # ffmpeg writes key=value blocks to the inherited fd instead of its
+  # stats line. chained pieces (smart render) share the same fd.
+  return FFMPEG_PATTERN.sub(r'\1\2 -progress pipe:%d -nostats' % (fd), command)
+
+##################################################################################################
+def parse_out_time(value):
+
+  # out_time=00:01:02.345678
+  try:
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+  except ValueError:
+    return None
+
+##################################################################################################
+def format_eta(seconds):
+
+  if seconds is None:
+    return '--:--:--'
+
+  return str(timedelta(seconds=int(seconds)))
+
+##################################################################################################
+class ProgressBoard(object):
+
+  # latest sample of every running job. prints an aggregate status line
+  # at most every REFRESH_INTERVAL seconds and appends every sample to
+  # an optional json lines feed.
+
+  def __init__(self, json_filename=None):
+
+    self.samples = dict()
+    self.lock = threading.Lock()
+    self.printed = 0
+    self.feed = open(json_filename, 'a') if json_filename else None
+
+  def update(self, sample):
+
+    with self.lock:
+      self.samples[sample['job']] = sample
+
+      if self.feed:
+        self.feed.write(json.dumps(sample) + '\n')
+        self.feed.flush()
+
+      if sample['done'] or time.time() - self.printed >= REFRESH_INTERVAL:
+        self.printed = time.time()
+        print(self.get_status())
+
+  def get_status(self):
+
+    parts = list()
+    remaining = 0
+    fps = 0.0
+
+    for sample in self.samples.values():
+      if sample['done']:
+        continue
+
+      if sample['total_frames']:
+        parts.append('%s %d/%d (%.1f%%) %.1f fps eta %s' % (sample['job'],
+          sample['frame'], sample['total_frames'],
+          100.0 * sample['frame'] / sample['total_frames'],
+          sample['fps'] or 0, format_eta(sample['eta'])))
+        remaining += max(sample['total_frames'] - sample['frame'], 0)
+        fps += sample['fps'] or 0
+      else:
+        parts.append('%s %s' % (sample['job'], format_eta(sample['out_time'])))
+
+    total_eta = remaining / fps if fps else None
+    parts.append('running: %d, eta %s' % (len(parts), format_eta(total_eta)))
+
+    return '[progress] ' + ' | '.join(parts)
+
+  def close(self):
+
+    if self.feed:
+      self.feed.close()
+
+##################################################################################################
+def read_progress(fd, job, board, total_frames=None):
+
+  # ffmpeg restarts frame counting for every piece of a chained command.
+  # frames of finished pieces are carried over. the last piece of a smart
+  # render joins the others and counts every frame again, so the count
+  # stops at total_frames.
+  values = dict()
+  carried = 0
+  started = time.time()
+  failed = False
+
+  with os.fdopen(fd, 'r', errors='replace') as stream:
+    for line in stream:
+      if failed or '=' not in line:
+        continue
+
+      try:
+        key, value = line.strip().split('=', 1)
+        values[key] = value
+        if key != 'progress':
+          continue
+
+        frame = carried + int(values.get('frame', 0) or 0)
+        if total_frames:
+          frame = min(frame, total_frames)
+        try:
+          fps = float(values.get('fps', 0))
+        except ValueError:
+          fps = 0.0
+
+        # fps is averaged over a piece. elapsed time covers the whole job.
+        if not fps and frame:
+          fps = frame / max(time.time() - started, 0.001)
+
+        eta = None
+        if total_frames and fps:
+          eta = max(total_frames - frame, 0) / fps
+
+        board.update({
+          'job': job['temp_name'],
+          'time': time.time(),
+          'frame': frame,
+          'total_frames': total_frames,
+          'fps': fps,
+          'speed': values.get('speed', 'N/A').rstrip('x'),
+          'bitrate': values.get('bitrate', 'N/A'),
+          'out_time': parse_out_time(values.get('out_time', str())),
+          'eta': eta,
+          'done': False
+        })
+
+        if value == 'end':
+          carried = frame
+          values = dict()
+      except Exception as error:
+        # the pipe is drained to the end regardless. ffmpeg would block
+        # writing progress to a full pipe and the job would never finish.
+        print('Progress of %s is no longer reported: %s' % (job['temp_name'], error))
+        failed = True
+
+  # the job leaves the status line either way.
+  try:
+    board.update({
+      'job': job['temp_name'], 'time': time.time(), 'frame': carried,
+      'total_frames': total_frames, 'fps': None, 'speed': None, 'bitrate': None,
+      'out_time': None, 'eta': 0, 'done': True
+    })
+  except Exception as error:
+    print('Progress of %s is no longer reported: %s' % (job['temp_name'], error))
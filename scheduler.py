@@ -0,0 +1,301 @@
+import os
+import heapq
+import shlex
+import time
+import threading
+import subprocess
+from collections import deque
+
+from progress import add_progress_options, read_progress
+from manifest import get_job_outputs
+from tracing import span
+from concurrent.futures import ThreadPoolExecutor
+
+# x264 / x265 at slow presets stop scaling at around this many threads.
+CORES_PER_ENCODE = 8
+
+##################################################################################################
+def get_available_cpus():
+
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+##################################################################################################
+def get_worker_count(params, jobs):
+
+  if params.get('nthread'):
+    return 1
+
+  if params.get('workers'):
+    workers = params['workers']
+  else:
+    workers = get_available_cpus() // CORES_PER_ENCODE
+
+  return max(1, min(workers, len(jobs)))
+
+##################################################################################################
+def get_lookahead_threads(threads):
+
+  # x264's own default: one lookahead thread per six frame threads.
+  return max(1, threads // 6)
+
+##################################################################################################
+class ThreadAllocator(object):
+
+  # splits the host's cores across the jobs that run at the same time,
+  # in proportion to their frame counts. cores held by a job go back to
+  # the pool once it finishes and are handed to the jobs started after.
+
+  def __init__(self, jobs, workers, cpus=None):
+
+    self.cpus = cpus or get_available_cpus()
+    self.workers = workers
+    self.pending = order_jobs(jobs)
+    self.held = dict()
+    self.lock = threading.Lock()
+
+  def acquire(self, job):
+
+    with self.lock:
+      self.pending = [x for x in self.pending if x is not job]
+      free = self.cpus - sum(self.held.values())
+
+      # jobs that will start alongside this one share the free cores.
+      starting = self.pending[:max(self.workers - len(self.held) - 1, 0)] + [job]
+      frames = sum(x.get('frames') or 1 for x in starting)
+
+      threads = max(1, int(free * (job.get('frames') or 1) / frames))
+      self.held[id(job)] = threads
+      return threads
+
+  def release(self, job):
+
+    with self.lock:
+      self.held.pop(id(job), None)
+
+##################################################################################################
+def plan_threads(jobs, workers, cpus=None):
+
+  # static budgets for bash scripts. replays the pool's schedule with frame
+  # counts as durations, so budgets match what run_jobs would hand out.
+  allocator = ThreadAllocator(jobs, workers, cpus)
+  budgets = dict()
+  running = list()
+  clock = 0
+
+  for job in order_jobs(jobs):
+    if len(running) >= workers:
+      clock, _, finished = heapq.heappop(running)
+      allocator.release(finished)
+
+    budgets[id(job)] = allocator.acquire(job)
+    heapq.heappush(running, (clock + (job.get('frames') or 1), id(job), job))
+
+  return budgets
+
+##################################################################################################
+def build_job(job, threads):
+
+  # jobs with a builder are rebuilt with the thread budget
+  # they were given. others keep their prebuilt command.
+  if job.get('builder') and threads:
+    command = job['builder'](threads=threads)['command']
+  else:
+    command = job['command']
+
+  # outputs may be hard links into the segment cache. ffmpeg would
+  # overwrite them in place and truncate the cached copy along with them.
+  return 'rm -f %s && %s' % (' '.join([shlex.quote(x) for x in get_job_outputs(job)]), command)
+
+##################################################################################################
+def order_jobs(jobs):
+
+  # longest first, so the job that sets the critical path starts
+  # right away. jobs of unknown length keep their relative order.
+  return sorted(jobs, key=lambda job: -(job.get('frames') or 0))
+
+##################################################################################################
+def run_job(job, allocator=None, board=None, on_state=None):
+
+  # on_state(job, state, exit_code) is told when the job starts and ends.
+  threads = allocator.acquire(job) if allocator else None
+  on_state(job, 'running') if on_state else None
+  print('Starting job: %s%s' % (job['temp_name'],
+    ' [threads: %d]' % (threads) if threads else str()))
+  started = time.time()
+  # a job that raises is reported as failed before the error is passed on.
+  exit_code = -1
+
+  try:
+    command = build_job(job, threads)
+    with span('encode:%s' % (job['temp_name']), command=command, threads=threads):
+      exit_code = start_job(job, command, board)
+  finally:
+    allocator.release(job) if allocator else None
+    on_state(job, 'failed' if exit_code else 'done', exit_code) if on_state else None
+
+  print('Finished job: %s [exit code: %d][%.1fs]' % (
+    job['temp_name'], exit_code, time.time() - started))
+
+  return exit_code
+
+##################################################################################################
+def start_job(job, command, board=None):
+
+  if board:
+    # ffmpeg reports progress on a pipe that only this job inherits.
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen(add_progress_options(command, write_fd),
+      shell=True, pass_fds=(write_fd,))
+    os.close(write_fd)
+
+    reader = threading.Thread(target=read_progress, args=(read_fd, job, board,
+      job.get('progress_frames')))
+    reader.start()
+    process.wait()
+    reader.join()
+  else:
+    process = subprocess.Popen(command, shell=True)
+    process.wait()
+
+  return process.returncode
+
+##################################################################################################
+def run_jobs(jobs, workers, board=None, on_state=None):
+
+  print('_' * 50 + '\n' + '_' * 50 + '\n')
+  print('Running %d job(s) with %d worker(s).' % (len(jobs), workers))
+  print('_' * 50 + '\n' + '_' * 50 + '\n')
+
+  allocator = ThreadAllocator(jobs, workers)
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = {id(job): executor.submit(run_job, job, allocator, board, on_state)
+      for job in order_jobs(jobs)}
+
+  # exit codes are reported in the order the jobs were given. a job that
+  # raised counts as failed, the others keep their exit codes.
+  exit_codes = list()
+  for job in jobs:
+    try:
+      exit_codes.append(futures[id(job)].result())
+    except Exception as error:
+      print('Job raised an error: %s: %s' % (job['temp_name'], error))
+      exit_codes.append(-1)
+
+  for job, exit_code in zip(jobs, exit_codes):
+    if exit_code:
+      print('Job failed [exit code: %d]: %s' % (exit_code, job['temp_name']))
+
+  return exit_codes
+
+##################################################################################################
+def run_shard(transport, job, stats, on_state=None):
+
+  print('Starting shard on %s: %s' % (transport.name, job['temp_name']))
+  on_state(job, 'running') if on_state else None
+  started = time.time()
+
+  with span('shard:%s' % (job['temp_name']), node=transport.name):
+    exit_code = transport.run(build_job(job, transport.threads))
+  stats['elapsed'] += time.time() - started
+
+  # every output has to be visible here for the concat and mux that follow.
+  missing = [x for x in get_job_outputs(job) if not os.path.isfile(x)]
+  if not exit_code and missing:
+    print('Output missing after shard on %s: %s' % (transport.name, ', '.join(missing)))
+    exit_code = -1
+
+  stats['succeeded' if not exit_code else 'failed'] += 1
+  on_state(job, 'failed' if exit_code else 'done', exit_code) if on_state else None
+  print('Finished shard on %s: %s [exit code: %d][%.1fs]' % (
+    transport.name, job['temp_name'], exit_code, time.time() - started))
+
+  return exit_code
+
+##################################################################################################
+def run_sharded_jobs(jobs, transports, retries=1, on_state=None):
+
+  # every transport pulls the next longest job from a shared queue.
+  # a node that fails a shard stops pulling, and the shard is queued
+  # again for the remaining nodes up to <retries> times.
+  queue = deque(order_jobs(jobs))
+  attempts = dict()
+  exit_codes = dict()
+  stats = {x.name: {'succeeded': 0, 'failed': 0, 'elapsed': 0.0} for x in transports}
+  condition = threading.Condition()
+  running = [0]
+
+  def work(transport):
+    while True:
+      with condition:
+        # idle nodes wait while a running shard may still be queued again.
+        while not queue and running[0]:
+          condition.wait()
+        if not queue:
+          return
+
+        job = queue.popleft()
+        attempts[id(job)] = attempts.get(id(job), 0) + 1
+        running[0] += 1
+
+      exit_code = run_shard(transport, job, stats[transport.name], on_state)
+
+      with condition:
+        running[0] -= 1
+        exit_codes[id(job)] = exit_code
+        if exit_code and attempts[id(job)] <= retries:
+          queue.append(job)
+        condition.notify_all()
+
+        if exit_code:
+          return
+
+  print('_' * 50 + '\n' + '_' * 50 + '\n')
+  print('Sharding %d job(s) over %d node(s).' % (len(jobs), len(transports)))
+  print('_' * 50 + '\n' + '_' * 50 + '\n')
+
+  with ThreadPoolExecutor(max_workers=len(transports)) as executor:
+    list(executor.map(work, transports))
+
+  for name, node_stats in stats.items():
+    print('%s: %d succeeded, %d failed [%.1fs]' % (name, node_stats['succeeded'],
+      node_stats['failed'], node_stats['elapsed']))
+
+  # jobs left in the queue had no healthy node left to run on.
+  exit_codes = [exit_codes.get(id(job), -1) for job in jobs]
+  for job, exit_code in zip(jobs, exit_codes):
+    if exit_code:
+      print('Shard failed [exit code: %d]: %s' % (exit_code, job['temp_name']))
+
+  return exit_codes
+
+##################################################################################################
+def get_bash_script(jobs, workers, escape=False, transports=None):
+
+  # same schedule as run_jobs, for scripts that are shown, kept or run
+  # elsewhere. at most <workers> jobs run in the background at once.
+  # escape keeps $ from being expanded by an unquoted ssh heredoc.
+  # with transports, jobs are dealt to the nodes round robin.
+  dollar = '\\$' if escape else '$'
+  budgets = plan_threads(jobs, workers)
+
+  bash_commands = list()
+  for number, job in enumerate(order_jobs(jobs)):
+    if transports:
+      transport = transports[number % len(transports)]
+      command = transport.get_command(build_job(job, transport.threads))
+    else:
+      command = build_job(job, budgets[id(job)])
+    if len(jobs) > 1 and workers > 1:
+      bash_commands.append('while [ %s(jobs -rp | wc -l) -ge %d ]; do wait -n; done' % (
+        dollar, workers))
+      bash_commands.append('%s &' % (command))
+    else:
+      bash_commands.append(command)
+
+  if len(jobs) > 1 and workers > 1:
+    bash_commands.append('wait')
+
+  return bash_commands
@@ -0,0 +1,310 @@
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+from probe import probe_file, ProbeError
+from probe_cache import CACHE_DIR, cached_query
+from manifest import get_job_outputs
+
+SEGMENT_DIR = os.environ.get('FFMPEG_WRAPPER_SEGMENT_CACHE_DIR', os.path.join(CACHE_DIR, 'segments'))
+INDEX_FILE = os.path.join(SEGMENT_DIR, 'index.sqlite')
+DISABLE_ENV = 'FFMPEG_WRAPPER_NO_SEGMENT_CACHE'
+
+MAX_SIZE = int(float(os.environ.get('FFMPEG_WRAPPER_SEGMENT_CACHE_GB', 20)) * 1024 ** 3)
+
+# the source fingerprint hashes this many evenly spaced samples.
+SAMPLES = 16
+SAMPLE_SIZE = 1024 * 1024
+
+# linux FICLONE ioctl: shares the extents of a file (btrfs, xfs).
+FICLONE = 0x40049409
+
+connection = None
+# jobs finish on worker threads. they share the one connection.
+lock = threading.Lock()
+
+##################################################################################################
+def disable_segment_cache():
+
+  global connection
+  os.environ[DISABLE_ENV] = '1'
+  connection = None
+
+##################################################################################################
+def is_enabled():
+
+  return not os.environ.get(DISABLE_ENV)
+
+##################################################################################################
+def get_connection():
+
+  global connection
+
+  if connection is None:
+    os.makedirs(SEGMENT_DIR, exist_ok=True)
+    connection = sqlite3.connect(INDEX_FILE, timeout=30, check_same_thread=False)
+    connection.execute('CREATE TABLE IF NOT EXISTS segments (' \
+      'key TEXT, output INTEGER, path TEXT, size INTEGER, created REAL, accessed REAL, ' \
+      'hits INTEGER, PRIMARY KEY (key, output))')
+    connection.execute('CREATE INDEX IF NOT EXISTS segments_accessed ON segments (accessed)')
+    connection.commit()
+
+  return connection
+
+##################################################################################################
+def get_sampled_hash(filename):
+
+  # head, tail and evenly spaced samples in between. reading a whole
+  # episode for every run would cost more than most cache hits save.
+  size = os.path.getsize(filename)
+  digest = hashlib.sha1(str(size).encode('utf-8'))
+
+  with open(filename, 'rb') as f:
+    if size <= SAMPLES * SAMPLE_SIZE:
+      digest.update(f.read())
+    else:
+      step = (size - SAMPLE_SIZE) // (SAMPLES - 1)
+      for num in range(SAMPLES):
+        f.seek(num * step)
+        digest.update(f.read(SAMPLE_SIZE))
+
+  return digest.hexdigest()
+
+##################################################################################################
+def get_source_fingerprint(filename):
+
+  # probe identity catches sources that only differ where nothing was sampled.
+  def compute():
+    media = probe_file(filename)
+    return {
+      'hash': get_sampled_hash(filename),
+      'duration': media.duration,
+      'tracks': media.tracks,
+      'codecs': media.codecs,
+      'dim': media.dim,
+      'frame_rate': media.frame_rate
+    }
+
+  return cached_query(filename, 'segment_cache:fingerprint', compute)
+
+##################################################################################################
+def replace_path(command, path, ending, in_folder=False):
+
+  # whole path tokens only: a path starts a token (or, with in_folder,
+  # follows a replaced destination folder) and ends where <ending> matches.
+  start = r'(?<![^\s"\'=])'
+  if in_folder:
+    start = r'(?:%s|(?<=\{name\}/))' % (start)
+
+  pattern = r'%s%s(?=%s)' % (start, re.escape(path), ending)
+  return re.sub(pattern, lambda match: '{name}', command)
+
+##################################################################################################
+def normalize_command(params, job):
+
+  # names of this run are replaced, so that only the encoder arguments
+  # are left. the same encode of a renamed avscript still hits.
+  command = job['command']
+  names = get_job_outputs(job) + [params['source_file']]
+  for name in sorted(set(names), key=len, reverse=True):
+    command = replace_path(command, name, r'$|[\s"\']')
+
+  # pieces and logs named after the avscript, in or out of the destination folder.
+  if params.get('dest'):
+    command = replace_path(command, params['dest'].rstrip('/'), '/')
+  command = replace_path(command, params['in'][:-4], r'[_.]', in_folder=True)
+
+  return ' '.join(command.split())
+
+##################################################################################################
+def get_job_key(params, job):
+
+  key = {
+    'source': get_source_fingerprint(params['source_file']),
+    'frames': list(job['frame_range']),
+    'command': normalize_command(params, job),
+    'outputs': [os.path.splitext(x)[1] for x in get_job_outputs(job)]
+  }
+
+  return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+##################################################################################################
+def link_file(source, target):
+
+  # hard link, then reflink, then a plain copy. scheduler.build_job
+  # removes the outputs of every encode first, so that ffmpeg never
+  # writes into a file that is linked to the cache.
+  if os.path.lexists(target):
+    os.remove(target)
+
+  try:
+    os.link(source, target)
+    return 'linked'
+  except OSError:
+    pass
+
+  try:
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+      fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    return 'reflinked'
+  except OSError:
+    pass
+
+  shutil.copyfile(source, target)
+  return 'copied'
+
+##################################################################################################
+def evict(db, max_size=MAX_SIZE, max_age=None):
+
+  # least recently used segments go first, whole keys at a time.
+  if max_age is not None:
+    for key, in db.execute('SELECT DISTINCT key FROM segments WHERE accessed < ?',
+        (time.time() - max_age,)).fetchall():
+      remove_entry(db, key)
+
+  total = db.execute('SELECT COALESCE(SUM(size), 0) FROM segments').fetchone()[0]
+  while total > max_size:
+    row = db.execute('SELECT key FROM segments ORDER BY accessed LIMIT 1').fetchone()
+    if not row:
+      break
+    total -= remove_entry(db, row[0])
+
+##################################################################################################
+def remove_entry(db, key):
+
+  removed = 0
+  for path, size in db.execute('SELECT path, size FROM segments WHERE key = ?', (key,)).fetchall():
+    if os.path.isfile(path):
+      os.remove(path)
+    removed += size
+
+  db.execute('DELETE FROM segments WHERE key = ?', (key,))
+  return removed
+
+##################################################################################################
+def restore_outputs(job):
+
+  db = get_connection()
+  rows = db.execute('SELECT output, path FROM segments WHERE key = ? ORDER BY output',
+    (job['cache_key'],)).fetchall()
+
+  outputs = get_job_outputs(job)
+  if len(rows) != len(outputs) or not all([os.path.isfile(x[1]) for x in rows]):
+    return False
+
+  for (output, path), target in zip(rows, outputs):
+    print('Segment cache hit [%s]: %s' % (link_file(path, target), target))
+
+  db.execute('UPDATE segments SET accessed = ?, hits = hits + 1 WHERE key = ?',
+    (time.time(), job['cache_key']))
+  db.commit()
+  return True
+
+##################################################################################################
+def restore_job(params, job):
+
+  # links cached outputs into place. True when the job needs no encode.
+  if not is_enabled() or not job.get('frame_range'):
+    return False
+
+  try:
+    job['cache_key'] = get_job_key(params, job)
+    with lock:
+      return restore_outputs(job)
+
+  except (OSError, ProbeError, sqlite3.Error) as error:
+    print('Segment cache is unavailable, continuing without it: %s' % (error))
+    disable_segment_cache()
+    return False
+
+##################################################################################################
+def store_job(job):
+
+  if not is_enabled() or not job.get('cache_key'):
+    return
+
+  try:
+    with lock:
+      db = get_connection()
+      key = job['cache_key']
+      directory = os.path.join(SEGMENT_DIR, key[:2])
+      os.makedirs(directory, exist_ok=True)
+
+      for num, filename in enumerate(get_job_outputs(job)):
+        path = os.path.join(directory, '%s_%d%s' % (key, num, os.path.splitext(filename)[1]))
+        link_file(filename, path)
+        db.execute('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (key, num, path, os.path.getsize(path), time.time(), time.time(), 0))
+
+      evict(db)
+      db.commit()
+
+  except (OSError, sqlite3.Error) as error:
+    print('Segment cache is unavailable, continuing without it: %s' % (error))
+    disable_segment_cache()
+
+##################################################################################################
+def restore_jobs(params, jobs):
+
+  # jobs that still have to be encoded.
+  pending = [job for job in jobs if not restore_job(params, job)]
+  if len(pending) < len(jobs):
+    print('Segment cache: %d of %d job(s) restored.' % (len(jobs) - len(pending), len(jobs)))
+
+  return pending
+
+##################################################################################################
+def print_stats(db):
+
+  count, segments, total, hits, oldest = db.execute('SELECT COUNT(DISTINCT key), COUNT(*), ' \
+    'COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), MIN(accessed) FROM segments').fetchone()
+
+  print('Segment cache: %s' % (SEGMENT_DIR))
+  print('Entries: %d (%d files)' % (count, segments))
+  print('Size: %.2f GB of %.2f GB' % (total / 1024 ** 3, MAX_SIZE / 1024 ** 3))
+  print('Hits: %d' % (hits))
+  if oldest:
+    print('Least recently used: %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(oldest))))
+
+##################################################################################################
+def get_params():
+
+  parser = argparse.ArgumentParser(description='inspects and prunes the cache of encoded segments.')
+  commands = parser.add_subparsers(dest='command')
+  commands.add_parser('stats', help='prints size, entries and hits of the cache.')
+
+  prune = commands.add_parser('prune', help='evicts least recently used segments.')
+  prune.add_argument('-max_size', type=float, help='size in GB the cache is pruned to ' \
+    '(default: %.0f).' % (MAX_SIZE / 1024 ** 3))
+  prune.add_argument('-max_age', type=float, help='evicts segments unused for this many days.')
+  prune.add_argument('-all', action='store_true', help='empties the cache.')
+
+  params = vars(parser.parse_args())
+  if not params['command']:
+    parser.print_help(); exit(0)
+
+  return params
+
+##################################################################################################
+if __name__ == '__main__':
+
+  params = get_params()
+  db = get_connection()
+
+  if params['command'] == 'prune':
+    if params['all']:
+      max_size = 0
+    else:
+      max_size = params['max_size'] * 1024 ** 3 if params['max_size'] is not None else MAX_SIZE
+
+    evict(db, max_size, params['max_age'] * 24 * 3600 if params['max_age'] is not None else None)
+    db.commit()
+
+  print_stats(db)
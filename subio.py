@@ -0,0 +1,428 @@
+import os
+import re
+import heapq
+import pickle
+import shutil
+import tempfile
+
+# bytes that are not valid utf-8 are carried through as they were read.
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+
+# trimmed events are matched in batches of this many and kept in spools
+# that move to disk past SPOOL_SIZE, so memory does not grow with the file.
+BATCH_SIZE = 10000
+SPOOL_SIZE = 4 * 1024 * 1024
+
+SECTION = re.compile(r'^\s*\[([^\]]+)\]\s*$')
+TIME = re.compile(r'^\s*(\d+):(\d+):(\d+)(?:[.,](\d+))?\s*$')
+PADDING = re.compile(r'^(\s*)(.*?)(\s*)$', re.DOTALL)
+SRT_TIMING = re.compile(r'^(\s*)(\d+:\d+:\d+(?:[.,]\d+)?)(\s*-->\s*)(\d+:\d+:\d+(?:[.,]\d+)?)(.*)$')
+
+EVENT_FORMAT = ['layer', 'start', 'end', 'style', 'name', 'marginl', 'marginr', 'marginv',
+  'effect', 'text']
+
+# header of ass files converted from srt.
+ASS_HEADER = [
+  '[Script Info]',
+  'ScriptType: v4.00+',
+  'WrapStyle: 0',
+  'ScaledBorderAndShadow: yes',
+  'PlayResX: 1280',
+  'PlayResY: 720',
+  '',
+  '[V4+ Styles]',
+  'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, ' \
+    'BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, ' \
+    'BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding',
+  'Style: Default,Arial,40,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,' \
+    '100,100,0,0,1,2,2,2,10,10,10,1',
+  '',
+  '[Events]',
+  'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text'
+]
+
+##################################################################################################
+def parse_time(text):
+
+  # h:mm:ss.cc (ass) or hh:mm:ss,mmm (srt) in milliseconds.
+  match = TIME.match(text)
+  if not match:
+    return None
+
+  hours, minutes, seconds, fraction = match.groups()
+  milliseconds = int((fraction or '0').ljust(3, '0')[:3])
+  return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + milliseconds
+
+##################################################################################################
+def format_ass_time(milliseconds):
+
+  centiseconds = (max(milliseconds, 0) + 5) // 10
+  return '%d:%02d:%02d.%02d' % (centiseconds // 360000, centiseconds // 6000 % 60,
+    centiseconds // 100 % 60, centiseconds % 100)
+
+##################################################################################################
+def format_srt_time(milliseconds):
+
+  milliseconds = max(milliseconds, 0)
+  return '%02d:%02d:%02d,%03d' % (milliseconds // 3600000, milliseconds // 60000 % 60,
+    milliseconds // 1000 % 60, milliseconds % 1000)
+
+##################################################################################################
+def replace_padded(field, text):
+
+  # keeps the whitespace around a field.
+  match = PADDING.match(field)
+  return match.group(1) + text + match.group(3)
+
+##################################################################################################
+def split_newline(line):
+
+  for newline in ['\r\n', '\n', '\r']:
+    if line.endswith(newline):
+      return line[:-len(newline)], newline
+
+  return line, str()
+
+##################################################################################################
+class SubtitleEvent(object):
+
+  # start and end are the only parsed fields, in milliseconds. an event
+  # that was not retimed is written back exactly as it was read.
+
+  def __init__(self, start, end):
+
+    self.start = start
+    self.end = end
+    self.timing = (start, end)
+
+  def is_changed(self):
+
+    return (self.start, self.end) != self.timing
+
+##################################################################################################
+class AssEvent(SubtitleEvent):
+
+  # a Dialogue (or Comment) line of the [Events] section.
+
+  def __init__(self, kind, fields, start_index, end_index, newline):
+
+    self.kind = kind
+    self.fields = fields
+    self.start_index = start_index
+    self.end_index = end_index
+    self.newline = newline
+    super().__init__(parse_time(fields[start_index]), parse_time(fields[end_index]))
+
+  def render(self, number=None):
+
+    fields = self.fields
+    if self.is_changed():
+      fields = list(fields)
+      fields[self.start_index] = replace_padded(fields[self.start_index],
+        format_ass_time(self.start))
+      fields[self.end_index] = replace_padded(fields[self.end_index], format_ass_time(self.end))
+
+    return '%s:%s%s' % (self.kind, ','.join(fields), self.newline)
+
+  def get_closing(self):
+
+    return '\n' if not self.newline else str()
+
+##################################################################################################
+class SrtEvent(SubtitleEvent):
+
+  # a numbered block: counter, timing line, text lines and the blank
+  # lines that end it.
+
+  def __init__(self, counter, timing, lines):
+
+    self.counter = counter
+    self.timing_line = timing
+    self.lines = lines
+    match = SRT_TIMING.match(split_newline(timing)[0])
+    super().__init__(parse_time(match.group(2)), parse_time(match.group(4)))
+
+  def render(self, number=None):
+
+    # blocks are numbered again in the order they are written.
+    counter = self.counter
+    if counter is not None and number is not None:
+      text, newline = split_newline(counter)
+      if text.lstrip('\ufeff').strip() != str(number):
+        counter = '%s%d%s' % ('\ufeff' if text.startswith('\ufeff') else str(), number, newline)
+
+    timing = self.timing_line
+    if self.is_changed():
+      text, newline = split_newline(timing)
+      match = SRT_TIMING.match(text)
+      timing = '%s%s%s%s%s%s' % (match.group(1), format_srt_time(self.start), match.group(3),
+        format_srt_time(self.end), match.group(5), newline)
+
+    return (counter or str()) + timing + ''.join(self.lines)
+
+  def get_closing(self):
+
+    # blocks moved away from the end of the file still need a blank line.
+    last = (self.lines or [self.timing_line])[-1]
+    if not split_newline(last)[1]:
+      return '\n\n'
+    if last.strip():
+      return '\n'
+    return str()
+
+  def get_text(self):
+
+    return '\n'.join([split_newline(x)[0] for x in self.lines if x.strip()])
+
+##################################################################################################
+def read_lines(filename):
+
+  # line endings are kept as they are.
+  with open(filename, 'r', encoding=ENCODING, errors=ERRORS, newline='') as f:
+    for line in f:
+      yield line
+
+##################################################################################################
+def read_ass(lines):
+
+  # every line is passed on as it is, except for events of the [Events]
+  # section, which become AssEvent objects.
+  section = None
+  event_format = EVENT_FORMAT
+
+  for line in lines:
+    text, newline = split_newline(line)
+    match = SECTION.match(text.lstrip('\ufeff'))
+
+    if match:
+      section = match.group(1).strip().lower()
+    elif section == 'events' and ':' in text and not text.lstrip().startswith(';'):
+      kind, value = text.split(':', 1)
+      if kind.strip().lower() == 'format':
+        event_format = [x.strip().lower() for x in value.split(',')]
+      elif 'start' in event_format and 'end' in event_format:
+        fields = value.split(',', len(event_format) - 1)
+        if len(fields) == len(event_format):
+          event = AssEvent(kind, fields, event_format.index('start'), event_format.index('end'),
+            newline)
+          if event.start is not None and event.end is not None:
+            yield event
+            continue
+
+    yield line
+
+##################################################################################################
+def read_srt(lines):
+
+  # a block is its non-blank lines and the blank lines that follow them.
+  block = list()
+  for line in lines:
+    if line.strip() and block and not block[-1].strip():
+      for item in parse_srt_block(block):
+        yield item
+      block = list()
+    block.append(line)
+
+  for item in parse_srt_block(block):
+    yield item
+
+##################################################################################################
+def parse_srt_block(block):
+
+  counter = None
+  position = 0
+  if len(block) > 1 and split_newline(block[0])[0].lstrip('\ufeff').strip().isdigit():
+    counter = block[0]
+    position = 1
+
+  if position < len(block) and SRT_TIMING.match(split_newline(block[position])[0]):
+    yield SrtEvent(counter, block[position], block[position + 1:])
+  else:
+    for line in block:
+      yield line
+
+##################################################################################################
+def read_subtitle(filename):
+
+  if os.path.splitext(filename)[1].lower() == '.srt':
+    return read_srt(read_lines(filename))
+
+  return read_ass(read_lines(filename))
+
+##################################################################################################
+def write_subtitle(filename, items):
+
+  # written next to the target and moved into place once the pipeline
+  # is drained, so a file can be rewritten while it is being read.
+  fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+    prefix='.%s.' % (os.path.basename(filename)))
+
+  try:
+    with os.fdopen(fd, 'w', encoding=ENCODING, errors=ERRORS, newline='') as f:
+      closing = str()
+      number = 0
+
+      for item in items:
+        f.write(closing)
+        if isinstance(item, SubtitleEvent):
+          number += 1
+          f.write(item.render(number))
+          closing = item.get_closing()
+        else:
+          f.write(item)
+          closing = str()
+
+    # mkstemp creates the file readable by the owner only.
+    if os.path.isfile(filename):
+      shutil.copymode(filename, temp_filename)
+    else:
+      umask = os.umask(0)
+      os.umask(umask)
+      os.chmod(temp_filename, 0o666 & ~umask)
+    os.replace(temp_filename, filename)
+
+  except BaseException:
+    os.remove(temp_filename)
+    raise
+
+##################################################################################################
+def delay_events(items, delay):
+
+  for item in items:
+    if isinstance(item, SubtitleEvent):
+      item.start = max(item.start + delay, 0)
+      item.end = max(item.end + delay, 0)
+    yield item
+
+##################################################################################################
+def convert_srt(items):
+
+  # srt events as Default style dialogue, line breaks as \N, italics dropped.
+  for line in ASS_HEADER:
+    yield line + '\n'
+
+  for item in items:
+    if not isinstance(item, SrtEvent):
+      continue
+
+    text = item.get_text().replace('\n', '\\N').replace('<i>', '').replace('</i>', '')
+    fields = [' 0', format_ass_time(item.start), format_ass_time(item.end), 'Default', str(),
+      '0', '0', '0', str(), text]
+    yield AssEvent('Dialogue', fields, 1, 2, '\n')
+
+##################################################################################################
+def get_trim_shifts(intervals, frame_ms):
+
+  # the first trim moves to zero. every later trim closes the gap to the
+  # previous one, less one frame for every trim before it.
+  shifts = list()
+  shift = 0
+
+  for index, (start, end) in enumerate(intervals):
+    if index == 0:
+      shift += start
+    else:
+      shift += start - intervals[index - 1][1] - frame_ms * index
+    shifts.append(shift)
+
+  return shifts
+
+##################################################################################################
+def trim_events(events, intervals, frame_ms):
+
+  # events and intervals are (start, end) pairs in milliseconds. returns
+  # (interval index, event index, start, end) for every kept event: grouped
+  # by interval in the given order and in file order within an interval,
+  # clipped to the interval and shifted.
+  order = sorted(range(len(events)), key=lambda x: events[x][0])
+  matches = [list() for x in intervals]
+  active = list()
+  position = 0
+
+  # events enter the heap once they start before the interval ends and
+  # leave it once they end before an interval starts.
+  for trim in sorted(range(len(intervals)), key=lambda x: intervals[x][0]):
+    trim_start, trim_end = intervals[trim]
+
+    while position < len(order) and events[order[position]][0] <= trim_end:
+      heapq.heappush(active, (events[order[position]][1], order[position]))
+      position += 1
+
+    while active and active[0][0] < trim_start:
+      heapq.heappop(active)
+
+    for end, index in active:
+      start = events[index][0]
+      if (trim_start <= start and end <= trim_end) or (start < trim_end and end > trim_start):
+        matches[trim].append(index)
+
+  trimmed = list()
+  for trim, shift in enumerate(get_trim_shifts(intervals, frame_ms)):
+    trim_start, trim_end = intervals[trim]
+    shift = shift if shift > 0 else 0
+
+    for index in sorted(matches[trim]):
+      start, end = events[index]
+      trimmed.append((trim, index, max(start, trim_start) - shift, min(end, trim_end) - shift))
+
+  return trimmed
+
+##################################################################################################
+class Spool(object):
+
+  # items pickled to a temporary file, read back in the order they were added.
+
+  def __init__(self):
+
+    self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+  def append(self, item):
+
+    pickle.dump(item, self.file, pickle.HIGHEST_PROTOCOL)
+
+  def __iter__(self):
+
+    self.file.seek(0)
+    try:
+      while True:
+        yield pickle.load(self.file)
+    except EOFError:
+      pass
+    finally:
+      self.file.close()
+
+##################################################################################################
+def trim_subtitle(items, intervals, frame_ms):
+
+  # lines before the first event are passed on right away. kept events are
+  # spooled per trim, everything after the first event ([Fonts] included)
+  # follows the last trim.
+  spools = [Spool() for x in intervals]
+  tail = Spool()
+  batch = list()
+  started = False
+
+  def flush():
+    for trim, index, start, end in trim_events([(x.start, x.end) for x in batch],
+        intervals, frame_ms):
+      # the spool keeps a copy, an event kept by several trims is reused.
+      batch[index].start, batch[index].end = start, end
+      spools[trim].append(batch[index])
+    del batch[:]
+
+  for item in items:
+    if isinstance(item, SubtitleEvent):
+      started = True
+      batch.append(item)
+      if len(batch) >= BATCH_SIZE:
+        flush()
+    elif started:
+      tail.append(item)
+    else:
+      yield item
+
+  flush()
+  for spool in spools + [tail]:
+    for item in spool:
+      yield item
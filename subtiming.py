@@ -0,0 +1,197 @@
+import os
+import argparse
+from array import array
+
+import numpy
+from subio import SubtitleEvent, Spool, read_subtitle, write_subtitle, get_trim_shifts
+
+# events longer than this many milliseconds (signs, songs shown for a whole
+# scene) are matched apart from the sorted window of a trim.
+LONG_EVENT = 60000
+
+##################################################################################################
+def snap_times(times, frame_rate):
+
+  # to the nearest frame boundary, back in milliseconds.
+  frames = numpy.rint(times * (frame_rate / 1000.0))
+  return numpy.rint(frames * (1000.0 / frame_rate)).astype(numpy.int64)
+
+##################################################################################################
+class SubtitleTimings(object):
+
+  # event times of a subtitle file as columns: start and end in
+  # milliseconds and the position of each row's event in the file.
+  # transforms work on the columns only. the file is read again when
+  # saved and only the timing fields of its events are rewritten.
+
+  def __init__(self, filename):
+
+    self.filename = filename
+    starts = array('q')
+    ends = array('q')
+
+    for item in read_subtitle(filename):
+      if isinstance(item, SubtitleEvent):
+        starts.append(item.start)
+        ends.append(item.end)
+
+    self.starts = numpy.array(starts, dtype=numpy.int64)
+    self.ends = numpy.array(ends, dtype=numpy.int64)
+    self.index = numpy.arange(len(starts), dtype=numpy.int64)
+
+    # rows are grouped by trim once trimmed. groups are written one after
+    # the other, each in file order.
+    self.groups = None
+
+  def shift(self, delay):
+
+    self.starts = numpy.maximum(self.starts + delay, 0)
+    self.ends = numpy.maximum(self.ends + delay, 0)
+
+  def rescale(self, ratio):
+
+    # e.g. source / target frame rate, for a video that is played faster or slower.
+    self.starts = numpy.rint(self.starts * ratio).astype(numpy.int64)
+    self.ends = numpy.rint(self.ends * ratio).astype(numpy.int64)
+
+  def snap(self, frame_rate):
+
+    self.starts = snap_times(self.starts, frame_rate)
+    self.ends = numpy.maximum(snap_times(self.ends, frame_rate), self.starts)
+
+  def trim(self, intervals, frame_ms):
+
+    # intervals are (start, end) pairs in milliseconds. every interval keeps
+    # the events that lie in or overlap it, clipped to it and shifted.
+    # rows are sorted by start once. an interval only looks at the rows that
+    # start before it ends and no longer than the longest event before it
+    # starts. the few events longer than LONG_EVENT are checked for every
+    # interval, so that one of them does not widen every window. so are
+    # events that end before they start.
+    durations = self.ends - self.starts
+    outside = (durations > LONG_EVENT) | (durations < 0)
+    long_rows = numpy.flatnonzero(outside)
+    short = durations[~outside]
+    longest = int(short.max()) if len(short) else 0
+
+    order = numpy.argsort(self.starts, kind='stable')
+    sorted_starts = self.starts[order]
+    index, starts, ends, groups = list(), list(), list(), list()
+
+    for trim, shift in enumerate(get_trim_shifts(intervals, frame_ms)):
+      trim_start, trim_end = intervals[trim]
+      shift = shift if shift > 0 else 0
+
+      first = numpy.searchsorted(sorted_starts, trim_start - longest, side='left')
+      last = numpy.searchsorted(sorted_starts, trim_end, side='right')
+      rows = numpy.union1d(order[first:last], long_rows)
+
+      row_starts, row_ends = self.starts[rows], self.ends[rows]
+      kept = rows[((row_starts >= trim_start) & (row_ends <= trim_end)) |
+        ((row_starts < trim_end) & (row_ends > trim_start))]
+
+      index.append(self.index[kept])
+      starts.append(numpy.maximum(self.starts[kept], trim_start) - shift)
+      ends.append(numpy.minimum(self.ends[kept], trim_end) - shift)
+      groups.append(numpy.full(len(kept), trim, dtype=numpy.int64))
+
+    self.index = numpy.concatenate(index) if index else self.index[:0]
+    self.starts = numpy.concatenate(starts) if starts else self.starts[:0]
+    self.ends = numpy.concatenate(ends) if ends else self.ends[:0]
+    self.groups = numpy.concatenate(groups) if groups else self.index[:0]
+
+  def get_items(self):
+
+    starts = self.starts.tolist()
+    ends = self.ends.tolist()
+
+    if self.groups is None:
+      # one row per event, in file order.
+      number = 0
+      for item in read_subtitle(self.filename):
+        if isinstance(item, SubtitleEvent):
+          item.start, item.end = starts[number], ends[number]
+          number += 1
+        yield item
+      return
+
+    # lines before the first event are passed on right away. the rows of
+    # every event go to the spool of their group, everything after the
+    # first event ([Fonts] included) follows the last group.
+    order = numpy.argsort(self.index, kind='stable').tolist()
+    index = self.index.tolist()
+    groups = self.groups.tolist()
+    spools = [Spool() for x in range(max(groups) + 1 if groups else 0)]
+    tail = Spool()
+    position = 0
+    number = 0
+
+    for item in read_subtitle(self.filename):
+      if not isinstance(item, SubtitleEvent):
+        if number:
+          tail.append(item)
+        else:
+          yield item
+        continue
+
+      while position < len(order) and index[order[position]] == number:
+        row = order[position]
+        item.start, item.end = starts[row], ends[row]
+        spools[groups[row]].append(item)
+        position += 1
+      number += 1
+
+    for spool in spools + [tail]:
+      for item in spool:
+        yield item
+
+  def save(self, filename=None):
+
+    write_subtitle(filename or self.filename, self.get_items())
+
+##################################################################################################
+def get_params():
+
+  parser = argparse.ArgumentParser(description='retimes subtitle files (.ass, .srt). ' \
+    'changes are applied in the order: delay, frame rate, snap.')
+  parser.add_argument('files', nargs='+', help='subtitle files.')
+  parser.add_argument('-delay', type=int, help='shifts events by <DELAY> milliseconds. ' \
+    '<DELAY> can be negative as well.')
+  parser.add_argument('-fr', type=float, help='frame rate the subtitles are timed for.')
+  parser.add_argument('-r', type=float, help='scales times by <FR> / <R>, for a video ' \
+    'that is sped up or slowed down to <R>. requires -fr.')
+  parser.add_argument('-snap', action='store_true', help='moves times to the nearest frame ' \
+    'boundary of <R> (or <FR>).')
+  parser.add_argument('-overwrite', action='store_true', help='replaces the files instead of ' \
+    'writing <NAME>_edited files.')
+
+  params = vars(parser.parse_args())
+  if params['r'] and not params['fr']:
+    parser.error('-r requires -fr.')
+  if params['snap'] and not (params['r'] or params['fr']):
+    parser.error('-snap requires -fr or -r.')
+
+  return params
+
+##################################################################################################
+if __name__ == '__main__':
+
+  params = get_params()
+
+  for filename in params['files']:
+    print('Processing sub file: %s' % (filename))
+    timings = SubtitleTimings(filename)
+
+    if params['delay']:
+      timings.shift(params['delay'])
+    if params['r']:
+      timings.rescale(params['fr'] / params['r'])
+    if params['snap']:
+      timings.snap(params['r'] or params['fr'])
+
+    output_filename = filename
+    if not params['overwrite']:
+      name, ext = os.path.splitext(filename)
+      output_filename = name + '_edited' + ext
+
+    timings.save(output_filename)
@@ -0,0 +1,122 @@
+import sys
+import threading
+import subprocess
+
+import external
+from external import OutputCapture, read_output
+
+##################################################################################################
+def spawn(code):
+
+  return subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+
+##################################################################################################
+def run_read_output(process, capture, timeout=30):
+
+  # read_output on a thread, so that a hang fails the test instead of the run.
+  reader = threading.Thread(target=read_output, args=(process, capture))
+  reader.start()
+  reader.join(timeout)
+  process.wait(timeout)
+  return not reader.is_alive()
+
+##################################################################################################
+def test_ring_buffer_keeps_the_tail():
+
+  capture = OutputCapture(echo=False, size=4096)
+  process = spawn('import sys\n'
+    'for num in range(20000):\n'
+    '  sys.stdout.write("line %d\\n" % num)\n')
+
+  assert run_read_output(process, capture)
+  output = capture.get_output()
+
+  assert output.endswith('line 19999\n')
+  assert 'line 0\n' not in output
+  assert capture.dropped > 0
+  # chunks are dropped whole, the newest one is always kept.
+  assert capture.buffered <= 4096 + external.CHUNK_SIZE
+  assert capture.dropped + len(output) == sum([len('line %d\n' % x) for x in range(20000)])
+
+##################################################################################################
+def test_read_returns_once_the_child_exits():
+
+  # a child that writes more than a pipe holds and exits without a newline.
+  capture = OutputCapture(echo=False, size=1024)
+  process = spawn('import sys; sys.stdout.write("x" * 300000 + "\\nlast")')
+
+  assert run_read_output(process, capture, timeout=10)
+  assert process.returncode == 0
+  assert capture.get_output().endswith('x\nlast')
+
+##################################################################################################
+def test_lines_split_across_reads_are_matched_whole():
+
+  capture = OutputCapture(['new cluster', 'timestamp'], echo=False)
+  capture.feed(b'Warning: new clu')
+  capture.feed(b'ster, bad timestamp\n')
+  assert capture.caught
+
+##################################################################################################
+def test_multibyte_characters_split_across_reads():
+
+  capture = OutputCapture(echo=False)
+  data = 'Título: ü\n'.encode('utf-8')
+  for num in range(len(data)):
+    capture.feed(data[num:num + 1])
+  capture.close()
+  assert capture.get_output() == 'Título: ü\n'
+
+##################################################################################################
+# output lines of ffmpeg and mkvmerge, by the rule that has to stop the job.
+FATAL_SAMPLES = {
+  'conversion_failed': [
+    'Conversion failed!',
+  ],
+  'muxing_error': [
+    'av_interleaved_write_frame(): Invalid argument\nError muxing a packet for output file #0',
+    '[out#0/matroska @ 0x55d0c2a1e2c0] Error submitting a packet to the muxer: '
+      'Invalid argument',
+  ],
+  'no_space': [
+    'av_interleaved_write_frame(): No space left on device',
+    'Error: Could not write to the output file: No space left on device (28)',
+  ],
+  'mkvmerge_error': [
+    'Error: The file \'ep_01_Encoded.mkv\' could not be opened for reading: open file error.',
+    'Error: No output file name was given.',
+  ],
+  'cluster_timestamp': [
+    'Warning: \'ep_01.mkv\' track 1: The timestamp of the new cluster is smaller than the '
+      'previous one.',
+    'Warning: A timestamp was found that is too far away for a new cluster to start.',
+  ],
+}
+
+# lines every healthy job prints.
+HARMLESS_SAMPLES = [
+  'frame= 1200 fps= 48 q=28.0 size=   10240kB time=00:00:50.05 bitrate=1676.1kbits/s speed=1.9x',
+  'Progress: 42%',
+  'Warning: \'ep_01.mkv\' track 2: Could not find the timestamp of the first frame.',
+  'The cluster timestamp was adjusted.',
+  'Error while decoding stream #0:1: Invalid data found when processing input',
+  'Multiplexing took 3 seconds.',
+]
+
+##################################################################################################
+def test_every_fatal_rule_matches_its_samples():
+
+  assert sorted(FATAL_SAMPLES) == sorted(external.FATAL_RULES)
+
+  for name, samples in FATAL_SAMPLES.items():
+    for sample in samples:
+      capture = OutputCapture(echo=False, fatal=[name])
+      capture.feed(('%s\n' % (sample)).encode('utf-8'))
+      assert capture.aborted and capture.aborted[0] == name, sample
+
+##################################################################################################
+def test_harmless_lines_match_no_rule():
+
+  pattern = external.get_fatal_pattern(sorted(external.FATAL_RULES))
+  for sample in HARMLESS_SAMPLES:
+    assert not pattern.search(sample), sample
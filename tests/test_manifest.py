@@ -0,0 +1,183 @@
+import pytest
+
+import manifest
+from manifest import RunManifest, check_output
+from probe import ProbeError
+
+FRAME_RATE = 24000 / 1001
+
+##################################################################################################
+class Media(object):
+
+  def __init__(self, duration):
+
+    self.duration = duration
+
+##################################################################################################
+@pytest.fixture
+def durations(monkeypatch):
+
+  # ffprobe durations by filename. a missing name fails the probe.
+  durations = dict()
+
+  def probe_file(filename):
+    if filename not in durations:
+      raise ProbeError('not a media file: %s' % (filename))
+    return Media(durations[filename])
+
+  monkeypatch.setattr(manifest, 'probe_file', probe_file)
+  return durations
+
+##################################################################################################
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+
+  monkeypatch.chdir(tmp_path)
+  open('source.mkv', 'wb').write(b'source')
+  return tmp_path
+
+##################################################################################################
+def write_output(filename, durations, duration):
+
+  open(filename, 'wb').write(b'encoded')
+  durations[filename] = duration
+
+##################################################################################################
+def get_job(name, frames=240, command=None):
+
+  return {
+    'temp_name': name,
+    'command': command or 'ffmpeg -i source.mkv -frames:v %d %s' % (frames, name),
+    'progress_frames': frames
+  }
+
+##################################################################################################
+def get_manifest(jobs, states):
+
+  # a manifest of an earlier run, reloaded from disk as -resume does.
+  params = {'in': 'episode.avs', 'frame_rate': FRAME_RATE}
+  previous = RunManifest(manifest.get_manifest_filename(params), params)
+  previous.plan(jobs, ['source.mkv'])
+  for job, state in zip(jobs, states):
+    previous.set_state(job, state, 0 if state == 'done' else 1)
+
+  return RunManifest(manifest.get_manifest_filename(params), params)
+
+##################################################################################################
+def test_check_output_missing_or_empty(workdir, durations):
+
+  assert not check_output('missing.mkv', 10)
+
+  open('empty.mkv', 'wb').close()
+  durations['empty.mkv'] = 10
+  assert not check_output('empty.mkv', 10)
+
+##################################################################################################
+def test_check_output_unreadable(workdir, durations):
+
+  open('broken.mkv', 'wb').write(b'not matroska')
+  assert not check_output('broken.mkv', 10)
+
+  write_output('no_duration.mkv', durations, None)
+  assert not check_output('no_duration.mkv', 10)
+
+##################################################################################################
+@pytest.mark.parametrize('expected, duration, valid', [
+  # short segments: one second either way.
+  (10.0, 10.9, True),
+  (10.0, 9.1, True),
+  (10.0, 11.1, False),
+  (10.0, 8.5, False),
+  # long segments: 2% of the planned duration.
+  (600.0, 611.5, True),
+  (600.0, 588.5, True),
+  (600.0, 612.5, False),
+  (600.0, 587.0, False),
+])
+def test_check_output_duration_tolerance(workdir, durations, expected, duration, valid):
+
+  write_output('segment.mkv', durations, duration)
+  assert check_output('segment.mkv', expected) == valid
+
+##################################################################################################
+def test_check_output_without_expected_duration(workdir, durations):
+
+  write_output('segment.mkv', durations, 1234.0)
+  assert check_output('segment.mkv')
+
+##################################################################################################
+def test_finished_job_is_skipped(workdir, durations):
+
+  job = get_job('episode_01.mkv')
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+
+  assert get_manifest([job], ['done']).get_pending([job]) == list()
+
+##################################################################################################
+def test_failed_job_is_run_again(workdir, durations):
+
+  job = get_job('episode_01.mkv')
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+
+  assert get_manifest([job], ['failed']).get_pending([job]) == [job]
+
+##################################################################################################
+def test_interrupted_job_is_run_again(workdir, durations):
+
+  # killed while running: the output is there, but cut short.
+  job = get_job('episode_01.mkv')
+  write_output('episode_01.mkv', durations, 120 / FRAME_RATE)
+
+  assert get_manifest([job], ['running']).get_pending([job]) == [job]
+
+##################################################################################################
+def test_changed_command_is_run_again(workdir, durations):
+
+  job = get_job('episode_01.mkv')
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+  resumed = get_manifest([job], ['done'])
+
+  changed = get_job('episode_01.mkv', command=job['command'].replace('-i', '-crf 18 -i'))
+  assert resumed.get_pending([changed]) == [changed]
+
+##################################################################################################
+def test_changed_input_is_run_again(workdir, durations):
+
+  job = get_job('episode_01.mkv')
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+  resumed = get_manifest([job], ['done'])
+
+  open('source.mkv', 'wb').write(b'another source')
+  assert resumed.get_pending([job]) == [job]
+
+##################################################################################################
+def test_unplanned_job_is_run(workdir, durations):
+
+  planned, unplanned = get_job('episode_01.mkv'), get_job('episode_02.mkv')
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+  write_output('episode_02.mkv', durations, 240 / FRAME_RATE)
+
+  resumed = get_manifest([planned], ['done'])
+  assert resumed.get_pending([planned, unplanned]) == [unplanned]
+
+##################################################################################################
+def test_job_with_a_missing_output_is_run_again(workdir, durations):
+
+  # every output of a multi output job has to pass.
+  job = dict(get_job('episode_01.mkv'), temp_names=['episode_01.mkv', 'episode_01_1280x720.mkv'])
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+  resumed = get_manifest([job], ['done'])
+  assert resumed.get_pending([job]) == [job]
+
+  write_output('episode_01_1280x720.mkv', durations, 240 / FRAME_RATE)
+  assert resumed.get_pending([job]) == list()
+
+##################################################################################################
+def test_unreadable_manifest_runs_everything(workdir, durations):
+
+  job = get_job('episode_01.mkv')
+  write_output('episode_01.mkv', durations, 240 / FRAME_RATE)
+  params = {'in': 'episode.avs', 'frame_rate': FRAME_RATE}
+  open(manifest.get_manifest_filename(params), 'w').write('{"jobs": ')
+
+  assert RunManifest(manifest.get_manifest_filename(params), params).get_pending([job]) == [job]
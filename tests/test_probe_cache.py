@@ -0,0 +1,165 @@
+import os
+import time
+
+import pytest
+
+import probe_cache
+
+##################################################################################################
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+
+  # a fresh database per test, never the user's cache.
+  monkeypatch.setattr(probe_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+  monkeypatch.setattr(probe_cache, 'CACHE_FILE', str(tmp_path / 'cache' / 'probe.sqlite'))
+  monkeypatch.setattr(probe_cache, 'connection', None)
+  monkeypatch.delenv(probe_cache.DISABLE_ENV, raising=False)
+
+  yield probe_cache
+
+  if probe_cache.connection:
+    probe_cache.connection.close()
+  probe_cache.connection = None
+
+##################################################################################################
+@pytest.fixture
+def source(tmp_path):
+
+  filename = str(tmp_path / 'source.mkv')
+  open(filename, 'wb').write(b'\0' * 1024)
+  return filename
+
+##################################################################################################
+class Probe(object):
+
+  # stands in for ffprobe / mediainfo and counts its calls.
+
+  def __init__(self, value='{"duration": 1.0}'):
+
+    self.value = value
+    self.calls = 0
+
+  def __call__(self):
+
+    self.calls += 1
+    return self.value
+
+##################################################################################################
+def test_hit_skips_the_probe(cache, source):
+
+  probe = Probe()
+  assert cache.cached_query(source, 'ffprobe', probe) == probe.value
+  assert cache.cached_query(source, 'ffprobe', probe) == probe.value
+  assert probe.calls == 1
+
+##################################################################################################
+def test_queries_are_cached_apart(cache, source):
+
+  ffprobe, mediainfo = Probe('ffprobe'), Probe('mediainfo')
+  cache.cached_query(source, 'ffprobe', ffprobe)
+  assert cache.cached_query(source, 'mediainfo', mediainfo) == 'mediainfo'
+  assert cache.cached_query(source, 'ffprobe', ffprobe) == 'ffprobe'
+  assert (ffprobe.calls, mediainfo.calls) == (1, 1)
+
+##################################################################################################
+def test_touched_file_is_probed_again(cache, source):
+
+  probe = Probe()
+  cache.cached_query(source, 'ffprobe', probe)
+
+  stat = os.stat(source)
+  os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+  cache.cached_query(source, 'ffprobe', probe)
+  assert probe.calls == 2
+
+##################################################################################################
+def test_resized_file_is_probed_again(cache, source):
+
+  probe = Probe()
+  cache.cached_query(source, 'ffprobe', probe)
+
+  # same mtime, different size.
+  stat = os.stat(source)
+  open(source, 'ab').write(b'\0')
+  os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  cache.cached_query(source, 'ffprobe', probe)
+  assert probe.calls == 2
+
+##################################################################################################
+def test_renamed_file_still_hits(cache, source, tmp_path):
+
+  # keyed by device and inode, not by path.
+  probe = Probe()
+  cache.cached_query(source, 'ffprobe', probe)
+
+  renamed = str(tmp_path / 'renamed.mkv')
+  os.rename(source, renamed)
+  cache.cached_query(renamed, 'ffprobe', probe)
+  assert probe.calls == 1
+
+##################################################################################################
+def test_replaced_file_is_probed_again(cache, source, tmp_path):
+
+  probe = Probe()
+  cache.cached_query(source, 'ffprobe', probe)
+
+  # a new inode under the same name.
+  replacement = str(tmp_path / 'replacement.mkv')
+  open(replacement, 'wb').write(b'\1' * 1024)
+  os.replace(replacement, source)
+  cache.cached_query(source, 'ffprobe', probe)
+  assert probe.calls == 2
+
+##################################################################################################
+def test_empty_results_are_not_cached(cache, source):
+
+  for value in ['', '  \n', dict(), None]:
+    probe = Probe(value)
+    cache.cached_query(source, 'ffprobe', probe)
+    cache.cached_query(source, 'ffprobe', probe)
+    assert probe.calls == 2
+
+##################################################################################################
+def test_disabled_cache_always_probes(cache, source):
+
+  cache.disable_probe_cache()
+  probe = Probe()
+  cache.cached_query(source, 'ffprobe', probe)
+  cache.cached_query(source, 'ffprobe', probe)
+  assert probe.calls == 2
+
+##################################################################################################
+def test_entries_unused_for_max_age_are_evicted(cache, source, tmp_path):
+
+  cache.cached_query(source, 'ffprobe', Probe())
+  cache.get_connection().execute('UPDATE probes SET accessed = ?',
+    (time.time() - cache.MAX_AGE - 1,))
+
+  # eviction runs whenever a value is stored.
+  other = str(tmp_path / 'other.mkv')
+  open(other, 'wb').write(b'\0')
+  cache.cached_query(other, 'ffprobe', Probe())
+
+  probe = Probe()
+  cache.cached_query(source, 'ffprobe', probe)
+  assert probe.calls == 1
+
+##################################################################################################
+def test_least_recently_used_entries_are_evicted_first(cache, tmp_path, monkeypatch):
+
+  # room for two values of 100 characters.
+  monkeypatch.setattr(cache, 'MAX_SIZE', 250)
+  value = '"%s"' % ('x' * 98)
+  names = list()
+  for name in ['first', 'second', 'third']:
+    names.append(str(tmp_path / name))
+    open(names[-1], 'wb').write(name.encode('utf-8'))
+
+  cache.cached_query(names[0], 'ffprobe', Probe(value))
+  cache.cached_query(names[1], 'ffprobe', Probe(value))
+  # the second file is now the least recently used one.
+  cache.get_connection().execute('UPDATE probes SET accessed = accessed - 10 WHERE path = ?',
+    (os.path.abspath(names[1]),))
+  cache.cached_query(names[2], 'ffprobe', Probe(value))
+
+  assert [cache.get_cached(x, 'ffprobe') is not None for x in names] == [True, False, True]
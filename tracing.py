@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import atexit
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+trace_filename = None
+events = list()
+events_lock = threading.Lock()
+thread_ids = dict()
+started = time.perf_counter()
+
+##################################################################################################
+def enable_tracing(filename):
+
+  # spans are only recorded once tracing is enabled. the trace is
+  # written at exit, since most code paths end with exit(0).
+  global trace_filename
+
+  if trace_filename is None:
+    atexit.register(dump_trace)
+  trace_filename = filename
+
+##################################################################################################
+def is_tracing():
+
+  return trace_filename is not None
+
+##################################################################################################
+def get_io_counters():
+
+  # bytes read and written by this process (linux only).
+  counters = dict()
+  try:
+    with open('/proc/self/io') as f:
+      for line in f:
+        key, value = line.split(':')
+        counters[key] = int(value)
+  except (OSError, ValueError):
+    pass
+
+  return counters
+
+##################################################################################################
+def get_sample():
+
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  io = get_io_counters()
+
+  return {
+    'time': time.perf_counter(),
+    'children_cpu': usage.ru_utime + usage.ru_stime,
+    # block counts are in 512 byte units.
+    'children_read': usage.ru_inblock * 512,
+    'children_written': usage.ru_oublock * 512,
+    'read': io.get('rchar', 0),
+    'written': io.get('wchar', 0),
+  }
+
+##################################################################################################
+def get_thread_id():
+
+  ident = threading.get_ident()
+  with events_lock:
+    return thread_ids.setdefault(ident, len(thread_ids) + 1)
+
+##################################################################################################
+@contextmanager
+def span(name, **args):
+
+  if not is_tracing():
+    yield
+    return
+
+  before = get_sample()
+  try:
+    yield
+  finally:
+    after = get_sample()
+
+    # child counters are process wide: spans that overlap in time
+    # (concurrent jobs) each see the children of the others too.
+    args.update({
+      'children_cpu_s': round(after['children_cpu'] - before['children_cpu'], 3),
+      'children_read_bytes': after['children_read'] - before['children_read'],
+      'children_written_bytes': after['children_written'] - before['children_written'],
+      'read_bytes': after['read'] - before['read'],
+      'written_bytes': after['written'] - before['written'],
+    })
+
+    event = {
+      'name': name,
+      'cat': name.split(':')[0],
+      'ph': 'X',
+      'ts': int((before['time'] - started) * 1000000),
+      'dur': int((after['time'] - before['time']) * 1000000),
+      'pid': os.getpid(),
+      'tid': get_thread_id(),
+      'args': args
+    }
+
+    with events_lock:
+      events.append(event)
+
+##################################################################################################
+def traced(name=None):
+
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with span(name or function.__name__):
+        return function(*args, **kwargs)
+    return wrapper
+
+  return decorator
+
+##################################################################################################
+def dump_trace():
+
+  if not trace_filename:
+    return
+
+  with events_lock:
+    trace = {
+      'traceEvents': sorted(events, key=lambda x: x['ts']),
+      'displayTimeUnit': 'ms'
+    }
+
+  with open(trace_filename, 'w') as f:
+    json.dump(trace, f)
+
+  print('Trace written: %s (%d spans)' % (trace_filename, len(trace['traceEvents'])))
@@ -0,0 +1,67 @@
+import os
+import shlex
+import subprocess
+
+from scheduler import get_available_cpus
+
+##################################################################################################
+def get_export_dir(path=None):
+
+  # compute nodes mount the head node's /state/partition1 under /export.
+  path = path or os.getcwd()
+  return '/'.join([x.replace('state', 'export').replace('partition1', '')
+    for x in path.split('/')])
+
+##################################################################################################
+class SSHTransport(object):
+
+  # runs shards on a compute node. outputs land in the shared export
+  # directory, so they are already in place for the local concat and mux.
+
+  def __init__(self, node):
+
+    self.node = node
+    self.name = 'compute-0-%s' % (node)
+    self.threads = None
+
+  def get_command(self, command):
+
+    remote_command = 'cd %s && %s' % (shlex.quote(get_export_dir()), command)
+    return 'ssh %s %s' % (self.name, shlex.quote(remote_command))
+
+  def run(self, command):
+
+    process = subprocess.Popen(self.get_command(command), shell=True)
+    return process.wait()
+
+##################################################################################################
+class LocalTransport(object):
+
+  # emulates a node with a local subprocess and an equal share of the
+  # host's cores, so sharding can be exercised on one machine.
+
+  def __init__(self, slot, slots):
+
+    self.node = slot
+    self.name = 'local-%d' % (slot)
+    self.threads = max(1, get_available_cpus() // slots)
+
+  def get_command(self, command):
+
+    return command
+
+  def run(self, command):
+
+    process = subprocess.Popen(command, shell=True)
+    return process.wait()
+
+##################################################################################################
+def get_transports(nodes):
+
+  # "3,5,7" shards over compute-0-3, compute-0-5 and compute-0-7.
+  # "local:4" emulates four nodes on this machine.
+  if nodes.startswith('local:'):
+    slots = int(nodes.split(':')[1])
+    return [LocalTransport(x, slots) for x in range(slots)]
+
+  return [SSHTransport(x.strip()) for x in nodes.split(',') if x.strip()]